@@ -0,0 +1,195 @@
+# Target of this module: serving the CDN libraries used by chart pages from a
+# local, content-addressed cache, so that rendering needs no network I/O
+
+import os
+import re
+import json
+import hashlib
+import mimetypes
+import threading
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Dict, List, Tuple
+from urllib.parse import urljoin
+
+import requests
+
+from config import get_env, load_config
+
+# Used when ASSET_CACHE_DIR is not configured
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "multimodal-deepresearcher", "assets"
+)
+
+# Pages request cached assets as /__vendor__/<host>/<path>, so relative URLs
+# inside a library (e.g. Font Awesome's ../webfonts/) resolve to cached paths too
+VENDOR_PREFIX = "/__vendor__/"
+
+KNOWN_CDN_HOSTS = [
+    "d3js.org",
+    "cdnjs.cloudflare.com",
+    "cdn.jsdelivr.net",
+    "unpkg.com",
+    "cdn.plot.ly",
+    "code.jquery.com",
+    "use.fontawesome.com",
+    "fonts.googleapis.com",
+    "fonts.gstatic.com",
+]
+
+CDN_URL_PATTERN = re.compile(
+    r"(?:https?:)?//(?:%s)/[^\s\"'()<>]+" % "|".join(map(re.escape, KNOWN_CDN_HOSTS))
+)
+CSS_URL_PATTERN = re.compile(r"url\(\s*[\"']?([^\"')]+)[\"']?\s*\)")
+
+
+def to_vendor_path(url: str) -> str:
+    return VENDOR_PREFIX + url.split("//", 1)[1]
+
+
+def from_vendor_path(path: str) -> str:
+    return "https://" + path[len(VENDOR_PREFIX) :]
+
+
+def rewrite_cdn_urls(text: str) -> str:
+    """Point every known CDN URL in an HTML or CSS document at the local cache."""
+    return CDN_URL_PATTERN.sub(lambda match: to_vendor_path(match.group(0)), text)
+
+
+def find_cdn_urls(text: str) -> List[str]:
+    urls = []
+    for match in CDN_URL_PATTERN.findall(text):
+        url = "https:" + match if match.startswith("//") else match
+        if url not in urls:
+            urls.append(url)
+    return urls
+
+
+class AssetCache:
+    """Content-addressed store of CDN assets.
+
+    Bodies live in objects/<sha256> and each URL maps to its object through a
+    small urls/<sha256 of url>.json record. Every file is written atomically
+    and never shared between URLs, so render processes can use one cache
+    directory concurrently. With `offline=True` a miss is an error instead of
+    a download.
+    """
+
+    def __init__(self, cache_dir: str | Path | None = None, offline: bool = False):
+        if cache_dir is None:
+            cache_dir = get_env("ASSET_CACHE_DIR", DEFAULT_CACHE_DIR)
+        self.cache_dir = Path(cache_dir)
+        self.offline = offline
+        self._objects_dir = self.cache_dir / "objects"
+        self._urls_dir = self.cache_dir / "urls"
+        self._objects_dir.mkdir(parents=True, exist_ok=True)
+        self._urls_dir.mkdir(parents=True, exist_ok=True)
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "downloaded_bytes": 0}
+
+    def _record_path(self, url: str) -> Path:
+        return self._urls_dir / (hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def _url_lock(self, url: str) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(url, threading.Lock())
+
+    @staticmethod
+    def _write_atomic(path: Path, data: bytes):
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+    def get(self, url: str) -> Tuple[bytes, str] | None:
+        """Return (body, content type) of a cached URL, or None."""
+        record_path = self._record_path(url)
+        try:
+            record = json.loads(record_path.read_text(encoding="utf-8"))
+            body = (self._objects_dir / record["sha256"]).read_bytes()
+        except (OSError, ValueError, KeyError):
+            return None
+        return body, record["content_type"]
+
+    def put(self, url: str, body: bytes, content_type: str):
+        digest = hashlib.sha256(body).hexdigest()
+        object_path = self._objects_dir / digest
+        if not object_path.exists():
+            self._write_atomic(object_path, body)
+        record = {"url": url, "sha256": digest, "content_type": content_type}
+        self._write_atomic(self._record_path(url), json.dumps(record).encode("utf-8"))
+
+    def fetch(self, url: str) -> Tuple[bytes, str]:
+        """Return a cached asset, downloading it once on a miss."""
+        with self._url_lock(url):
+            cached = self.get(url)
+            if cached is not None:
+                self.stats["hits"] += 1
+                return cached
+            self.stats["misses"] += 1
+            if self.offline:
+                raise LookupError(f"{url} is not in the asset cache")
+
+            proxy_addr = get_env("PROXY_ADDR")
+            proxies = {"http": proxy_addr, "https": proxy_addr} if proxy_addr else None
+            response = requests.get(url, proxies=proxies, timeout=30)
+            response.raise_for_status()
+            content_type = response.headers.get("Content-Type") or (
+                mimetypes.guess_type(url)[0] or "application/octet-stream"
+            )
+            self.put(url, response.content, content_type)
+            self.stats["downloaded_bytes"] += len(response.content)
+            return response.content, content_type
+
+    def prefetch(self, html_paths: List[str | Path]) -> Dict:
+        """Warm the cache with every CDN asset referenced by the given pages,
+        including fonts and images referenced from cached stylesheets."""
+        pending = []
+        for html_path in html_paths:
+            text = Path(html_path).read_text(encoding="utf-8", errors="replace")
+            pending.extend(url for url in find_cdn_urls(text) if url not in pending)
+
+        fetched, failed = [], {}
+        while pending:
+            url = pending.pop(0)
+            if url in fetched or url in failed:
+                continue
+            try:
+                body, content_type = self.fetch(url)
+            except Exception as e:
+                failed[url] = str(e)
+                continue
+            fetched.append(url)
+            if "css" in content_type:
+                css = body.decode("utf-8", errors="replace")
+                for ref in CSS_URL_PATTERN.findall(css):
+                    if not ref.startswith("data:"):
+                        pending.append(urljoin(url, ref).split("#")[0])
+        return {"fetched": fetched, "failed": failed}
+
+
+if __name__ == "__main__":
+    load_config()
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    prefetch_parser = subparsers.add_parser(
+        "prefetch", help="Download the CDN assets used by chart pages into the cache"
+    )
+    prefetch_parser.add_argument(
+        "folders", type=str, nargs="+", help="Folders searched for *.html pages"
+    )
+    prefetch_parser.add_argument(
+        "--cache_dir", type=str, default=None, help="Defaults to ASSET_CACHE_DIR"
+    )
+    args = parser.parse_args()
+
+    html_paths = [path for folder in args.folders for path in Path(folder).rglob("*.html")]
+    cache = AssetCache(args.cache_dir)
+    result = cache.prefetch(html_paths)
+    print(
+        f"Scanned {len(html_paths)} pages: {len(result['fetched'])} assets cached "
+        f"({cache.stats['misses']} downloaded, {cache.stats['downloaded_bytes']} bytes) "
+        f"in {cache.cache_dir}"
+    )
+    for url, error in result["failed"].items():
+        print(f"Failed: {url}: {error}")
@@ -0,0 +1,982 @@
+# Micro-benchmarks for src/utils. Run from this folder, e.g.
+#   python benchmark.py border --folder ../../public/html_charts
+
+import re
+import sys
+import json
+import time
+import subprocess
+import random
+import platform
+import statistics
+import tempfile
+import asyncio
+import threading
+import tracemalloc
+import http.server
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+from config import load_config
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+HTML_CHARTS_FOLDER = REPO_ROOT / "public" / "html_charts"
+
+
+def measure(func: Callable, repeat: int = 5) -> dict:
+    """Run `func` `repeat` times and return the best and mean wall time in ms."""
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start_time) * 1000)
+    return {"best_ms": min(timings), "mean_ms": sum(timings) / len(timings)}
+
+
+def print_comparison(name: str, baseline: dict, current: dict):
+    speedup = baseline["best_ms"] / current["best_ms"] if current["best_ms"] else 0
+    print(
+        f"{name:<48} baseline {baseline['best_ms']:9.2f}ms | "
+        f"current {current['best_ms']:9.2f}ms | x{speedup:.1f}"
+    )
+
+
+def remove_any_color_border_loop(image):
+    """The previous row/column scanning implementation, kept as the baseline."""
+    import numpy as np
+
+    img_array = np.array(image)
+    height, width = img_array.shape[:2]
+    axis = 1 if len(img_array.shape) == 3 else 0
+    border_color = img_array[0, 0]
+
+    top = 0
+    while top < height and np.all(img_array[top, :] == border_color, axis=axis).all():
+        top += 1
+    bottom = height - 1
+    while (
+        bottom >= 0
+        and np.all(img_array[bottom, :] == border_color, axis=axis).all()
+    ):
+        bottom -= 1
+    left = 0
+    while left < width and np.all(img_array[:, left] == border_color, axis=axis).all():
+        left += 1
+    right = width - 1
+    while (
+        right >= 0 and np.all(img_array[:, right] == border_color, axis=axis).all()
+    ):
+        right -= 1
+
+    if top <= bottom and left <= right:
+        cropped_image = image.crop((left, top, right + 1, bottom + 1))
+        return cropped_image, right - left + 1, bottom - top + 1
+    return image, width, height
+
+
+def load_border_images(folder: Path) -> List:
+    from PIL import Image
+
+    paths = sorted(folder.rglob("*_screenshot.png"))
+    if paths:
+        return [(str(path.relative_to(folder)), Image.open(path).copy()) for path in paths]
+
+    # No rendered screenshots yet (see `pageRender.py --batch`): fall back to a
+    # 2000x2400 page with wide uniform margins around a small chart
+    print(f"No *_screenshot.png under {folder}, using a synthetic screenshot")
+    image = Image.new("RGBA", (2000, 2400), "white")
+    image.paste(Image.new("RGBA", (900, 600), (70, 130, 180, 255)), (550, 800))
+    return [("synthetic_2000x2400.png", image)]
+
+
+def bench_border(args):
+    from pageRender import remove_any_color_border
+
+    images = load_border_images(Path(args.folder))
+    total_baseline, total_current = 0.0, 0.0
+    for name, image in images:
+        expected = remove_any_color_border_loop(image)[1:]
+        actual = remove_any_color_border(image)[1:]
+        if expected != actual:
+            raise AssertionError(f"{name}: baseline {expected} != current {actual}")
+        baseline = measure(lambda: remove_any_color_border_loop(image), args.repeat)
+        current = measure(lambda: remove_any_color_border(image), args.repeat)
+        total_baseline += baseline["best_ms"]
+        total_current += current["best_ms"]
+        print_comparison(name, baseline, current)
+    print_comparison(
+        f"total ({len(images)} images)",
+        {"best_ms": total_baseline},
+        {"best_ms": total_current},
+    )
+
+
+STUB_HEAD = (
+    "<html><head><title>Stub page {index}</title>"
+    '<meta name="description" content="Description of stub page {index}">'
+    "</head><body>"
+)
+STUB_PARAGRAPH = "<p>lorem ipsum dolor sit amet</p>"
+
+
+class QuietHTTPServer(http.server.ThreadingHTTPServer):
+    """Threaded server for the stubs: a deep accept backlog, so a burst of
+    connections is not reset, and no tracebacks for clients that hang up."""
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = (
+            STUB_HEAD.format(index=self.path.rsplit("/", 1)[-1]) + self.server.page_body
+        ).encode("utf-8")
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The streaming fetcher stops reading once it has the head
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def stub_http_server(page_kb: int = 16):
+    """A local HTTP server answering every path with a `page_kb` HTML page."""
+    httpd = QuietHTTPServer(("127.0.0.1", 0), StubHandler)
+    paragraphs = page_kb * 1024 // len(STUB_PARAGRAPH)
+    httpd.page_body = STUB_PARAGRAPH * paragraphs + "</body></html>"
+    server_thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    server_thread.start()
+    try:
+        yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+async def get_url_info_baseline(url: str) -> dict:
+    """The previous get_url_info: a new ClientSession for every URL."""
+    import aiohttp
+    from utils import DEFAULT_HEADERS, process_response_text
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(
+                url, headers=DEFAULT_HEADERS, timeout=aiohttp.ClientTimeout(total=10)
+            ) as response:
+                response.raise_for_status()
+                res = process_response_text(await response.text())
+                res["url"] = url
+                return res
+    except Exception as e:
+        return {"error": str(e), "url": url}
+
+
+def bench_url_info(args):
+    from utils import UrlFetcher
+
+    async def run_baseline(urls):
+        return await asyncio.gather(*[get_url_info_baseline(url) for url in urls])
+
+    async def run_pooled(urls):
+        async with UrlFetcher(
+            max_concurrency=args.max_concurrency, per_host_limit=args.per_host_limit
+        ) as fetcher:
+            return await asyncio.gather(*[fetcher.get_url_info(url) for url in urls])
+
+    runners = [
+        ("baseline (session per URL, unbounded)", run_baseline),
+        (
+            f"UrlFetcher (limit {args.max_concurrency}, per host {args.per_host_limit})",
+            run_pooled,
+        ),
+    ]
+    runs = {name: [] for name, _ in runners}
+    with stub_http_server(args.page_kb) as base_url:
+        urls = [f"{base_url}/page/{i}" for i in range(args.urls)]
+        # Alternate the runners so drift on the machine hits both alike
+        for _ in range(args.repeat):
+            for name, runner in runners:
+                if args.trace_memory:
+                    tracemalloc.start()
+                start_time = time.perf_counter()
+                results = asyncio.run(runner(urls))
+                elapsed = time.perf_counter() - start_time
+                peak = 0
+                if args.trace_memory:
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                errors = sum(1 for res in results if "error" in res)
+                runs[name].append((len(urls) / elapsed, errors, peak))
+
+    for name, _ in runners:
+        rates = [rate for rate, _, _ in runs[name]]
+        median_rate = statistics.median(rates)
+        peak_memory = ""
+        if args.trace_memory:
+            peak_memory = f" | peak {max(peak for _, _, peak in runs[name]) / 1024**2:.1f}MB"
+        print(
+            f"{name:<48} {median_rate:9.1f} requests/sec (median of {len(rates)}, "
+            f"{min(rates):.1f}-{max(rates):.1f}) | "
+            f"{1000 / median_rate:7.2f}ms/reference | "
+            f"{sum(errors for _, errors, _ in runs[name])} errors{peak_memory}"
+        )
+
+
+class MockFirecrawlHandler(http.server.BaseHTTPRequestHandler):
+    """Answers POST /v1/search like Firecrawl, allowing `rate` requests per
+    second and answering 429 with a Retry-After beyond that."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        with server.lock:
+            server.requests += 1
+            now = time.monotonic()
+            server.tokens = min(server.rate, server.tokens + (now - server.last) * server.rate)
+            server.last = now
+            allowed = server.tokens >= 1
+            if allowed:
+                server.tokens -= 1
+            else:
+                server.rejected += 1
+        if allowed:
+            time.sleep(server.latency)
+            body = json.dumps(
+                {
+                    "success": True,
+                    "data": [
+                        {
+                            "url": f"https://example.com/{data['query']}/{i}",
+                            "title": data["query"],
+                            "description": "",
+                        }
+                        for i in range(data.get("limit", 5))
+                    ],
+                }
+            ).encode("utf-8")
+            self.send_response(200)
+        else:
+            body = b'{"success": false, "error": "Rate limit exceeded"}'
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def mock_firecrawl_server(rate: float, latency: float):
+    httpd = QuietHTTPServer(("127.0.0.1", 0), MockFirecrawlHandler)
+    httpd.lock = threading.Lock()
+    httpd.rate, httpd.latency = rate, latency
+    httpd.tokens, httpd.last = rate, time.monotonic()
+    httpd.requests = httpd.rejected = 0
+    server_thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    server_thread.start()
+    try:
+        yield httpd, f"http://127.0.0.1:{httpd.server_address[1]}/v1/search"
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+async def firecrawl_search_baseline(url: str, query: str, params: dict) -> dict:
+    """The previous firecrawl_search: a new ClientSession per query and
+    tenacity's exponential wait (4s to 60s) on failure, ignoring Retry-After."""
+    import aiohttp
+
+    for attempt in range(6):
+        async with aiohttp.ClientSession() as session:
+            async with session.post(url, json={"query": query, **params}) as response:
+                if response.status != 429:
+                    return await response.json()
+        await asyncio.sleep(min(60, max(4, 2**attempt)))
+    return {"success": False}
+
+
+def bench_search(args):
+    from tools import SearchClient
+
+    queries = [f"query {i % args.unique}" for i in range(args.queries)]
+    params = {"limit": 5}
+
+    async def run_baseline(url):
+        return await asyncio.gather(
+            *[firecrawl_search_baseline(url, query, params) for query in queries]
+        )
+
+    async def run_client(url):
+        async with SearchClient(
+            api_key="mock",
+            base_url=url,
+            requests_per_minute=args.rate * 60,
+            burst=int(args.rate),
+            proxy="",
+        ) as client:
+            results = await client.search_many(queries, params)
+        print(f"  client stats: {client.stats}")
+        return results
+
+    for name, runner in [
+        ("baseline (session per query, no limiter)", run_baseline),
+        (f"SearchClient ({args.rate:g} requests/sec, coalesced)", run_client),
+    ]:
+        with mock_firecrawl_server(args.rate, args.latency_ms / 1000) as (httpd, url):
+            start_time = time.perf_counter()
+            results = asyncio.run(runner(url))
+            elapsed = time.perf_counter() - start_time
+            failures = sum(1 for res in results if not res.get("success"))
+            print(
+                f"{name:<48} {len(queries) / elapsed:7.1f} queries/sec | "
+                f"{httpd.requests} upstream requests | {httpd.rejected} rejected (429) | "
+                f"{failures} failed"
+            )
+
+
+def synthetic_references(count: int, seed: int = 0) -> List:
+    """References where about a third repeat an earlier page under another URL
+    spelling and a few are syndicated copies with one word changed."""
+    rng = random.Random(seed)
+    vocabulary = [f"word{i}" for i in range(5000)]
+    url_variants = [
+        "https://{host}/{path}",
+        "http://www.{host}/{path}/",
+        "https://{host}/{path}?utm_source=newsletter&utm_medium=email",
+        "https://{host}/{path}#section-2",
+    ]
+    references = []
+    for i in range(count):
+        if references and rng.random() < 0.35:
+            original = rng.choice(references)
+            host, path = original.host, original.path
+            title, description = original.title, original.description
+            if rng.random() < 0.3:
+                host = f"mirror{i}.org"
+                description = description.replace(description.split()[0], "changed", 1)
+        else:
+            host, path = f"site{i}.com", f"article/{i}"
+            title = " ".join(rng.sample(vocabulary, 8))
+            description = " ".join(rng.choices(vocabulary, k=30))
+        references.append(
+            SimpleNamespace(
+                url=rng.choice(url_variants).format(host=host, path=path),
+                host=host,
+                path=path,
+                title=title,
+                description=description,
+            )
+        )
+    return references
+
+
+def bench_dedup(args):
+    from utils import deduplicate_by_url
+
+    references = synthetic_references(args.references)
+
+    def baseline():
+        return list({reference.url: reference for reference in references}.values())
+
+    for name, runner in [
+        ("baseline (raw URL string)", baseline),
+        ("canonical URL", lambda: deduplicate_by_url(references)),
+        (
+            "canonical URL + near duplicates",
+            lambda: deduplicate_by_url(references, near_duplicates=True),
+        ),
+    ]:
+        timing = measure(runner, args.repeat)
+        kept = len(runner())
+        print(
+            f"{name:<48} {len(references) / timing['best_ms'] * 1000:10.0f} references/sec | "
+            f"{kept} of {len(references)} kept"
+        )
+
+
+def sanitize_baseline(html_str: str) -> str:
+    """The previous process_html_str followed by clean_body_styles."""
+
+    def replace_styles(match):
+        style_block = match.group(1)
+        style_block = re.sub(r"padding\s*:\s*[^;]+;", "padding: 0;", style_block)
+        return re.sub(
+            r"background-color\s*:\s*[^;]+;", "background-color: white;", style_block
+        )
+
+    font_awesome_pattern = r'<script\s+src="https://kit\.fontawesome\.com/a076d05399\.js"(?:\s+crossorigin(?:=["\'](.*?)["\'])?)?(?:\s+[^>]*)?></script>'
+    replacement = '<link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css">'
+    html_str = re.sub(font_awesome_pattern, replacement, html_str)
+    html_str = re.sub(r'<body\s+class=["\'][^"\']*["\']', "<body", html_str)
+    html_str = re.sub(r'<body\s+style=["\'][^"\']*["\']', "<body", html_str)
+    html_str = re.sub(r'<body([^>]*)\s+class=["\'][^"\']*["\']', r"<body\1", html_str)
+    html_str = re.sub(r'<body([^>]*)\s+style=["\'][^"\']*["\']', r"<body\1", html_str)
+    for pattern in [
+        r"(body\s*\{[^}]*\})",
+        r"(\.container\s*\{[^}]*\})",
+        r"(\.visualization-container\s*\{[^}]*\})",
+    ]:
+        html_str = re.sub(pattern, replace_styles, html_str, flags=re.DOTALL)
+    return html_str
+
+
+def bench_sanitize(args):
+    from htmlSanitizer import sanitize_html
+
+    pages = [
+        path.read_text(encoding="utf-8") for path in sorted(Path(args.folder).rglob("*.html"))
+    ]
+    if not pages:
+        raise SystemExit(f"No pages found in {args.folder}")
+    mismatches = sum(1 for page in pages if sanitize_baseline(page) != sanitize_html(page))
+    total_bytes = sum(len(page.encode("utf-8")) for page in pages)
+    baseline = measure(lambda: [sanitize_baseline(page) for page in pages], args.repeat)
+    current = measure(lambda: [sanitize_html(page) for page in pages], args.repeat)
+    print_comparison(f"sanitize {len(pages)} pages ({total_bytes / 1024:.0f}KB)", baseline, current)
+    print(
+        f"{len(pages) / current['best_ms'] * 1000:.0f} pages/sec, "
+        f"{mismatches} pages where the output differs from the baseline"
+    )
+
+
+def log_baseline(class_variables: List[str]):
+    """The previous log decorator (sync path): message and JSON built eagerly."""
+    import logging
+    from functools import wraps
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            logger = logging.getLogger("benchmark")
+            start_time = time.perf_counter()
+            vars = {var: getattr(self, var, "<未找到>") for var in class_variables}
+            result = func(self, *args, **kwargs)
+            duration = time.perf_counter() - start_time
+            logger.debug(
+                f"✅ 方法 {self.__class__.__name__}.{func.__name__} 成功 | "
+                f"耗时: {duration:.2f}s | "
+                f"return: {result} | "
+                f"类变量: {json.dumps(vars, indent=4, ensure_ascii=False)}"
+            )
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def bench_log(args):
+    import logging
+    from utils import log
+
+    # About 1KB per section
+    report = {"sections": ["lorem ipsum dolor sit amet " * 38] * args.report_kb}
+    logging.getLogger().setLevel(logging.INFO)
+
+    class Baseline:
+        def __init__(self):
+            self.report = report
+
+        @log_baseline(["report"])
+        def step(self):
+            return self.report
+
+    class Current(Baseline):
+        @log(["report"])
+        def step(self):
+            return self.report
+
+    baseline, current = Baseline(), Current()
+    print_comparison(
+        f"{args.calls} calls, ~{args.report_kb}KB report, DEBUG filtered",
+        measure(lambda: [baseline.step() for _ in range(args.calls)], args.repeat),
+        measure(lambda: [current.step() for _ in range(args.calls)], args.repeat),
+    )
+
+
+def bench_logging(args):
+    import logging
+    import tempfile
+    from utils import configure_logger, stop_log_listener
+
+    message = "x" * args.message_bytes
+
+    async def run():
+        lags = []
+        records = 0
+        stop_time = time.perf_counter() + args.seconds
+
+        async def ticker():
+            while time.perf_counter() < stop_time:
+                start_time = time.perf_counter()
+                await asyncio.sleep(0.001)
+                lags.append(time.perf_counter() - start_time - 0.001)
+
+        async def writer():
+            nonlocal records
+            logger = logging.getLogger("benchmark")
+            while time.perf_counter() < stop_time:
+                for _ in range(args.burst):
+                    logger.debug("record %d: %s", records, message)
+                    records += 1
+                await asyncio.sleep(0)
+
+        await asyncio.gather(ticker(), *[writer() for _ in range(args.writers)])
+        return sorted(lags), records
+
+    root_logger = logging.getLogger()
+    with tempfile.TemporaryDirectory() as log_dir:
+        for name, use_queue in [("FileHandler (blocking)", False), ("QueueHandler", True)]:
+            log_file = Path(log_dir, f"{use_queue}.log")
+            configure_logger(log_file, use_queue=use_queue, max_bytes=args.max_mb * 1024**2)
+            handlers = root_logger.handlers[-1:]
+            lags, records = asyncio.run(run())
+            stop_log_listener()
+            for handler in handlers:
+                root_logger.removeHandler(handler)
+                handler.close()
+            lags_ms = [lag * 1000 for lag in lags]
+            print(
+                f"{name:<24} loop lag p50 {lags_ms[len(lags_ms) // 2]:6.2f}ms | "
+                f"p99 {lags_ms[int(len(lags_ms) * 0.99)]:6.2f}ms | max {lags_ms[-1]:7.2f}ms | "
+                f"{records / args.seconds:9.0f} records/sec"
+            )
+
+
+# Modules too heavy to load when importing utils or tools
+HEAVY_MODULES = ["tiktoken", "bs4", "requests", "aiohttp", "dotenv", "langchain", "schema"]
+STARTUP_SCRIPT = """
+import importlib, json, sys, time
+start_time = time.perf_counter()
+importlib.import_module({module!r})
+elapsed = time.perf_counter() - start_time
+heavy = sorted(name for name in sys.modules if name.split(".")[0] in {heavy!r})
+print(json.dumps({{"ms": elapsed * 1000, "heavy": heavy}}))
+"""
+
+
+def measure_startup(module: str, runs: int) -> dict:
+    """Import `module` in fresh interpreters; return the best import time, the
+    heavy modules it pulled in and the slowest imports of one -X importtime run."""
+    utils_folder = Path(__file__).resolve().parent
+    script = STARTUP_SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=utils_folder,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    importtime = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=utils_folder,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    slowest = []
+    for line in importtime.splitlines()[1:]:
+        self_us, cumulative_us, name = line.split(":", 1)[1].split("|")
+        slowest.append((int(self_us) / 1000, int(cumulative_us) / 1000, name.strip()))
+    slowest.sort(reverse=True)
+    return {
+        "best_ms": min(result["ms"] for result in results),
+        "heavy": results[0]["heavy"],
+        "slowest": slowest[:5],
+    }
+
+
+def bench_startup(args):
+    """Exits non-zero when a module goes over the budget or imports a heavy
+    dependency, so it can gate changes like a test."""
+    failed = False
+    for module in args.modules:
+        result = measure_startup(module, args.runs)
+        over_budget = result["best_ms"] > args.budget_ms
+        failed = failed or over_budget or bool(result["heavy"])
+        print(
+            f"import {module:<20} {result['best_ms']:8.1f}ms (budget {args.budget_ms:g}ms)"
+            f"{' OVER BUDGET' if over_budget else ''}"
+            f"{' | heavy: ' + ', '.join(result['heavy']) if result['heavy'] else ''}"
+        )
+        for self_ms, cumulative_ms, name in result["slowest"]:
+            print(f"    {name:<36} self {self_ms:7.1f}ms | cumulative {cumulative_ms:7.1f}ms")
+    if failed:
+        sys.exit(1)
+
+
+def trim_baseline(content: str, context_size: int) -> str:
+    """The previous trim: estimate a character cut, split, re-encode, recurse."""
+    import tiktoken
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    if not content:
+        return ""
+    encoder = tiktoken.get_encoding("cl100k_base")
+    length = len(encoder.encode(content))
+    if length <= context_size:
+        return content
+    chunk_size = len(content) - (length - context_size) * 3
+    if chunk_size < 140:
+        return content[:140]
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=0)
+    chunks = splitter.split_text(content)
+    trimmed_prompt = chunks[0] if chunks else ""
+    if len(trimmed_prompt) == len(content):
+        return trim_baseline(content[:chunk_size], context_size)
+    return trim_baseline(trimmed_prompt, context_size)
+
+
+def load_report_corpus(min_chars: int) -> str:
+    """The bundled MDX reports, repeated until at least `min_chars` long."""
+    reports = [
+        path.read_text(encoding="utf-8")
+        for path in sorted((REPO_ROOT / "data" / "report").glob("*.mdx"))
+    ]
+    corpus = "\n\n".join(reports)
+    return corpus * (min_chars // len(corpus) + 1)
+
+
+def bench_trim(args):
+    import tiktoken
+    from utils import trim
+
+    # ~4 characters per token for English prose
+    content = load_report_corpus(args.tokens * 4)
+    calls = {"encode": 0}
+    original_encode = tiktoken.Encoding.encode
+
+    def counting_encode(self, *encode_args, **encode_kwargs):
+        calls["encode"] += 1
+        return original_encode(self, *encode_args, **encode_kwargs)
+
+    tiktoken.Encoding.encode = counting_encode
+    try:
+        for name, func in [
+            ("baseline (estimate, split, recurse)", trim_baseline),
+            ("trim (single encode, exact cut)", trim),
+        ]:
+            calls["encode"] = 0
+            start_time = time.perf_counter()
+            trimmed = func(content, args.context_size)
+            elapsed = (time.perf_counter() - start_time) * 1000
+            encodes = calls["encode"]
+            tokens = len(original_encode(tiktoken.get_encoding("cl100k_base"), trimmed))
+            print(
+                f"{name:<40} {elapsed:9.1f}ms | {encodes:3d} encodes | "
+                f"{tokens} of {args.context_size} tokens kept"
+            )
+    finally:
+        tiktoken.Encoding.encode = original_encode
+
+
+TAG_SNIPPETS = ["<a>", "</a>", "<b>", "</b>", "<ab>", "</ab>", "<T>", "<", ">", "</", "x", "y", " "]
+
+
+def random_chunks(text: str, rng: random.Random) -> List[str]:
+    cuts = sorted(rng.sample(range(1, len(text)), min(len(text) - 1, rng.randint(0, 6))))
+    return [text[start:end] for start, end in zip([0, *cuts], [*cuts, len(text)])]
+
+
+def bench_tags(args):
+    """Differential check: TagStreamParser fed random chunks of random texts
+    must return what parse_tags returns for the whole text. Exits non-zero on
+    the first disagreement."""
+    from utils import ANY_TAG_PATTERN, TagStreamParser, get_tags_pattern, parse_tags
+
+    rng = random.Random(args.seed)
+    for case in range(args.cases):
+        text = "".join(rng.choice(TAG_SNIPPETS) for _ in range(rng.randint(1, 24)))
+        tags = rng.choice([None, ["a"], ["a", "b"], ["ab", "a"], ["T", "b"]])
+        parser = TagStreamParser(tags)
+        streamed = []
+        for chunk in random_chunks(text, rng):
+            streamed.extend(parser.feed(chunk))
+        streamed.extend(parser.close())
+        expected = [
+            (match.group(1), match.group(2))
+            for match in (
+                get_tags_pattern(tuple(tags)) if tags else ANY_TAG_PATTERN
+            ).finditer(text)
+        ]
+        grouped = {}
+        for tag, content in streamed:
+            grouped.setdefault(tag, []).append(content)
+        if streamed != expected or grouped != parse_tags(text, tags):
+            print(f"case {case}: tags={tags} text={text!r}")
+            print(f"  streamed {streamed}")
+            print(f"  expected {expected}")
+            sys.exit(1)
+    print(f"{args.cases} random cases agree with parse_tags")
+
+    response = "".join(
+        f"<think>step {i} uses List<T> and a < b</think>\n<chart_{i}>{'data ' * 200}</chart_{i}>\n"
+        for i in range(200)
+    )
+    chunks = [response[i : i + 16] for i in range(0, len(response), 16)]
+
+    def stream():
+        parser = TagStreamParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+        parser.close()
+
+    print_comparison(
+        f"parse_tags vs. stream in 16-char chunks ({len(response) // 1024} KB)",
+        measure(lambda: parse_tags(response), args.repeat),
+        measure(stream, args.repeat),
+    )
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def render_corpus(folder: Path, limit: int | None) -> List:
+    pages = [
+        (str(page.parent), page.name)
+        for topic in sorted(path for path in folder.iterdir() if path.is_dir())
+        for page in sorted(topic.glob("*.html"))
+    ]
+    return pages[:limit] if limit else pages
+
+
+def print_render_comparison(current: Dict, baseline: Dict):
+    print(f"\nvs. {baseline.get('revision') or 'baseline'} (p50 ms, p95 ms)")
+    for stage, summary in current["stages"].items():
+        previous = baseline["stages"].get(stage)
+        if previous is None:
+            continue
+        print(
+            f"{stage:<14} p50 {previous['p50'] * 1000:8.1f} -> {summary['p50'] * 1000:8.1f} | "
+            f"p95 {previous['p95'] * 1000:8.1f} -> {summary['p95'] * 1000:8.1f}"
+        )
+    print(
+        f"{'charts/sec':<14} {baseline['charts_per_sec']:.2f} -> {current['charts_per_sec']:.2f}"
+    )
+
+
+def bench_render(args):
+    """Renders the bundled chart corpus with CDN assets served from the asset
+    cache only, so runs on different commits see the same inputs. Fill the
+    cache once with --online. With --group_size, a page's stage timings are
+    its equal share of its group's."""
+    from assetCache import AssetCache
+    from pageRender import RenderPool, print_stage_summary, summarize_stages
+
+    pages = render_corpus(Path(args.folder), args.limit)
+    asset_cache = AssetCache(args.asset_cache, offline=not args.online)
+    timings, failures = [], []
+    with tempfile.TemporaryDirectory() as screenshot_folder, RenderPool(
+        size=args.size, asset_cache=asset_cache, image_format=args.image_format
+    ) as pool:
+
+        def job(page):
+            folder_path, page_file_name = page
+            return folder_path, page_file_name, str(Path(screenshot_folder) / Path(folder_path).name)
+
+        def render(group):
+            if args.group_size > 1:
+                results, group_timings = pool.render_group_timed([job(page) for page in group])
+                share = {stage: seconds / len(group) for stage, seconds in group_timings.items()}
+                return [(result, share) for result in results]
+            return [pool.render_timed(*job(page)) for page in group]
+
+        # Warm-up pages start the server and the drivers; they are not counted
+        for page in pages[: args.warmup]:
+            render([page])
+        groups = [pages[i : i + args.group_size] for i in range(0, len(pages), args.group_size)]
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.size) as executor:
+            for group, group_results in zip(groups, executor.map(render, groups)):
+                for page, (result, page_timings) in zip(group, group_results):
+                    timings.append(page_timings)
+                    if result[0] is None:
+                        failures.append(f"{page[0]}/{page[1]}: {result[1]}")
+        elapsed = time.perf_counter() - start_time
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "pages": len(pages),
+        "size": args.size,
+        "group_size": args.group_size,
+        "image_format": args.image_format,
+        "seconds": elapsed,
+        "charts_per_sec": len(pages) / elapsed if elapsed > 0 else 0.0,
+        "failures": len(failures),
+        "stages": summarize_stages(timings),
+    }
+    print(
+        f"Rendered {len(pages)} charts with {args.size} drivers in {elapsed:.2f}s "
+        f"({report['charts_per_sec']:.2f} charts/sec), {len(failures)} failed"
+    )
+    print_stage_summary(report["stages"])
+    for failure in failures:
+        print(f"  {failure}")
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2), encoding="utf-8")
+    if args.compare:
+        print_render_comparison(report, json.loads(Path(args.compare).read_text(encoding="utf-8")))
+
+
+if __name__ == "__main__":
+    load_config()
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    border_parser = subparsers.add_parser(
+        "border", help="remove_any_color_border: scanline loop vs. whole-array mask"
+    )
+    border_parser.add_argument("--folder", type=str, default=str(HTML_CHARTS_FOLDER))
+    border_parser.add_argument("--repeat", type=int, default=5)
+    border_parser.set_defaults(func=bench_border)
+
+    url_info_parser = subparsers.add_parser(
+        "url_info", help="get_url_info against a local stub server: requests/sec"
+    )
+    url_info_parser.add_argument("--urls", type=int, default=500)
+    url_info_parser.add_argument("--max_concurrency", type=int, default=64)
+    url_info_parser.add_argument("--per_host_limit", type=int, default=64)
+    url_info_parser.add_argument(
+        "--page_kb", type=int, default=16, help="Size of each stub page"
+    )
+    url_info_parser.add_argument(
+        "--repeat", type=int, default=5, help="Runs per variant, the median is reported"
+    )
+    url_info_parser.add_argument(
+        "--trace_memory",
+        action="store_true",
+        help="Report peak Python memory (tracemalloc slows both runs)",
+    )
+    url_info_parser.set_defaults(func=bench_url_info)
+
+    trim_parser = subparsers.add_parser(
+        "trim", help="trim: encode count and time on a large crawl-like text"
+    )
+    trim_parser.add_argument("--tokens", type=int, default=500000)
+    trim_parser.add_argument("--context_size", type=int, default=128000)
+    trim_parser.set_defaults(func=bench_trim)
+
+    search_parser = subparsers.add_parser(
+        "search", help="Firecrawl search against a rate-limited mock server"
+    )
+    search_parser.add_argument("--queries", type=int, default=60)
+    search_parser.add_argument(
+        "--unique", type=int, default=40, help="Distinct queries among --queries"
+    )
+    search_parser.add_argument(
+        "--rate", type=float, default=10, help="Requests/sec the mock server accepts"
+    )
+    search_parser.add_argument("--latency_ms", type=float, default=50)
+    search_parser.set_defaults(func=bench_search)
+
+    dedup_parser = subparsers.add_parser(
+        "dedup", help="deduplicate_by_url on synthetic references: references/sec"
+    )
+    dedup_parser.add_argument("--references", type=int, default=20000)
+    dedup_parser.add_argument("--repeat", type=int, default=3)
+    dedup_parser.set_defaults(func=bench_dedup)
+
+    sanitize_parser = subparsers.add_parser(
+        "sanitize", help="chart page sanitation: regex passes vs. single pass"
+    )
+    sanitize_parser.add_argument("--folder", type=str, default=str(HTML_CHARTS_FOLDER))
+    sanitize_parser.add_argument("--repeat", type=int, default=5)
+    sanitize_parser.set_defaults(func=bench_sanitize)
+
+    log_parser = subparsers.add_parser(
+        "log", help="@log overhead on a large return value with DEBUG filtered out"
+    )
+    log_parser.add_argument("--calls", type=int, default=200)
+    log_parser.add_argument("--report_kb", type=int, default=1024)
+    log_parser.add_argument("--repeat", type=int, default=3)
+    log_parser.set_defaults(func=bench_log)
+
+    logging_parser = subparsers.add_parser(
+        "logging", help="event loop latency under heavy logging: file vs. queue handler"
+    )
+    logging_parser.add_argument("--seconds", type=float, default=3)
+    logging_parser.add_argument("--writers", type=int, default=4)
+    logging_parser.add_argument("--burst", type=int, default=50)
+    logging_parser.add_argument("--message_bytes", type=int, default=2000)
+    logging_parser.add_argument("--max_mb", type=int, default=50, help="Rotation size")
+    logging_parser.set_defaults(func=bench_logging)
+
+    tags_parser = subparsers.add_parser(
+        "tags", help="TagStreamParser vs. parse_tags: random differential check and timing"
+    )
+    tags_parser.add_argument("--cases", type=int, default=40000)
+    tags_parser.add_argument("--seed", type=int, default=0)
+    tags_parser.add_argument("--repeat", type=int, default=5)
+    tags_parser.set_defaults(func=bench_tags)
+
+    startup_parser = subparsers.add_parser(
+        "startup", help="import time of src/utils modules against a budget"
+    )
+    startup_parser.add_argument("--modules", type=str, nargs="+", default=["utils", "tools"])
+    startup_parser.add_argument("--budget_ms", type=float, default=250)
+    startup_parser.add_argument("--runs", type=int, default=5)
+    startup_parser.set_defaults(func=bench_startup)
+
+    render_parser = subparsers.add_parser(
+        "render", help="render the bundled charts offline: p50/p95 per stage, charts/sec"
+    )
+    render_parser.add_argument("--folder", type=str, default=str(HTML_CHARTS_FOLDER))
+    render_parser.add_argument("--limit", type=int, default=None, help="Render the first N pages")
+    render_parser.add_argument("--size", type=int, default=2, help="Chrome drivers")
+    render_parser.add_argument("--warmup", type=int, default=2)
+    render_parser.add_argument(
+        "--group_size", type=int, default=1, help="Pages per browser page (iframes)"
+    )
+    render_parser.add_argument("--image_format", type=str, default="PNG")
+    render_parser.add_argument(
+        "--asset_cache", type=str, default=None, help="Defaults to ASSET_CACHE_DIR"
+    )
+    render_parser.add_argument(
+        "--online", action="store_true", help="Download CDN assets missing from the cache"
+    )
+    render_parser.add_argument("--output", type=str, default=None, help="Write the report as JSON")
+    render_parser.add_argument(
+        "--compare", type=str, default=None, help="A previous --output to compare against"
+    )
+    render_parser.set_defaults(func=bench_render)
+
+    args = parser.parse_args()
+    args.func(args)
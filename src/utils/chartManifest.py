@@ -0,0 +1,262 @@
+# Target of this module: one index of every chart page with its size, content
+# hashes and render outcome, so stale charts are found without rendering them
+
+import os
+import re
+import json
+import hashlib
+import threading
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Dict, Tuple
+
+from config import load_config
+
+MANIFEST_VERSION = 1
+REPO_ROOT = Path(__file__).resolve().parents[2]
+HTML_CHARTS_FOLDER = REPO_ROOT / "public" / "html_charts"
+# Kept out of public/ so the index is not served with the site
+MANIFEST_PATH = REPO_ROOT / "build" / "chart_manifest.json"
+SCREENSHOT_EXTENSIONS = (".png", ".webp", ".jpg")
+
+
+def file_hash(path: str | Path) -> str:
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()[:32]
+
+
+def natural_key(name: str) -> list:
+    # html_2.html sorts before html_10.html
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)]
+
+
+def parse_html_size(value: str) -> Tuple[float, float]:
+    """Legacy html_size.json value "914.5500000000001+620.55" -> (914.55, 620.55)."""
+    width, height = value.split("+")
+    return round(float(width), 2), round(float(height), 2)
+
+
+def scan_charts(root: str | Path) -> Dict[str, Path]:
+    """{"<topic>/<page>": html path} for every html page in the topic folders."""
+    root = Path(root)
+    charts = {}
+    for topic_folder in sorted(path for path in root.iterdir() if path.is_dir()):
+        pages = sorted(
+            (path for path in topic_folder.iterdir() if path.suffix == ".html"),
+            key=lambda path: natural_key(path.name),
+        )
+        for page in pages:
+            charts[f"{topic_folder.name}/{page.name}"] = page
+    return charts
+
+
+def find_screenshot(html_path: Path, screenshot_folder: str | Path | None = None) -> Path | None:
+    folder = (
+        Path(screenshot_folder) / html_path.parent.name if screenshot_folder else html_path.parent
+    )
+    for extension in SCREENSHOT_EXTENSIONS:
+        candidate = folder / f"{html_path.stem}_screenshot{extension}"
+        if candidate.is_file():
+            return candidate
+    return None
+
+
+def read_manifest(manifest_path: str | Path) -> Dict[str, Dict]:
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest["charts"]
+
+
+def write_manifest(manifest_path: str | Path, charts: Dict[str, Dict]):
+    """Compact JSON with one chart per line, so updates make small diffs."""
+    lines = [
+        f"{json.dumps(key, ensure_ascii=False)}:"
+        f"{json.dumps(entry, ensure_ascii=False, separators=(',', ':'))}"
+        for key, entry in charts.items()
+    ]
+    body = (
+        f'{{"version":{MANIFEST_VERSION},"charts":{{\n' + ",\n".join(lines) + "\n}}\n"
+    )
+    manifest_path = Path(manifest_path)
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = manifest_path.with_name(f"{manifest_path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(body, encoding="utf-8")
+    os.replace(tmp_path, manifest_path)
+
+
+_loaded_manifests: Dict = {}
+_loaded_manifests_lock = threading.Lock()
+
+
+def load_manifest(
+    manifest_path: str | Path = MANIFEST_PATH,
+) -> Dict[str, Dict]:
+    """Chart entries keyed by "<topic>/<page>". Parsed once per file version,
+    so repeated lookups from the Python build steps cost a stat call. The
+    Next.js site does not read the manifest; HTMLRenderer sizes charts in the
+    browser."""
+    stat = os.stat(manifest_path)
+    key = os.path.abspath(manifest_path)
+    with _loaded_manifests_lock:
+        cached = _loaded_manifests.get(key)
+        if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+            return cached[1]
+    charts = read_manifest(manifest_path)
+    with _loaded_manifests_lock:
+        _loaded_manifests[key] = ((stat.st_mtime_ns, stat.st_size), charts)
+    return charts
+
+
+def _screenshot_fields(screenshot: Path | None, root: Path, old_entry: Dict | None) -> Dict:
+    if screenshot is None:
+        return {"screenshot": None, "screenshot_hash": None, "screenshot_mtime_ns": None}
+    mtime_ns = screenshot.stat().st_mtime_ns
+    if old_entry and old_entry.get("screenshot_mtime_ns") == mtime_ns:
+        screenshot_hash = old_entry["screenshot_hash"]
+    else:
+        screenshot_hash = file_hash(screenshot)
+    return {
+        "screenshot": os.path.relpath(screenshot, root).replace(os.sep, "/"),
+        "screenshot_hash": screenshot_hash,
+        "screenshot_mtime_ns": mtime_ns,
+    }
+
+
+def build_manifest(
+    root: str | Path = HTML_CHARTS_FOLDER,
+    manifest_path: str | Path = MANIFEST_PATH,
+    render: bool = False,
+    retry_failed: bool = False,
+    force: bool = False,
+    workers: int | None = None,
+    screenshot_folder: str | None = None,
+    **render_kwargs,
+) -> Dict:
+    """
+    Update the manifest of all charts under `root`, touching only changed ones.
+
+    A chart is stale when it is new, its HTML hash changed (hashes are reused
+    while the file's mtime and size are unchanged), its screenshot is missing
+    and `render` is set, or, with `retry_failed`, its last render failed;
+    `force` makes all stale. With `render`, stale charts are rendered with
+    `render_directories` (`render_kwargs` are passed on); otherwise their size
+    is taken from the legacy html_size.json and their screenshot from disk, so
+    a missing screenshot only marks a chart stale once a run can render it.
+
+    Returns a summary: charts, stale, rendered, failures and removed.
+    """
+    root = Path(root).resolve()
+    manifest_path = Path(manifest_path)
+    old_charts = read_manifest(manifest_path)
+    pages = scan_charts(root)
+
+    charts, stale = {}, []
+    for key, html_path in pages.items():
+        stat = html_path.stat()
+        old_entry = old_charts.get(key)
+        if (
+            old_entry
+            and old_entry["html_mtime_ns"] == stat.st_mtime_ns
+            and old_entry["html_bytes"] == stat.st_size
+        ):
+            html_hash = old_entry["html_hash"]
+        else:
+            html_hash = file_hash(html_path)
+        screenshot = find_screenshot(html_path, screenshot_folder)
+        entry = {
+            "w": None,
+            "h": None,
+            "html_hash": html_hash,
+            "html_mtime_ns": stat.st_mtime_ns,
+            "html_bytes": stat.st_size,
+            **_screenshot_fields(screenshot, root, old_entry),
+            "error": None,
+            "render_ms": None,
+        }
+        up_to_date = (
+            not force
+            and old_entry is not None
+            and old_entry["html_hash"] == html_hash
+            and (screenshot is not None or old_entry["error"] is not None or not render)
+            and not (retry_failed and old_entry["error"] is not None)
+        )
+        if up_to_date:
+            for field in ("w", "h", "error", "render_ms"):
+                entry[field] = old_entry[field]
+        else:
+            stale.append(key)
+        charts[key] = entry
+
+    rendered, failures = 0, 0
+    if stale and render:
+        from pageRender import render_directories
+
+        summary = render_directories(
+            [str(pages[key]) for key in stale], workers, screenshot_folder, **render_kwargs
+        )
+        for result in summary["results"]:
+            key = f"{Path(result['folder']).name}/{result['page']}"
+            entry = charts[key]
+            entry["render_ms"] = round(result["seconds"] * 1000)
+            entry["error"] = result["error"] or None
+            if result["screenshot_path"] is None:
+                failures += 1
+                continue
+            rendered += 1
+            entry["w"] = round(float(result["width"]), 2)
+            entry["h"] = round(float(result["height"]), 2)
+            entry.update(_screenshot_fields(Path(result["screenshot_path"]), root, None))
+    elif stale:
+        legacy_sizes = {}
+        for key in stale:
+            topic, page = key.split("/", 1)
+            if topic not in legacy_sizes:
+                size_file = root / topic / "html_size.json"
+                legacy_sizes[topic] = (
+                    json.loads(size_file.read_text(encoding="utf-8")) if size_file.is_file() else {}
+                )
+            if page in legacy_sizes[topic]:
+                charts[key]["w"], charts[key]["h"] = parse_html_size(legacy_sizes[topic][page])
+
+    removed = len(set(old_charts) - set(charts))
+    if charts != old_charts:
+        write_manifest(manifest_path, charts)
+    return {
+        "charts": len(charts),
+        "stale": len(stale),
+        "rendered": rendered,
+        "failures": failures,
+        "removed": removed,
+        "manifest": str(manifest_path),
+    }
+
+
+if __name__ == "__main__":
+    load_config()
+    parser = ArgumentParser()
+    parser.add_argument("--root", type=str, default=str(HTML_CHARTS_FOLDER))
+    parser.add_argument("--manifest", type=str, default=str(MANIFEST_PATH))
+    parser.add_argument("--render", action="store_true", help="Render stale charts with Chrome")
+    parser.add_argument("--retry_failed", action="store_true", help="Treat failed charts as stale")
+    parser.add_argument("--force", action="store_true", help="Treat every chart as stale")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--screenshot_folder", type=str, default=None)
+    args = parser.parse_args()
+
+    summary = build_manifest(
+        args.root,
+        args.manifest,
+        render=args.render,
+        retry_failed=args.retry_failed,
+        force=args.force,
+        workers=args.workers,
+        screenshot_folder=args.screenshot_folder,
+    )
+    print(
+        f"{summary['charts']} charts, {summary['stale']} stale, {summary['rendered']} rendered, "
+        f"{summary['failures']} failed, {summary['removed']} removed -> {summary['manifest']}"
+    )
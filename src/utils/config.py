@@ -0,0 +1,37 @@
+# Target of this module: loading the .env settings once, as an explicit step,
+# instead of as a side effect of importing utils or tools
+
+import os
+import threading
+from pathlib import Path
+
+_loaded = False
+_lock = threading.Lock()
+
+
+def load_config(env_file: str | Path | None = None, override: bool = True) -> bool:
+    """
+    Load `env_file` (by default the nearest .env above this folder) into
+    os.environ. Only the first call loads anything; returns whether it did.
+
+    Entry points should call this before anything else. Code that reads a
+    setting through `get_env` triggers it on first use otherwise.
+    """
+    global _loaded
+    with _lock:
+        if _loaded:
+            return False
+        from dotenv import find_dotenv, load_dotenv
+
+        if env_file is None:
+            # find_dotenv searches upwards from the file of its caller
+            env_file = find_dotenv()
+        load_dotenv(env_file, override=override)
+        _loaded = True
+        return True
+
+
+def get_env(name: str, default: str | None = None) -> str | None:
+    if not _loaded:
+        load_config()
+    return os.environ.get(name, default)
@@ -0,0 +1,120 @@
+# Target of this module: normalizing generated chart pages (Font Awesome kit,
+# body attributes, container padding and background) in one pass per page
+
+import os
+import re
+import string
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Dict, List
+
+from config import load_config
+
+FONT_AWESOME_KIT = (
+    r'<script\s+src="https://kit\.fontawesome\.com/a076d05399\.js"'
+    r'(?:\s+crossorigin(?:=["\'](?:.*?)["\'])?)?(?:\s+[^>]*)?></script>'
+)
+FONT_AWESOME_CSS = (
+    '<link rel="stylesheet" '
+    'href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css">'
+)
+
+# One scan over the page finds everything that may need rewriting: <style>
+# blocks, <body> open tags and the Font Awesome kit script. Every branch starts
+# at "<", and the style body is an unrolled loop rather than a lazy `.*?`, so
+# `re` mostly skips ahead at C speed.
+TOKEN_PATTERN = re.compile(
+    r"<(?:(?P<style>style\b[^>]*>)(?P<css>[^<]*(?:<(?!/style)[^<]*)*)(?P<style_end></style\s*>)"
+    r"|(?P<body>body\b[^>]*>)"
+    rf"|(?P<font_awesome>{FONT_AWESOME_KIT[1:]}))"
+)
+# Rules whose padding and background are reset. A lookbehind excluding
+# selectors like tbody would slow the scan down, so it is checked in Python.
+RESET_RULE_PATTERN = re.compile(r"(?:body|\.container|\.visualization-container)\s*\{[^}]*\}")
+SELECTOR_CHARS = frozenset(string.ascii_letters + string.digits + "_-.#")
+BODY_ATTRIBUTE_PATTERN = re.compile(r"""\s+(?:class|style)\s*=\s*(?:"[^"]*"|'[^']*')""")
+DECLARATION_PATTERN = re.compile(r"(?<![\w-])(padding|background-color)\s*:\s*[^;]+;")
+DECLARATION_REPLACEMENTS = {
+    "padding": "padding: 0;",
+    "background-color": "background-color: white;",
+}
+
+
+def _replace_declaration(match: re.Match) -> str:
+    return DECLARATION_REPLACEMENTS[match.group(1)]
+
+
+def _reset_rule(match: re.Match) -> str:
+    rule = match.group()
+    start = match.start()
+    if rule[0] == "b" and start and match.string[start - 1] in SELECTOR_CHARS:
+        # Part of a longer selector such as tbody or .card-body
+        return rule
+    return DECLARATION_PATTERN.sub(_replace_declaration, rule)
+
+
+def sanitize_html(html_str: str, font_awesome: bool = True, body_styles: bool = True) -> str:
+    """
+    Apply all chart page rewrites in one pass over `html_str`.
+
+    - font_awesome: replace the Font Awesome kit script with the cdnjs stylesheet.
+    - body_styles: drop class and style attributes from <body>, and set padding
+      to 0 and background-color to white in the body, .container and
+      .visualization-container rules of <style> blocks.
+    """
+
+    def rewrite(match: re.Match) -> str:
+        kind = match.lastgroup
+        if kind == "font_awesome":
+            return FONT_AWESOME_CSS if font_awesome else match.group()
+        if not body_styles:
+            return match.group()
+        if kind == "body":
+            return "<" + BODY_ATTRIBUTE_PATTERN.sub("", match.group("body"))
+        css = RESET_RULE_PATTERN.sub(_reset_rule, match.group("css"))
+        return f"<{match.group('style')}{css}{match.group('style_end')}"
+
+    return TOKEN_PATTERN.sub(rewrite, html_str)
+
+
+def sanitize_file(html_path: str | Path, **kwargs) -> bool:
+    """Sanitize a page in place. Returns whether it changed; unchanged pages
+    are not rewritten, so their mtime (and any render cache entry) survives."""
+    html_path = Path(html_path)
+    html_str = html_path.read_text(encoding="utf-8", errors="surrogateescape")
+    cleaned = sanitize_html(html_str, **kwargs)
+    if cleaned == html_str:
+        return False
+    tmp_path = html_path.with_name(f"{html_path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(cleaned, encoding="utf-8", errors="surrogateescape")
+    os.replace(tmp_path, html_path)
+    return True
+
+
+def sanitize_chart_folders(folders: List[str], **kwargs) -> Dict:
+    """Sanitize every *.html page below `folders` in place."""
+    html_paths = sorted(path for folder in folders for path in Path(folder).rglob("*.html"))
+    changed = [str(path) for path in html_paths if sanitize_file(path, **kwargs)]
+    return {"pages": len(html_paths), "changed": changed}
+
+
+if __name__ == "__main__":
+    load_config()
+    parser = ArgumentParser()
+    parser.add_argument("folders", type=str, nargs="+", help="Chart folders to sanitize")
+    parser.add_argument(
+        "--keep_font_awesome_kit", action="store_true", help="Do not replace the kit script"
+    )
+    parser.add_argument(
+        "--keep_body_styles", action="store_true", help="Do not touch body and container styles"
+    )
+    args = parser.parse_args()
+
+    result = sanitize_chart_folders(
+        args.folders,
+        font_awesome=not args.keep_font_awesome_kit,
+        body_styles=not args.keep_body_styles,
+    )
+    for path in result["changed"]:
+        print(f"Sanitized {path}")
+    print(f"{len(result['changed'])} of {result['pages']} pages changed")
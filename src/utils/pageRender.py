@@ -4,88 +4,75 @@
 # Target of this module: rendering the page with chrome and taking a screenshot
 
 import os
+import io
+import base64
+import asyncio
+import functools
+import contextvars
+import glob
+import json
+import logging
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException
 import time
-import http.server
-import socketserver
 import threading
+import queue
 from argparse import ArgumentParser
-import functools
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Dict, List, Tuple
+from assetCache import AssetCache
+from chartManifest import natural_key
+from config import load_config
+from renderServer import ChartServer, get_shared_server
+from renderCache import RenderCache
+from tracing import percentile, trace
+
+logger = logging.getLogger(__name__)
+
 
+def remove_any_color_border(image, tolerance: int = 0):
+    """Crop the uniform border whose color is taken from the top-left pixel.
 
-def remove_any_color_border(image):
+    The bounding box is found from one whole-array mask instead of walking in
+    from each edge. A pixel belongs to the border when every channel differs
+    from the border color by at most `tolerance`, which absorbs anti-aliased
+    edges when > 0.
+    """
     # Convert image to numpy array
-    img_array = np.array(image)
+    img_array = np.asarray(image)
 
     # Get dimensions
     height, width = img_array.shape[:2]
 
     # Get the color of the top-left corner (assumed to be the border color)
-    if len(img_array.shape) == 3:  # Color image
-        border_color = img_array[0, 0, :]
-    else:  # Grayscale image
-        border_color = img_array[0, 0]
-
-    # Find the bounding box
-    # Find first non-border-color pixel from each edge
-    # Top
-    top = 0
-    while (
-        top < height
-        and np.all(
-            img_array[top, :] == border_color,
-            axis=1 if len(img_array.shape) == 3 else 0,
-        ).all()
-    ):
-        top += 1
-
-    # Bottom
-    bottom = height - 1
-    while (
-        bottom >= 0
-        and np.all(
-            img_array[bottom, :] == border_color,
-            axis=1 if len(img_array.shape) == 3 else 0,
-        ).all()
-    ):
-        bottom -= 1
-
-    # Left
-    left = 0
-    while (
-        left < width
-        and np.all(
-            img_array[:, left] == border_color,
-            axis=1 if len(img_array.shape) == 3 else 0,
-        ).all()
-    ):
-        left += 1
-
-    # Right
-    right = width - 1
-    while (
-        right >= 0
-        and np.all(
-            img_array[:, right] == border_color,
-            axis=1 if len(img_array.shape) == 3 else 0,
-        ).all()
-    ):
-        right -= 1
-
-    # Check if we found a valid bounding box
-    if top <= bottom and left <= right:
-        cropped_image = image.crop((left, top, right + 1, bottom + 1))
-        cropped_width = right - left + 1
-        cropped_height = bottom - top + 1
-        return cropped_image, cropped_width, cropped_height
+    border_color = img_array[0, 0]
+
+    if tolerance > 0:
+        diff = np.abs(img_array.astype(np.int16) - border_color.astype(np.int16))
+        content_mask = diff > tolerance
     else:
-        # No border to remove, or the entire image is the border color
+        content_mask = img_array != border_color
+    if content_mask.ndim == 3:  # Color image
+        content_mask = content_mask.any(axis=2)
+
+    rows = np.flatnonzero(content_mask.any(axis=1))
+    if rows.size == 0:
+        # The entire image is the border color
         return image, width, height
+    cols = np.flatnonzero(content_mask.any(axis=0))
+    top, bottom = int(rows[0]), int(rows[-1])
+    left, right = int(cols[0]), int(cols[-1])
+
+    cropped_image = image.crop((left, top, right + 1, bottom + 1))
+    cropped_width = right - left + 1
+    cropped_height = bottom - top + 1
+    return cropped_image, cropped_width, cropped_height
 
 
 def add_white_border(image, border_percentage=5):
@@ -98,133 +85,316 @@ def add_white_border(image, border_percentage=5):
     return result
 
 
-def crop_white_margins(
-    input_image_path: str, output_image_path: str, border_percentage=5
+# PIL format name -> file extension of the saved screenshot
+IMAGE_EXTENSIONS = {"PNG": ".png", "WEBP": ".webp", "JPEG": ".jpg"}
+
+# Stages of one render in pipeline order. "wait" is the time spent waiting for
+# a free driver; a page's record only has the stages it went through.
+RENDER_STAGES = (
+    "cache",
+    "wait",
+    "driver_launch",
+    "server_start",
+    "layout_reset",
+    "load",
+    "ready",
+    "relayout",
+    "capture",
+    "crop",
+    "encode",
+)
+
+
+class StageTimer:
+    """Wall time per render stage of one page, in seconds.
+
+    Every stage is also a `render.<stage>` span on the process-wide tracer, so
+    with `configure_tracing(path)` the same timings end up in a JSONL trace.
+
+    Usage:
+        timer = StageTimer()
+        with timer.stage("load"):
+            driver.get(url)
+        timer.record()  # {"load": 0.41, "total": 0.41}
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+        self._start = time.perf_counter()
+        # Screenshots of a page group are encoded on several threads
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        start_time = time.perf_counter()
+        try:
+            with trace(f"render.{name}"):
+                yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    def record(self) -> Dict[str, float]:
+        return {**self.stages, "total": time.perf_counter() - self._start}
+
+
+def get_screenshot_name(page_file_name: str, image_format: str = "PNG") -> str:
+    extension = IMAGE_EXTENSIONS[image_format.upper()]
+    return page_file_name.replace(".html", f"_screenshot{extension}")
+
+
+def process_screenshot(
+    image_bytes: bytes,
+    output_image_path: str,
+    border_percentage=5,
+    border_tolerance: int = 0,
+    image_format: str = "PNG",
+    compress_level: int = 6,
+    quality: int = 90,
+    timer: StageTimer | None = None,
+    crop: bool = True,
 ):
-    image = Image.open(input_image_path)
-    r_image, width, height = remove_any_color_border(image)
-    a_image = add_white_border(r_image, border_percentage)
-    a_image.save(output_image_path)
+    """Crop and pad an encoded screenshot in memory and encode it exactly once.
+
+    `compress_level` (0-9) applies to PNG, `quality` (0-100) to WEBP and JPEG.
+    Screenshots already clipped to their content box pass `crop=False` and are
+    only padded. Returns the padded content width and height.
+    """
+    image_format = image_format.upper()
+    if image_format not in IMAGE_EXTENSIONS:
+        raise ValueError(f"Unsupported image format: {image_format}")
+    timer = timer or StageTimer()
+    with timer.stage("crop"):
+        image = Image.open(io.BytesIO(image_bytes))
+        if crop:
+            r_image, width, height = remove_any_color_border(image, border_tolerance)
+        else:
+            r_image, (width, height) = image, image.size
+        a_image = add_white_border(r_image, border_percentage)
+    with timer.stage("encode"):
+        if image_format == "PNG":
+            save_kwargs = {"compress_level": compress_level}
+        else:
+            save_kwargs = {"quality": quality}
+            if image_format == "JPEG" and a_image.mode != "RGB":
+                a_image = a_image.convert("RGB")
+        a_image.save(output_image_path, format=image_format, **save_kwargs)
     width = width * (1 + border_percentage / 100.0)
     height = height * (1 + border_percentage / 100.0)
     return width, height
 
 
-# Custom handler that serves from a specific directory without changing cwd
-class DirectoryHandler(http.server.SimpleHTTPRequestHandler):
-    def __init__(self, directory, *args, **kwargs):
-        self.directory = directory
-        super().__init__(*args, directory=directory, **kwargs)
-
-    def do_GET(self):
-        if self.path == "/favicon.ico":
-            # Return 204 No Content for favicon.ico requests
-            self.send_response(204)
-            self.end_headers()
-            return
-        return super().do_GET()
+def crop_white_margins(
+    input_image_path: str,
+    output_image_path: str,
+    border_percentage=5,
+    border_tolerance: int = 0,
+    **image_kwargs,
+):
+    with open(input_image_path, "rb") as f:
+        image_bytes = f.read()
+    return process_screenshot(
+        image_bytes,
+        output_image_path,
+        border_percentage,
+        border_tolerance,
+        **image_kwargs,
+    )
 
-    def log_message(self, format, *args):
-        pass
 
+# Bump whenever a change to this module changes the rendered output, so that
+# RenderCache entries written by older versions are not reused
+RENDERER_VERSION = "2"
 
-# get a free port
-def get_free_port():
-    with socketserver.TCPServer(("", 0), None) as s:
-        free_port = s.server_address[1]
-    return free_port
+# Size the window is laid out at before the content is measured
+LAYOUT_WINDOW_SIZE = (2000, 2000)
+# Added to the body's size when the window is shrunk to the content
+CONTENT_MARGIN = (100, 400)
 
+# Injected before any page script runs. window.__chartReady(quietMs) resolves
+# once the document has loaded, no fetch/XHR is in flight, no Web Animation is
+# running and the DOM has not mutated for quietMs (D3 transitions mutate
+# attributes on every frame). It resolves early on an uncaught error, or as
+# soon as the page itself calls window.__chartReadySignal().
+READINESS_HOOK = """
+(() => {
+  if (window.__chartReady) return;
+  const state = { lastChange: performance.now(), pending: 0, errors: 0, signaled: false };
+  const touch = () => { state.lastChange = performance.now(); };
+  window.addEventListener("error", () => { state.errors += 1; }, true);
+  window.addEventListener("unhandledrejection", () => { state.errors += 1; });
+  new MutationObserver(touch).observe(document, {
+    subtree: true, childList: true, attributes: true, characterData: true,
+  });
+  if (window.fetch) {
+    const fetch = window.fetch;
+    window.fetch = function (...args) {
+      state.pending += 1;
+      return fetch.apply(this, args).finally(() => { state.pending -= 1; touch(); });
+    };
+  }
+  const send = XMLHttpRequest.prototype.send;
+  XMLHttpRequest.prototype.send = function (...args) {
+    state.pending += 1;
+    this.addEventListener("loadend", () => { state.pending -= 1; touch(); });
+    return send.apply(this, args);
+  };
+  window.__chartReadySignal = () => { state.signaled = true; };
+  window.__chartReady = (quietMs = 200) => new Promise((resolve) => {
+    const check = () => {
+      if (state.signaled) return resolve("signal");
+      if (state.errors > 0) return resolve("error");
+      const animating = document.getAnimations
+        ? document.getAnimations().some((a) => a.playState === "running")
+        : false;
+      if (
+        document.readyState === "complete" && state.pending === 0 && !animating &&
+        performance.now() - state.lastChange >= quietMs
+      ) return resolve("idle");
+      setTimeout(check, Math.min(50, quietMs));
+    };
+    check();
+  });
+})();
+"""
 
-# start a local server
-def start_server(folder_path, port):
-    # Create handler with specific directory using functools.partial
-    handler = functools.partial(DirectoryHandler, folder_path)
 
-    # Create server with custom handler
-    httpd = socketserver.TCPServer(("", port), handler)
+def install_readiness_hook(driver):
+    """Register READINESS_HOOK for every document the driver loads from now on."""
+    driver.execute_cdp_cmd(
+        "Page.addScriptToEvaluateOnNewDocument", {"source": READINESS_HOOK}
+    )
 
-    # Start server in a thread
-    server_thread = threading.Thread(target=httpd.serve_forever)
-    server_thread.daemon = True
-    server_thread.start()
-    return httpd
 
+def wait_until_ready(
+    driver,
+    ready_timeout: float = 30,
+    ready_quiet_ms: int = 200,
+    ready_signal: str | None = None,
+) -> str | None:
+    """Wait for the page's readiness promise instead of polling.
 
-# take a screenshot of the page
-def take_screenshot(
-    driver, screenshot_path: str, implicitly_wait_time: int = 1
-) -> tuple:
-    driver.implicitly_wait(implicitly_wait_time)  # Wait for DOM elements
-    time_limit = 30
+    `ready_signal` is a JavaScript expression evaluating to a value or promise
+    that marks the page as ready; `arguments[0]` is `ready_quiet_ms`. Returns
+    how the wait ended ("idle", "signal", "error", "timeout", ...), or None
+    when the page has no readiness hook and the caller should poll instead.
+    """
+    if ready_signal is None:
+        if not driver.execute_script("return typeof window.__chartReady === 'function'"):
+            return None
+        ready_signal = "window.__chartReady(arguments[0])"
+    driver.set_script_timeout(ready_timeout)
+    script = (
+        "const done = arguments[arguments.length - 1];"
+        f"Promise.resolve({ready_signal})"
+        ".then((r) => done(String(r)), (e) => done('error: ' + e));"
+    )
     try:
-        # 等待页面加载完成
-        start_time = time.time()
+        return driver.execute_async_script(script, ready_quiet_ms)
+    except TimeoutException:
+        return "timeout"
+
+
+def get_error_logs(driver) -> List[Dict]:
+    browser_logs = driver.get_log("browser")
+    return [log for log in browser_logs if log["level"] in ["SEVERE", "ERROR"]]
+
+
+def poll_until_rendered(driver, time_limit: float = 30) -> List[Dict]:
+    # 等待页面加载完成
+    start_time = time.time()
+    error_logs = []
+    while time.time() - start_time < time_limit:
+        # 1. Check if anything is rendered
         anything_rendered = False
-        any_browser_error_found = False
-        while time.time() - start_time < time_limit:
-            # 1. Check if anything is rendered
-            try:
-                WebDriverWait(driver, 0.1).until(
-                    EC.visibility_of_element_located(
-                        (By.CSS_SELECTOR, "body > *:not(script)")
-                    )
+        try:
+            WebDriverWait(driver, 0.1).until(
+                EC.visibility_of_element_located(
+                    (By.CSS_SELECTOR, "body > *:not(script)")
                 )
-                anything_rendered = True
-            except Exception:
-                pass
-            browser_logs = driver.get_log("browser")
-            error_logs = [
-                log for log in browser_logs if log["level"] in ["SEVERE", "ERROR"]
-            ]
+            )
+            anything_rendered = True
+        except Exception:
+            pass
+        error_logs = get_error_logs(driver)
+        if error_logs or anything_rendered:
+            break
+    return error_logs
 
-            if len(error_logs) > 0:
-                any_browser_error_found = True
 
-            if any_browser_error_found:
-                break
-            if anything_rendered:
-                break
+# wait for the page to render and capture it as PNG bytes
+def capture_screenshot(
+    driver,
+    implicitly_wait_time: int = 1,
+    readiness: str = "event",
+    ready_timeout: float = 30,
+    ready_quiet_ms: int = 200,
+    ready_signal: str | None = None,
+    timer: StageTimer | None = None,
+) -> tuple:
+    """`readiness` is "event" to await the injected readiness hook (falling
+    back to polling when the page has none) or "poll" for the polling loop,
+    in which case `ready_timeout` bounds the loop. `timer` records the ready,
+    relayout and capture stages."""
+    if readiness not in ("event", "poll"):
+        raise ValueError(f"Unknown readiness mode: {readiness}")
+    timer = timer or StageTimer()
+    driver.implicitly_wait(implicitly_wait_time)  # Wait for DOM elements
+    try:
+        with timer.stage("ready"):
+            ready_state = None
+            if readiness == "event":
+                ready_state = wait_until_ready(
+                    driver, ready_timeout, ready_quiet_ms, ready_signal
+                )
+            if ready_state is None:
+                error_logs = poll_until_rendered(driver, ready_timeout)
+            else:
+                error_logs = get_error_logs(driver)
 
         # 这个脚本会遍历所有可见元素，找出实际内容的边界
-        driver.set_window_size(2000, 2000)
-        element = driver.find_element(By.TAG_NAME, "body")
-        driver.set_window_size(
-            element.size["width"] + 100, element.size["height"] + 400
-        )
+        # The driver is normally still at the layout size, so this costs no
+        # relayout; only the resize to the content box does
+        with timer.stage("relayout"):
+            layout_width, layout_height = LAYOUT_WINDOW_SIZE
+            window_size = driver.get_window_size()
+            if (window_size["width"], window_size["height"]) != LAYOUT_WINDOW_SIZE:
+                driver.set_window_size(layout_width, layout_height)
+            element = driver.find_element(By.TAG_NAME, "body")
+            driver.set_window_size(
+                element.size["width"] + CONTENT_MARGIN[0],
+                element.size["height"] + CONTENT_MARGIN[1],
+            )
 
         # 截取完整页面
-        driver.save_screenshot(screenshot_path)
-        content_width, content_height = crop_white_margins(
-            screenshot_path, screenshot_path
-        )
-        # 返回实际内容区域的尺寸（不包括添加的边距）
-        return content_width, content_height, error_logs
+        with timer.stage("capture"):
+            return driver.get_screenshot_as_png(), error_logs
 
     except Exception as e:
         print(f"Error taking screenshot: {str(e)}")
         raise
 
 
-def render_page(
-    folder_path: str,
-    page_file_name: str,
-    screenshot_folder: str,
-):
-    error_message = ""
-    screenshot_path = None
-    content_width, content_height = None, None
-
-    if not os.path.isdir(folder_path):
-        raise ValueError(f"{folder_path} is not a directory")
-    file_list = os.listdir(folder_path)
-    # make sure the page_file_name is in the folder
-    if page_file_name not in file_list:
-        raise ValueError(f"{page_file_name} not found in {folder_path}")
+# take a screenshot of the page
+def take_screenshot(
+    driver,
+    screenshot_path: str,
+    implicitly_wait_time: int = 1,
+    ready_kwargs: Dict | None = None,
+    **image_kwargs,
+) -> tuple:
+    png_bytes, error_logs = capture_screenshot(
+        driver, implicitly_wait_time, **(ready_kwargs or {})
+    )
+    content_width, content_height = process_screenshot(
+        png_bytes, screenshot_path, **image_kwargs
+    )
+    # 返回实际内容区域的尺寸（不包括添加的边距）
+    return content_width, content_height, error_logs
 
-    # Start local server
-    port = get_free_port()
-    httpd = start_server(folder_path, port)
 
+def build_chrome_options() -> Options:
     # Set up headless Chrome options
     chrome_options = Options()
     chrome_options.add_argument("--headless")
@@ -232,18 +402,10 @@ def render_page(
     chrome_options.add_argument("--disable-dev-shm-usage")
     # 添加隐藏滚动条的设置
     chrome_options.add_argument("--hide-scrollbars")
-    original_env = {}
-    proxy_vars = ["http_proxy", "https_proxy", "HTTP_PROXY", "HTTPS_PROXY"]
-    for var in proxy_vars:
-        if var in os.environ:
-            original_env[var] = os.environ[var]
-            del os.environ[var]
+    chrome_options.add_argument("--window-size={},{}".format(*LAYOUT_WINDOW_SIZE))
 
     # 添加下载路径设置
     prefs = {
-        "download.prompt_for_download": False,  # disable the download prompt
-        "download.directory_upgrade": True,
-        "safebrowsing.enabled": True,
         "profile.default_content_settings.popups": 0,
         # 允许所有文件下载，不需要询问
         "safebrowsing.enabled": False,
@@ -255,13 +417,29 @@ def render_page(
         "download.show_download_bar": False,
     }
     chrome_options.add_experimental_option("prefs", prefs)
+    return chrome_options
 
-    try:
-        # Initialize driver with specific ChromeDriver version
-        # service = Service(ChromeDriverManager().install())
-        service = Service()
+
+# os.environ is process-wide, so concurrent driver launches must not interleave
+# the removal and restoration of the proxy variables
+_proxy_env_lock = threading.Lock()
+
+
+def create_driver():
+    """Launch a headless Chrome driver that bypasses any configured proxy,
+    since it only ever talks to the local server."""
+    proxy_vars = ["http_proxy", "https_proxy", "HTTP_PROXY", "HTTPS_PROXY"]
+    with _proxy_env_lock:
+        original_env = {}
+        for var in proxy_vars:
+            if var in os.environ:
+                original_env[var] = os.environ[var]
+                del os.environ[var]
         try:
-            driver = webdriver.Chrome(service=service, options=chrome_options)
+            # Initialize driver with specific ChromeDriver version
+            # service = Service(ChromeDriverManager().install())
+            service = Service()
+            driver = webdriver.Chrome(service=service, options=build_chrome_options())
         except Exception as chrome_error:
             print(f"Chrome initialization error: {str(chrome_error)}")
             # 尝试打印更详细的错误信息
@@ -269,51 +447,1020 @@ def render_page(
 
             print(f"Detailed error:\n{traceback.format_exc()}")
             raise  # 重新抛出异常
+        finally:
+            for var, value in original_env.items():
+                os.environ[var] = value
+
+    # Add page load timeout
+    driver.set_page_load_timeout(60)
+    install_readiness_hook(driver)
+    return driver
+
+
+def quit_driver(driver):
+    try:
+        driver.quit()
+    except Exception as quit_error:
+        print(f"Warning: Error while quitting driver: {str(quit_error)}")
 
-        # Add page load timeout
-        driver.set_page_load_timeout(60)
 
-        # Use localhost URL instead of file://
-        url = f"http://localhost:{port}/{page_file_name}"
-        # print(f"Accessing URL: {url}")
+def check_page(folder_path: str, page_file_name: str):
+    if not os.path.isdir(folder_path):
+        raise ValueError(f"{folder_path} is not a directory")
+    file_list = os.listdir(folder_path)
+    # make sure the page_file_name is in the folder
+    if page_file_name not in file_list:
+        raise ValueError(f"{page_file_name} not found in {folder_path}")
+
+
+def render_with_driver(
+    driver, url: str, timer: StageTimer | None = None, **ready_kwargs
+) -> tuple:
+    timer = timer or StageTimer()
+    # A reused driver is still sized to the previous page's content, restore
+    # the layout size before loading so the page is laid out as on a new one
+    with timer.stage("layout_reset"):
+        window_size = driver.get_window_size()
+        if (window_size["width"], window_size["height"]) != LAYOUT_WINDOW_SIZE:
+            driver.set_window_size(*LAYOUT_WINDOW_SIZE)
+    with timer.stage("load"):
         driver.get(url)
+    png_bytes, error_logs = capture_screenshot(driver, timer=timer, **ready_kwargs)
+    error_message = "\n".join([log["message"] for log in error_logs])
+    return png_bytes, error_message
+
 
-        # Take screenshot
-        os.makedirs(screenshot_folder, exist_ok=True)
-        screenshot_name = page_file_name.replace(".html", "_screenshot.png")
-        screenshot_path = os.path.join(screenshot_folder, screenshot_name)
-        content_width, content_height, error_logs = take_screenshot(
-            driver, screenshot_path
+# Resolves with one readiness state per frame of a harness page. Each frame is
+# awaited like a single page: the readiness hook (injected into every frame),
+# the caller's signal evaluated in the frame, or a quiet period after load.
+GROUP_READY_SCRIPT = """
+const [quietMs, useHook, readySignal, timeoutMs] = arguments;
+const done = arguments[arguments.length - 1];
+const frames = Array.from(document.querySelectorAll("iframe"));
+const loaded = (frame) => new Promise((resolve) => {
+  if (frame.dataset.loaded) return resolve();
+  frame.addEventListener("load", () => resolve(), { once: true });
+});
+const ready = async (frame) => {
+  await loaded(frame);
+  const win = frame.contentWindow;
+  if (readySignal) {
+    return String(await new win.Function(`return (${readySignal});`).call(win, quietMs));
+  }
+  if (useHook && typeof win.__chartReady === "function") {
+    return String(await win.__chartReady(quietMs));
+  }
+  await new Promise((resolve) => setTimeout(resolve, quietMs));
+  return "load";
+};
+const timeout = new Promise((resolve) => setTimeout(() => resolve("timeout"), timeoutMs));
+Promise.all(frames.map((frame) => Promise.race([
+  ready(frame).catch((e) => "error: " + e), timeout,
+]))).then(done);
+"""
+
+# Shrinks every frame to its body plus the margins, as capture_screenshot does
+# with the window, then returns each frame's content box in page coordinates
+# (null when nothing is visible). The box covers text, graphics, empty leaf
+# elements such as bars and icons, and elements with a background or border.
+GROUP_LAYOUT_SCRIPT = """
+const [marginWidth, marginHeight] = arguments;
+const done = arguments[arguments.length - 1];
+const frames = Array.from(document.querySelectorAll("iframe"));
+const GRAPHICS = new Set(["svg", "canvas", "img", "video", "object", "embed", "iframe"]);
+const SKIPPED = new Set(["script", "style", "template", "noscript"]);
+const BLANK = new Set(["transparent", "rgba(0, 0, 0, 0)", "rgb(255, 255, 255)"]);
+for (const frame of frames) {
+  const body = frame.contentDocument && frame.contentDocument.body;
+  if (!body) continue;
+  const rect = body.getBoundingClientRect();
+  frame.style.width = `${Math.round(rect.width) + marginWidth}px`;
+  frame.style.height = `${Math.round(rect.height) + marginHeight}px`;
+}
+const contentBox = (frame) => {
+  const doc = frame.contentDocument;
+  if (!doc || !doc.body) return null;
+  const win = frame.contentWindow;
+  const range = doc.createRange();
+  let left = Infinity, top = Infinity, right = -Infinity, bottom = -Infinity;
+  const add = (rect) => {
+    if (rect.width <= 0 || rect.height <= 0) return;
+    left = Math.min(left, rect.left);
+    top = Math.min(top, rect.top);
+    right = Math.max(right, rect.right);
+    bottom = Math.max(bottom, rect.bottom);
+  };
+  const visit = (element, root) => {
+    const tag = element.localName;
+    if (SKIPPED.has(tag)) return;
+    const style = win.getComputedStyle(element);
+    if (style.display === "none" || style.opacity === "0") return;
+    const shown = style.visibility !== "hidden";
+    if (GRAPHICS.has(tag)) {
+      if (shown) add(element.getBoundingClientRect());
+      return;
+    }
+    const decorated = !BLANK.has(style.backgroundColor) ||
+      parseFloat(style.borderTopWidth) + parseFloat(style.borderLeftWidth) > 0;
+    if (shown && !root && decorated) add(element.getBoundingClientRect());
+    let empty = true;
+    for (const child of element.childNodes) {
+      if (child.nodeType === Node.ELEMENT_NODE) {
+        empty = false;
+        visit(child, false);
+      } else if (child.nodeType === Node.TEXT_NODE && child.textContent.trim()) {
+        empty = false;
+        if (shown) {
+          range.selectNodeContents(child);
+          add(range.getBoundingClientRect());
+        }
+      }
+    }
+    if (shown && !root && empty) add(element.getBoundingClientRect());
+  };
+  visit(doc.body, true);
+  if (left === Infinity) return null;
+  // Clip to the frame, then move into the coordinates of the harness page
+  const frameRect = frame.getBoundingClientRect();
+  left = Math.max(0, Math.floor(left));
+  top = Math.max(0, Math.floor(top));
+  right = Math.min(frame.clientWidth, Math.ceil(right));
+  bottom = Math.min(frame.clientHeight, Math.ceil(bottom));
+  if (right <= left || bottom <= top) return null;
+  return {
+    x: frameRect.left + window.scrollX + left,
+    y: frameRect.top + window.scrollY + top,
+    width: right - left,
+    height: bottom - top,
+  };
+};
+// Let resize handlers redraw before measuring
+requestAnimationFrame(() => requestAnimationFrame(() => done(frames.map(contentBox))));
+"""
+
+RAISE_FRAME_SCRIPT = """
+Array.from(document.querySelectorAll("iframe")).forEach((frame, index) => {
+  frame.style.zIndex = index === arguments[0] ? 1 : 0;
+});
+"""
+
+
+def render_group_with_driver(
+    driver,
+    harness_url: str,
+    page_urls: List[str],
+    timer: StageTimer | None = None,
+    readiness: str = "event",
+    ready_timeout: float = 30,
+    ready_quiet_ms: int = 200,
+    ready_signal: str | None = None,
+) -> List[tuple]:
+    """Load the harness page showing `page_urls` as iframes and capture each
+    frame's content box with one CDP clip screenshot.
+
+    Returns (png_bytes, error_message) per page; png_bytes is None when the
+    page shows nothing. Console errors are matched to pages by their URL; an
+    error no page's URL matches goes to every page whose readiness wait ended
+    with "error". `readiness="poll"` waits a quiet period after each frame's
+    load instead of using the readiness hook.
+    """
+    if readiness not in ("event", "poll"):
+        raise ValueError(f"Unknown readiness mode: {readiness}")
+    timer = timer or StageTimer()
+    with timer.stage("layout_reset"):
+        window_size = driver.get_window_size()
+        if (window_size["width"], window_size["height"]) != LAYOUT_WINDOW_SIZE:
+            driver.set_window_size(*LAYOUT_WINDOW_SIZE)
+    with timer.stage("load"):
+        driver.get(harness_url)
+    with timer.stage("ready"):
+        # Leave room for the script's own per-frame timeout to fire first
+        driver.set_script_timeout(ready_timeout + 10)
+        states = driver.execute_async_script(
+            GROUP_READY_SCRIPT,
+            ready_quiet_ms,
+            readiness == "event",
+            ready_signal,
+            ready_timeout * 1000,
         )
-        error_message = "\n".join([log["message"] for log in error_logs])
+        error_logs = get_error_logs(driver)
+    with timer.stage("relayout"):
+        boxes = driver.execute_async_script(GROUP_LAYOUT_SCRIPT, *CONTENT_MARGIN)
 
-    except Exception as e:
-        error_message = f"Error processing {folder_path}: {str(e)}"
-        screenshot_path = None
-        content_width, content_height = None, None
+    unmatched = [
+        log["message"]
+        for log in error_logs
+        if not any(page_url in log["message"] for page_url in page_urls)
+    ]
+    captures = []
+    for index, (page_url, state, box) in enumerate(zip(page_urls, states, boxes)):
+        messages = [log["message"] for log in error_logs if page_url in log["message"]]
+        if state.startswith("error"):
+            messages += unmatched
+        error_message = "\n".join(messages)
+        if box is None:
+            captures.append((None, error_message or "Nothing rendered in the page"))
+            continue
+        with timer.stage("capture"):
+            driver.execute_script(RAISE_FRAME_SCRIPT, index)
+            screenshot = driver.execute_cdp_cmd(
+                "Page.captureScreenshot",
+                {
+                    "format": "png",
+                    "clip": {**box, "scale": 1},
+                    "captureBeyondViewport": True,
+                },
+            )
+        captures.append((base64.b64decode(screenshot["data"]), error_message))
+    return captures
 
-    finally:
-        for var, value in original_env.items():
-            os.environ[var] = value
-        # Clean up resources regardless of success or failure
-        if "driver" in locals() and driver is not None:
+
+class RenderPool:
+    """A pool of warm headless Chrome drivers shared by many render jobs.
+
+    At most `size` drivers are alive at once. A driver is recycled after it has
+    rendered `max_pages_per_driver` pages or as soon as a render raises, so a
+    crashed or leaking Chrome never serves a second job. Pages are served by
+    `server`, by default the process-wide `ChartServer`, where every chart
+    folder is mounted once under its own prefix.
+
+    A driver goes back to the pool as soon as its screenshot bytes are
+    captured; cropping and encoding run on a separate pool of
+    `encode_workers` threads so Chrome keeps rendering in the meantime.
+    `image_kwargs` (image_format, compress_level, quality, border_percentage,
+    border_tolerance) are passed to `process_screenshot`. `ready_kwargs`
+    (readiness, ready_timeout, ready_quiet_ms, ready_signal) are the defaults
+    passed to `capture_screenshot` and can be overridden per `render` call.
+    With an `asset_cache`, CDN libraries are served from local disk. With a
+    `render_cache`, unchanged pages are answered from disk without Chrome.
+
+    `render_async` and `render_many_async` run the same jobs on the pool's
+    bounded thread pool so they can be awaited alongside other coroutines.
+    `render_timed` also returns the page's time per stage (see
+    `RENDER_STAGES`); `stats["stage_seconds"]` sums them over all pages.
+    `render_group` loads several pages as iframes of one harness page and
+    captures each at its own content box, so a page costs one capture rather
+    than a navigation, two window resizes and a full-window capture.
+
+    Usage:
+        with RenderPool(size=4) as pool:
+            results = pool.render_many(
+                [(folder_path, "html_0.html", screenshot_folder), ...]
+            )
+
+        async with RenderPool(size=4) as pool:
+            results = await pool.render_many_async(jobs, timeout=60)
+    """
+
+    def __init__(
+        self,
+        size: int = 2,
+        max_pages_per_driver: int = 50,
+        encode_workers: int = 2,
+        ready_kwargs: Dict | None = None,
+        asset_cache: AssetCache | None = None,
+        server: ChartServer | None = None,
+        render_cache: RenderCache | None = None,
+        **image_kwargs,
+    ):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.size = size
+        self.max_pages_per_driver = max_pages_per_driver
+        self.encode_workers = max(1, encode_workers)
+        self.image_kwargs = image_kwargs
+        self.ready_kwargs = ready_kwargs or {}
+        self.asset_cache = asset_cache
+        self.server = server
+        self.render_cache = render_cache
+        self.image_format = image_kwargs.get("image_format", "PNG")
+        self._encoder = ThreadPoolExecutor(max_workers=self.encode_workers)
+        # Extra threads keep every driver busy while others wait on encoding
+        self._executor = ThreadPoolExecutor(max_workers=size + self.encode_workers)
+        self._slots = threading.Semaphore(size)
+        self._idle = queue.LifoQueue()
+        self._page_counts = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self._mounted = set()  # folders this pool holds mounted on the server
+        self.stats = {
+            "pages": 0,
+            "failures": 0,
+            "cache_hits": 0,
+            "drivers_started": 0,
+            "drivers_recycled": 0,
+            "charts_per_sec": None,
+            "stage_seconds": {},
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # Cancelled or failed, do not hold the caller up on running jobs
+            self.close(wait=False)
+            return
+        # Quitting Chrome blocks, keep it off the event loop
+        await asyncio.to_thread(self.close)
+
+    def _acquire_driver(self, timer: StageTimer):
+        with timer.stage("wait"):
+            self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            with timer.stage("driver_launch"):
+                driver = create_driver()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._page_counts[id(driver)] = 0
+            self.stats["drivers_started"] += 1
+        return driver
+
+    def _release_driver(self, driver, broken: bool = False, pages: int = 1):
+        with self._lock:
+            self._page_counts[id(driver)] += pages
+            worn_out = self._page_counts[id(driver)] >= self.max_pages_per_driver
+            recycle = broken or worn_out or self._closed
+            if recycle:
+                del self._page_counts[id(driver)]
+                self.stats["drivers_recycled"] += 1
+        if recycle:
+            quit_driver(driver)
+        else:
+            self._idle.put(driver)
+        self._slots.release()
+
+    def _get_url(self, folder_path: str, page_file_name: str, timer: StageTimer) -> str:
+        if self.server is None:
+            with timer.stage("server_start"):
+                self.server = get_shared_server(self.asset_cache)
+        folder_path = os.path.abspath(folder_path)
+        with self._lock:
+            acquire = folder_path not in self._mounted
+            self._mounted.add(folder_path)
+        if acquire:
+            self.server.acquire(folder_path)
+        return self.server.url_for(folder_path, page_file_name)
+
+    def render(
+        self,
+        folder_path: str,
+        page_file_name: str,
+        screenshot_folder: str,
+        **ready_kwargs,
+    ) -> tuple:
+        """Render one page. Returns the same tuple as `render_page`."""
+        return self.render_timed(
+            folder_path, page_file_name, screenshot_folder, **ready_kwargs
+        )[0]
+
+    def render_timed(
+        self,
+        folder_path: str,
+        page_file_name: str,
+        screenshot_folder: str,
+        **ready_kwargs,
+    ) -> Tuple[tuple, Dict[str, float]]:
+        """`render`, also returning the seconds spent in each stage the page
+        went through, plus "total". Failed pages keep the stages they reached."""
+        timer = StageTimer()
+        with trace("render.page", page=page_file_name):
+            result = self._render(
+                folder_path, page_file_name, screenshot_folder, timer, ready_kwargs
+            )
+        timings = timer.record()
+        self._add_stage_seconds(timings)
+        return result, timings
+
+    def _render(
+        self,
+        folder_path: str,
+        page_file_name: str,
+        screenshot_folder: str,
+        timer: StageTimer,
+        ready_kwargs: Dict,
+    ) -> tuple:
+        ready_kwargs = {**self.ready_kwargs, **ready_kwargs}
+        check_page(folder_path, page_file_name)
+        screenshot_path = os.path.join(
+            screenshot_folder, get_screenshot_name(page_file_name, self.image_format)
+        )
+        cache_key, cached = self._lookup_cache(
+            folder_path, page_file_name, screenshot_path, {"ready": ready_kwargs}, timer
+        )
+        if cached is not None:
+            return cached
+        try:
+            os.makedirs(screenshot_folder, exist_ok=True)
+            # Use localhost URL instead of file://
+            url = self._get_url(folder_path, page_file_name, timer)
+            driver = self._acquire_driver(timer)
+            broken = False
+            try:
+                png_bytes, error_message = render_with_driver(
+                    driver, url, timer, **ready_kwargs
+                )
+            except Exception:
+                broken = True
+                raise
+            finally:
+                self._release_driver(driver, broken)
+            # The copied context keeps the crop and encode spans under this page
+            content_width, content_height = self._encoder.submit(
+                contextvars.copy_context().run,
+                functools.partial(
+                    process_screenshot,
+                    png_bytes,
+                    screenshot_path,
+                    timer=timer,
+                    **self.image_kwargs,
+                ),
+            ).result()
+            result = (screenshot_path, error_message, content_width, content_height)
+            if cache_key is not None:
+                self.render_cache.put(cache_key, result)
+        except Exception as e:
+            result = (None, f"Error processing {folder_path}: {str(e)}", None, None)
+        self._count_result(result)
+        return result
+
+    def _lookup_cache(
+        self,
+        folder_path: str,
+        page_file_name: str,
+        screenshot_path: str,
+        settings: Dict,
+        timer: StageTimer,
+    ) -> tuple:
+        """(cache_key, cached result); both None without a render cache."""
+        if self.render_cache is None:
+            return None, None
+        settings = {
+            "renderer_version": RENDERER_VERSION,
+            "window_size": LAYOUT_WINDOW_SIZE,
+            "image": self.image_kwargs,
+            **settings,
+        }
+        with timer.stage("cache"):
+            cache_key = self.render_cache.make_key(folder_path, page_file_name, settings)
+            cached = self.render_cache.get(cache_key, screenshot_path)
+        if cached is not None:
+            with self._lock:
+                self.stats["pages"] += 1
+                self.stats["cache_hits"] += 1
+        return cache_key, cached
+
+    def _count_result(self, result: tuple):
+        with self._lock:
+            self.stats["pages"] += 1
+            if result[0] is None:
+                self.stats["failures"] += 1
+
+    def _add_stage_seconds(self, timings: Dict[str, float]):
+        with self._lock:
+            stage_seconds = self.stats["stage_seconds"]
+            for stage, seconds in timings.items():
+                stage_seconds[stage] = stage_seconds.get(stage, 0.0) + seconds
+
+    def render_group(
+        self, jobs: List[Tuple[str, str, str]], **ready_kwargs
+    ) -> List[tuple]:
+        """Render (folder_path, page_file_name, screenshot_folder) jobs as
+        iframes of one page in one driver. Results keep the order of `jobs`
+        and are the same tuples as `render` returns."""
+        return self.render_group_timed(jobs, **ready_kwargs)[0]
+
+    def render_group_timed(
+        self, jobs: List[Tuple[str, str, str]], **ready_kwargs
+    ) -> Tuple[List[tuple], Dict[str, float]]:
+        """`render_group`, also returning the seconds per stage of the whole
+        group: one load and one readiness wait, one capture per page.
+
+        Each page is captured by clipping to its own content box, so the
+        screenshot needs no border stripping, only padding. A group costs the
+        driver as many of its `max_pages_per_driver` as it has pages.
+        """
+        timer = StageTimer()
+        with trace("render.group", pages=len(jobs)):
+            results = self._render_group(jobs, timer, ready_kwargs)
+        timings = timer.record()
+        self._add_stage_seconds(timings)
+        return results, timings
+
+    def _render_group(
+        self, jobs: List[Tuple[str, str, str]], timer: StageTimer, ready_kwargs: Dict
+    ) -> List[tuple]:
+        ready_kwargs = {**self.ready_kwargs, **ready_kwargs}
+        results = [None] * len(jobs)
+        pending = []
+        for index, (folder_path, page_file_name, screenshot_folder) in enumerate(jobs):
+            try:
+                check_page(folder_path, page_file_name)
+            except ValueError as e:
+                results[index] = (None, str(e), None, None)
+                self._count_result(results[index])
+                continue
+            screenshot_path = os.path.join(
+                screenshot_folder, get_screenshot_name(page_file_name, self.image_format)
+            )
+            # Clipped captures differ from full-window ones, keep them apart
+            cache_key, cached = self._lookup_cache(
+                folder_path,
+                page_file_name,
+                screenshot_path,
+                {"ready": ready_kwargs, "capture": "group"},
+                timer,
+            )
+            if cached is not None:
+                results[index] = cached
+            else:
+                pending.append((index, screenshot_path, cache_key))
+        if not pending:
+            return results
+
+        try:
+            page_urls = []
+            for index, _, _ in pending:
+                folder_path, page_file_name, screenshot_folder = jobs[index]
+                os.makedirs(screenshot_folder, exist_ok=True)
+                page_urls.append(self._get_url(folder_path, page_file_name, timer))
+            harness_url = self.server.harness_url_for(page_urls, *LAYOUT_WINDOW_SIZE)
+            driver = self._acquire_driver(timer)
+            broken = False
             try:
-                driver.quit()
-            except Exception as quit_error:
-                print(f"Warning: Error while quitting driver: {str(quit_error)}")
-            driver = None
+                captures = render_group_with_driver(
+                    driver, harness_url, page_urls, timer, **ready_kwargs
+                )
+            except Exception:
+                broken = True
+                raise
+            finally:
+                self._release_driver(driver, broken, pages=len(pending))
+            encodings = [
+                self._encoder.submit(
+                    contextvars.copy_context().run,
+                    functools.partial(
+                        process_screenshot,
+                        png_bytes,
+                        screenshot_path,
+                        timer=timer,
+                        crop=False,
+                        **self.image_kwargs,
+                    ),
+                )
+                if png_bytes is not None
+                else None
+                for (_, screenshot_path, _), (png_bytes, _) in zip(pending, captures)
+            ]
+            for (index, screenshot_path, cache_key), (_, error_message), encoding in zip(
+                pending, captures, encodings
+            ):
+                if encoding is None:
+                    results[index] = (None, error_message, None, None)
+                    continue
+                content_width, content_height = encoding.result()
+                results[index] = (
+                    screenshot_path,
+                    error_message,
+                    content_width,
+                    content_height,
+                )
+                if cache_key is not None:
+                    self.render_cache.put(cache_key, results[index])
+        except Exception as e:
+            for index, _, _ in pending:
+                if results[index] is None:
+                    results[index] = (
+                        None,
+                        f"Error processing {jobs[index][0]}: {str(e)}",
+                        None,
+                        None,
+                    )
+        for index, _, _ in pending:
+            self._count_result(results[index])
+        return results
+
+    def render_many(
+        self, jobs: List[Tuple[str, str, str]], group_size: int | None = None
+    ) -> List[tuple]:
+        """Render (folder_path, page_file_name, screenshot_folder) jobs
+        concurrently. Results keep the order of `jobs`. With `group_size`,
+        up to that many pages share one load with `render_group`."""
+
+        start_time = time.perf_counter()
+        if group_size and group_size > 1:
+            groups = [jobs[i : i + group_size] for i in range(0, len(jobs), group_size)]
+            results = [
+                result
+                for group_results in self._executor.map(self.render_group, groups)
+                for result in group_results
+            ]
+        else:
+            results = list(self._executor.map(lambda job: self._render_job(*job), jobs))
+        self._report_throughput(len(jobs), time.perf_counter() - start_time)
+        return results
+
+    def _render_job(self, *job, **ready_kwargs) -> tuple:
+        try:
+            return self.render(*job, **ready_kwargs)
+        except ValueError as e:
+            return None, str(e), None, None
+
+    def _report_throughput(self, charts: int, elapsed: float):
+        charts_per_sec = charts / elapsed if elapsed > 0 else 0.0
+        self.stats["charts_per_sec"] = charts_per_sec
+        logger.info(
+            f"Rendered {charts} charts in {elapsed:.2f}s "
+            f"({charts_per_sec:.2f} charts/sec)"
+        )
+
+    async def render_async(
+        self,
+        folder_path: str,
+        page_file_name: str,
+        screenshot_folder: str,
+        timeout: float | None = None,
+        **ready_kwargs,
+    ) -> tuple:
+        """Await one render without blocking the event loop.
+
+        Cancelling the task, or exceeding `timeout`, withdraws a job that is
+        still queued. A job already inside Chrome runs to completion in its
+        thread (bounded by the readiness and page load timeouts), but its
+        result is discarded. A timeout is reported like any other render
+        error.
+        """
+        future = asyncio.wrap_future(
+            self._executor.submit(
+                functools.partial(
+                    self._render_job,
+                    folder_path,
+                    page_file_name,
+                    screenshot_folder,
+                    **ready_kwargs,
+                )
+            )
+        )
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return (
+                None,
+                f"Error processing {folder_path}: timed out after {timeout}s",
+                None,
+                None,
+            )
+
+    async def render_many_async(
+        self, jobs: List[Tuple[str, str, str]], timeout: float | None = None
+    ) -> List[tuple]:
+        """Async `render_many`; `timeout` applies to each page separately."""
+        start_time = time.perf_counter()
+        results = await asyncio.gather(
+            *[self.render_async(*job, timeout=timeout) for job in jobs]
+        )
+        self._report_throughput(len(jobs), time.perf_counter() - start_time)
+        return results
+
+    def close(self, wait: bool = True):
+        """Cancel queued jobs and quit the drivers. With `wait=False`, return at
+        once and let a background thread quit them after the jobs already
+        inside Chrome finish, so a timed out or cancelled caller is not held up.
+        """
+        with self._lock:
+            self._closed = True
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        if wait:
+            self._finish_close()
+        else:
+            threading.Thread(target=self._finish_close, name="RenderPool.close").start()
+
+    def _finish_close(self):
+        # The shared server outlives the pool, only drivers and the pool's
+        # mounts are released. Drivers of running jobs are quit as they return.
+        self._executor.shutdown(wait=True)
+        self._encoder.shutdown(wait=True)
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            quit_driver(driver)
+        with self._lock:
+            mounted, self._mounted = self._mounted, set()
+        for folder_path in mounted:
+            self.server.release(folder_path)
+
+
+def render_page(
+    folder_path: str,
+    page_file_name: str,
+    screenshot_folder: str,
+    readiness: str = "event",
+    ready_timeout: float = 30,
+    ready_quiet_ms: int = 200,
+    ready_signal: str | None = None,
+    asset_cache: AssetCache | None = None,
+    render_cache: RenderCache | None = None,
+    return_timings: bool = False,
+    **image_kwargs,
+):
+    """Render one page with a fresh driver. Returns (screenshot_path,
+    error_message, content_width, content_height); with `return_timings`,
+    ((...), timings) where timings are the seconds per stage of the render,
+    driver launch and server start included."""
+    with RenderPool(
+        size=1,
+        encode_workers=1,
+        asset_cache=asset_cache,
+        render_cache=render_cache,
+        **image_kwargs,
+    ) as pool:
+        result, timings = pool.render_timed(
+            folder_path,
+            page_file_name,
+            screenshot_folder,
+            readiness=readiness,
+            ready_timeout=ready_timeout,
+            ready_quiet_ms=ready_quiet_ms,
+            ready_signal=ready_signal,
+        )
+    return (result, timings) if return_timings else result
+
+
+async def render_page_async(
+    folder_path: str,
+    page_file_name: str,
+    screenshot_folder: str,
+    timeout: float | None = None,
+    pool: RenderPool | None = None,
+    **ready_kwargs,
+) -> tuple:
+    """Async `render_page`. Pass a long-lived `pool` to reuse its warm drivers
+    and caches; otherwise a one-driver pool is used for this page and closed
+    without waiting, so `timeout` and cancellation return at once."""
+    if pool is not None:
+        return await pool.render_async(
+            folder_path, page_file_name, screenshot_folder, timeout, **ready_kwargs
+        )
+    pool = RenderPool(size=1, encode_workers=1)
+    try:
+        return await pool.render_async(
+            folder_path, page_file_name, screenshot_folder, timeout, **ready_kwargs
+        )
+    finally:
+        pool.close(wait=False)
+
+
+async def render_many_async(
+    jobs: List[Tuple[str, str, str]],
+    timeout: float | None = None,
+    pool: RenderPool | None = None,
+    size: int = 2,
+) -> List[tuple]:
+    """Async `RenderPool.render_many` on `pool`, or on a temporary pool of
+    `size` drivers that is closed without waiting."""
+    if pool is not None:
+        return await pool.render_many_async(jobs, timeout)
+    pool = RenderPool(size=size)
+    try:
+        return await pool.render_many_async(jobs, timeout)
+    finally:
+        pool.close(wait=False)
+
+
+def summarize_stages(timings: List[Dict[str, float]]) -> Dict[str, Dict]:
+    """Per stage: pages that went through it, total seconds, p50 and p95.
+    Stages follow RENDER_STAGES, then "total"."""
+    stages = {}
+    for stage in (*RENDER_STAGES, "total"):
+        values = [record[stage] for record in timings if stage in record]
+        if values:
+            stages[stage] = {
+                "count": len(values),
+                "total": sum(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+            }
+    return stages
+
+
+def print_stage_summary(stages: Dict[str, Dict]):
+    print(f"{'stage':<14} {'pages':>6} {'total s':>9} {'p50 ms':>9} {'p95 ms':>9}")
+    for stage, summary in stages.items():
+        print(
+            f"{stage:<14} {summary['count']:>6} {summary['total']:>9.2f} "
+            f"{summary['p50'] * 1000:>9.1f} {summary['p95'] * 1000:>9.1f}"
+        )
+
+
+def collect_chart_folders(paths: List[str]) -> Dict[str, List[str]]:
+    """Expand chart directories or glob patterns into {folder: [html pages]}."""
+    folders = {}
+    for path in paths:
+        matches = glob.glob(path) if glob.has_magic(path) else [path]
+        for match in sorted(matches):
+            if os.path.isdir(match):
+                folder, pages = match, [
+                    name for name in os.listdir(match) if name.endswith(".html")
+                ]
+            elif match.endswith(".html") and os.path.isfile(match):
+                folder, pages = os.path.dirname(match) or ".", [os.path.basename(match)]
+            else:
+                continue
+            folder = os.path.abspath(folder)
+            merged = set(folders.get(folder, [])) | set(pages)
+            folders[folder] = sorted(merged, key=natural_key)
+    return {folder: pages for folder, pages in folders.items() if pages}
 
-        if "httpd" in locals():
+
+def _render_batch_chunk(
+    jobs: List[Tuple[str, str, str]], options: Dict
+) -> Tuple[List[tuple], Dict]:
+    # Runs in a worker process: one warm driver renders the whole chunk.
+    # Caches are built here since their locks cannot be pickled.
+    results = []
+    asset_cache_kwargs = options["asset_cache_kwargs"]
+    render_cache_kwargs = options["render_cache_kwargs"]
+    group_size = options.get("group_size") or 1
+    with RenderPool(
+        size=1,
+        encode_workers=1,
+        ready_kwargs=options["ready_kwargs"],
+        asset_cache=AssetCache(**asset_cache_kwargs) if asset_cache_kwargs else None,
+        render_cache=(
+            RenderCache(**render_cache_kwargs) if render_cache_kwargs else None
+        ),
+        **options["image_kwargs"],
+    ) as pool:
+        if group_size > 1:
+            for i in range(0, len(jobs), group_size):
+                group = jobs[i : i + group_size]
+                group_results, timings = pool.render_group_timed(group)
+                # A group's stages are shared, charge each page an equal part
+                share = {stage: seconds / len(group) for stage, seconds in timings.items()}
+                for job, result in zip(group, group_results):
+                    results.append((job, result, share["total"], share))
+            return results, pool.stats
+        for job in jobs:
+            start_time = time.perf_counter()
             try:
-                httpd.shutdown()
-                httpd.server_close()
-            except Exception as server_error:
-                print(f"Warning: Error while closing server: {str(server_error)}")
+                result, timings = pool.render_timed(*job)
+            except ValueError as e:
+                result, timings = (None, str(e), None, None), {}
+            latency = time.perf_counter() - start_time
+            results.append((job, result, latency, {**timings, "total": latency}))
+    return results, pool.stats
+
+
+def write_html_size(folder_path: str, sizes: Dict[str, str]):
+    size_file = os.path.join(folder_path, "html_size.json")
+    html_size = {}
+    if os.path.exists(size_file):
+        with open(size_file, "r", encoding="utf-8") as f:
+            html_size = json.load(f)
+    html_size.update(sizes)
+    html_size = {key: html_size[key] for key in sorted(html_size, key=natural_key)}
+    with open(size_file, "w", encoding="utf-8") as f:
+        json.dump(html_size, f, indent=2, ensure_ascii=False)
+
 
-    return screenshot_path, error_message, content_width, content_height
+def render_directories(
+    paths: List[str],
+    workers: int | None = None,
+    screenshot_folder: str | None = None,
+    ready_kwargs: Dict | None = None,
+    asset_cache_kwargs: Dict | None = None,
+    render_cache_kwargs: Dict | None = None,
+    group_size: int | None = None,
+    **image_kwargs,
+) -> Dict:
+    """Render every chart page under `paths` across `workers` processes and
+    update each folder's html_size.json in one pass.
+
+    With `group_size`, each process renders its pages `group_size` at a time
+    with `RenderPool.render_group`; a page's latency and stage timings are
+    then its equal share of its group's.
+
+    Screenshots are written next to the pages, or to
+    `screenshot_folder/<folder name>/` when given. `asset_cache_kwargs`
+    (cache_dir, offline) enable the CDN asset cache and `render_cache_kwargs`
+    (cache_dir, max_bytes) the render cache. Returns a summary with
+    latency percentiles (seconds), per-stage timings (`summarize_stages`),
+    the failed pages and every page's result with its own stage timings.
+    """
+    folders = collect_chart_folders(paths)
+    jobs = []
+    for folder, pages in folders.items():
+        target = (
+            os.path.join(screenshot_folder, os.path.basename(folder))
+            if screenshot_folder
+            else folder
+        )
+        jobs.extend((folder, page, target) for page in pages)
+    if not jobs:
+        raise ValueError(f"No html pages found in {paths}")
+
+    workers = max(1, min(workers or os.cpu_count() or 1, len(jobs)))
+    # Interleave jobs so that every process gets a similar share of each folder
+    chunks = [jobs[i::workers] for i in range(workers)]
+
+    options = {
+        "ready_kwargs": ready_kwargs or {},
+        "asset_cache_kwargs": asset_cache_kwargs,
+        "render_cache_kwargs": render_cache_kwargs,
+        "group_size": group_size,
+        "image_kwargs": image_kwargs,
+    }
+    start_time = time.perf_counter()
+    outcomes = []
+    cache_hits = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk_results, pool_stats in executor.map(
+            _render_batch_chunk, chunks, [options] * len(chunks)
+        ):
+            outcomes.extend(chunk_results)
+            cache_hits += pool_stats["cache_hits"]
+    elapsed = time.perf_counter() - start_time
+
+    sizes = {folder: {} for folder in folders}
+    latencies = []
+    failures = []
+    results = []
+    for (folder, page, _), result, latency, timings in outcomes:
+        screenshot_path, error_message, content_width, content_height = result
+        latencies.append(latency)
+        results.append(
+            {
+                "folder": folder,
+                "page": page,
+                "screenshot_path": screenshot_path,
+                "error": error_message,
+                "width": content_width,
+                "height": content_height,
+                "seconds": latency,
+                "stages": timings,
+            }
+        )
+        if screenshot_path is None:
+            failures.append({"page": os.path.join(folder, page), "error": error_message})
+            continue
+        sizes[folder][page] = f"{content_width}+{content_height}"
+    for folder, folder_sizes in sizes.items():
+        if folder_sizes:
+            write_html_size(folder, folder_sizes)
+
+    return {
+        "pages": len(jobs),
+        "folders": len(folders),
+        "workers": workers,
+        "seconds": elapsed,
+        "charts_per_sec": len(jobs) / elapsed if elapsed > 0 else 0.0,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p90": percentile(latencies, 90),
+        "latency_p99": percentile(latencies, 99),
+        "latency_max": max(latencies),
+        "stages": summarize_stages([result["stages"] for result in results]),
+        "cache_hits": cache_hits,
+        "failures": failures,
+        "results": results,
+    }
+
+
+def print_batch_summary(summary: Dict):
+    print(
+        f"Rendered {summary['pages']} pages in {summary['folders']} folders with "
+        f"{summary['workers']} workers in {summary['seconds']:.2f}s "
+        f"({summary['charts_per_sec']:.2f} charts/sec)"
+    )
+    print(
+        "Latency per page: "
+        f"p50 {summary['latency_p50']:.2f}s | "
+        f"p90 {summary['latency_p90']:.2f}s | "
+        f"p99 {summary['latency_p99']:.2f}s | "
+        f"max {summary['latency_max']:.2f}s"
+    )
+    print_stage_summary(summary["stages"])
+    print(f"Render cache hits: {summary['cache_hits']}")
+    print(f"Failures: {len(summary['failures'])}")
+    for failure in summary["failures"]:
+        print(f"  {failure['page']}: {failure['error']}")
 
 
 if __name__ == "__main__":
+    load_config()
     parser = ArgumentParser()
     parser.add_argument("--folder_path", type=str, default=".")
     parser.add_argument(
@@ -323,12 +1470,113 @@ def render_page(
         help="The name of the html file",
     )
     parser.add_argument("--screenshot_folder", type=str, default=".")
+    parser.add_argument(
+        "--batch",
+        type=str,
+        nargs="+",
+        help="Chart directories or glob patterns to render in batch mode",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes in batch mode, defaults to the CPU count",
+    )
+    parser.add_argument(
+        "--batch_screenshot_folder",
+        type=str,
+        default=None,
+        help="Where batch mode writes screenshots, defaults to each chart folder",
+    )
+    parser.add_argument(
+        "--group_size",
+        type=int,
+        default=None,
+        help="In batch mode, render this many pages per browser page as iframes",
+    )
+    parser.add_argument(
+        "--image_format", type=str, default="PNG", choices=list(IMAGE_EXTENSIONS)
+    )
+    parser.add_argument(
+        "--compress_level", type=int, default=6, help="PNG compression level (0-9)"
+    )
+    parser.add_argument(
+        "--quality", type=int, default=90, help="WEBP/JPEG quality (0-100)"
+    )
+    parser.add_argument(
+        "--readiness",
+        type=str,
+        default="event",
+        choices=["event", "poll"],
+        help="Await the injected readiness hook or poll for rendered elements",
+    )
+    parser.add_argument(
+        "--ready_timeout", type=float, default=30, help="Seconds to wait per page"
+    )
+    parser.add_argument(
+        "--asset_cache",
+        type=str,
+        default=None,
+        help="Serve CDN libraries from this asset cache folder",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Never download missing assets into the asset cache",
+    )
+    parser.add_argument(
+        "--render_cache",
+        type=str,
+        default=None,
+        help="Reuse screenshots of unchanged pages from this render cache folder",
+    )
+    parser.add_argument(
+        "--render_cache_max_mb",
+        type=int,
+        default=512,
+        help="Size bound of the render cache in MB",
+    )
     args = parser.parse_args()
+    render_cache_kwargs = (
+        {"cache_dir": args.render_cache, "max_bytes": args.render_cache_max_mb * 1024**2}
+        if args.render_cache
+        else None
+    )
+    asset_cache_kwargs = (
+        {"cache_dir": args.asset_cache, "offline": args.offline}
+        if args.asset_cache
+        else None
+    )
+    ready_kwargs = {"readiness": args.readiness, "ready_timeout": args.ready_timeout}
+    image_kwargs = {
+        "image_format": args.image_format,
+        "compress_level": args.compress_level,
+        "quality": args.quality,
+    }
+    if args.batch:
+        summary = render_directories(
+            args.batch,
+            args.workers,
+            args.batch_screenshot_folder,
+            ready_kwargs,
+            asset_cache_kwargs,
+            render_cache_kwargs,
+            args.group_size,
+            **image_kwargs,
+        )
+        print_batch_summary(summary)
+        raise SystemExit(1 if summary["failures"] else 0)
     folder_path = args.folder_path
     input_html_file_name = args.input_html_file_name
     screenshot_folder = args.screenshot_folder
     screenshot_path, error_message, content_width, content_height = render_page(
-        folder_path, input_html_file_name, screenshot_folder
+        folder_path,
+        input_html_file_name,
+        screenshot_folder,
+        asset_cache=AssetCache(**asset_cache_kwargs) if asset_cache_kwargs else None,
+        render_cache=RenderCache(**render_cache_kwargs) if render_cache_kwargs else None,
+        **ready_kwargs,
+        **image_kwargs,
     )
     if error_message:
         print(f"error_message: {error_message}")
@@ -0,0 +1,157 @@
+# Target of this module: remembering the title and description of reference
+# URLs across runs, so overlapping topics do not fetch the same pages again
+
+import os
+import json
+import time
+import sqlite3
+from pathlib import Path
+from typing import Dict
+
+from config import get_env
+
+DEFAULT_DB_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "multimodal-deepresearcher", "references.sqlite3"
+)
+
+FRESH = "fresh"
+STALE = "stale"
+MISSING = "missing"
+
+
+class ReferenceCache:
+    """SQLite cache of get_url_info results keyed by canonical URL.
+
+    The database is REFERENCE_CACHE_PATH from the config unless `db_path` is
+    given. Successful results live for `ttl` seconds and failures for
+    `negative_ttl` seconds. Stale successful entries keep their ETag and
+    Last-Modified validators, so the caller can revalidate them with a
+    conditional request instead of refetching.
+
+    Writes are committed in batches of `commit_every`, so storing results from
+    an event loop does not wait for a disk sync per URL. The connection sees
+    its own uncommitted rows; call `flush` (or `close`) to persist them.
+    """
+
+    def __init__(
+        self,
+        db_path: str | Path | None = None,
+        ttl: float = 7 * 24 * 3600,
+        negative_ttl: float = 3600,
+        commit_every: int = 64,
+    ):
+        if db_path is None:
+            db_path = get_env("REFERENCE_CACHE_PATH", DEFAULT_DB_PATH)
+        self.db_path = str(db_path)
+        if self.db_path != ":memory:":
+            Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.commit_every = commit_every
+        self._pending = 0
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS reference_info (
+                url TEXT PRIMARY KEY,
+                info TEXT,
+                error TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL
+            )"""
+        )
+        self.conn.commit()
+        self.stats = {
+            "hits": 0,
+            "negative_hits": 0,
+            "stale": 0,
+            "revalidated": 0,
+            "misses": 0,
+        }
+
+    def flush(self):
+        if self._pending:
+            self.conn.commit()
+            self._pending = 0
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def _written(self):
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.flush()
+
+    def lookup(self, url: str) -> tuple:
+        """Return (FRESH | STALE | MISSING, entry)."""
+        row = self.conn.execute(
+            "SELECT info, error, etag, last_modified, fetched_at "
+            "FROM reference_info WHERE url = ?",
+            (url,),
+        ).fetchone()
+        if row is None:
+            self.stats["misses"] += 1
+            return MISSING, None
+        info, error, etag, last_modified, fetched_at = row
+        entry = {
+            "info": json.loads(info) if info else None,
+            "error": error,
+            "etag": etag,
+            "last_modified": last_modified,
+        }
+        age = time.time() - fetched_at
+        if error is not None:
+            if age < self.negative_ttl:
+                self.stats["negative_hits"] += 1
+                return FRESH, entry
+            self.stats["misses"] += 1
+            return MISSING, None
+        if age < self.ttl:
+            self.stats["hits"] += 1
+            return FRESH, entry
+        if etag or last_modified:
+            self.stats["stale"] += 1
+            return STALE, entry
+        self.stats["misses"] += 1
+        return MISSING, None
+
+    def store(
+        self,
+        url: str,
+        info: Dict | None = None,
+        error: str | None = None,
+        etag: str | None = None,
+        last_modified: str | None = None,
+    ):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO reference_info "
+            "(url, info, error, etag, last_modified, fetched_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                url,
+                json.dumps(info, ensure_ascii=False) if info is not None else None,
+                error,
+                etag,
+                last_modified,
+                time.time(),
+            ),
+        )
+        self._written()
+
+    def touch(self, url: str):
+        """Mark a stale entry fresh again after a 304 Not Modified."""
+        self.conn.execute(
+            "UPDATE reference_info SET fetched_at = ? WHERE url = ?", (time.time(), url)
+        )
+        self._written()
+        self.stats["revalidated"] += 1
+
+    def hit_rate(self) -> float:
+        """Share of lookups answered without downloading the page again,
+        counting stale entries revalidated by a 304."""
+        stats = self.stats
+        served = stats["hits"] + stats["negative_hits"] + stats["revalidated"]
+        lookups = stats["hits"] + stats["negative_hits"] + stats["stale"] + stats["misses"]
+        return served / lookups if lookups else 0.0
@@ -0,0 +1,156 @@
+# Target of this module: skipping Chrome for charts whose HTML, local assets
+# and render settings have not changed since they were last rendered
+
+import os
+import re
+import json
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict
+
+from config import get_env
+
+# Used when RENDER_CACHE_DIR is not configured
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "multimodal-deepresearcher", "renders"
+)
+
+# src="...", href="..." and CSS url(...) references in a chart page
+LOCAL_REFERENCE_PATTERN = re.compile(
+    r"""(?:src|href)\s*=\s*["']([^"']+)["']|url\(\s*["']?([^"')]+)["']?\s*\)""",
+    re.IGNORECASE,
+)
+
+
+def find_local_assets(folder_path: str, html_bytes: bytes) -> list:
+    """Return the existing files inside `folder_path` that the page references."""
+    html_str = html_bytes.decode("utf-8", errors="replace")
+    folder = Path(folder_path).resolve()
+    assets = set()
+    for groups in LOCAL_REFERENCE_PATTERN.findall(html_str):
+        ref = (groups[0] or groups[1]).strip().split("#")[0].split("?")[0]
+        if not ref or ref.startswith(("http:", "https:", "//", "data:", "javascript:")):
+            continue
+        asset_path = (folder / ref.lstrip("/")).resolve()
+        if asset_path.is_file() and folder in asset_path.parents:
+            assets.add(asset_path)
+    return sorted(assets)
+
+
+class RenderCache:
+    """Disk cache of render results keyed on page content and render settings.
+
+    The key hashes the page's HTML bytes, the bytes of every local file it
+    references and the caller's `settings` (renderer version, viewport, image
+    and readiness options). Each entry is a screenshot file plus a JSON record
+    with the error message and content size. Entries are evicted least
+    recently used first once the cache exceeds `max_bytes`.
+    """
+
+    def __init__(self, cache_dir: str | Path | None = None, max_bytes: int = 512 * 1024**2):
+        if cache_dir is None:
+            cache_dir = get_env("RENDER_CACHE_DIR", DEFAULT_CACHE_DIR)
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = None  # key -> size in bytes, least recently used first
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def make_key(self, folder_path: str, page_file_name: str, settings: Dict) -> str:
+        hasher = hashlib.sha256()
+        hasher.update(json.dumps(settings, sort_keys=True, default=str).encode("utf-8"))
+        html_bytes = Path(folder_path, page_file_name).read_bytes()
+        hasher.update(hashlib.sha256(html_bytes).digest())
+        for asset_path in find_local_assets(folder_path, html_bytes):
+            hasher.update(asset_path.name.encode("utf-8"))
+            hasher.update(hashlib.sha256(asset_path.read_bytes()).digest())
+        return hasher.hexdigest()
+
+    def _record_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.json"
+
+    def _load_entries(self) -> OrderedDict:
+        if self._entries is None:
+            records = sorted(self.cache_dir.glob("*.json"), key=lambda path: path.stat().st_mtime)
+            self._entries = OrderedDict()
+            for record_path in records:
+                try:
+                    record = json.loads(record_path.read_text(encoding="utf-8"))
+                except (OSError, ValueError):
+                    continue
+                self._entries[record_path.stem] = record.get("size", 0)
+        return self._entries
+
+    def get(self, key: str, screenshot_path: str) -> tuple | None:
+        """On a hit, place the cached screenshot at `screenshot_path` and return
+        the render_page result tuple."""
+        record_path = self._record_path(key)
+        try:
+            record = json.loads(record_path.read_text(encoding="utf-8"))
+            cached_image = self.cache_dir / f"{key}{record['extension']}"
+            os.makedirs(os.path.dirname(screenshot_path) or ".", exist_ok=True)
+            shutil.copyfile(cached_image, screenshot_path)
+            os.utime(record_path)
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.stats["misses"] += 1
+            return None
+        with self._lock:
+            self.stats["hits"] += 1
+            entries = self._load_entries()
+            if key in entries:
+                entries.move_to_end(key)
+        return (
+            screenshot_path,
+            record["error_message"],
+            record["content_width"],
+            record["content_height"],
+        )
+
+    def put(self, key: str, result: tuple):
+        screenshot_path, error_message, content_width, content_height = result
+        if screenshot_path is None:
+            # Failed renders are retried next time
+            return
+        extension = os.path.splitext(screenshot_path)[1]
+        cached_image = self.cache_dir / f"{key}{extension}"
+        tmp_suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copyfile(screenshot_path, str(cached_image) + tmp_suffix)
+        os.replace(str(cached_image) + tmp_suffix, cached_image)
+        record = {
+            "extension": extension,
+            "error_message": error_message,
+            "content_width": content_width,
+            "content_height": content_height,
+            "size": cached_image.stat().st_size,
+        }
+        record_path = self._record_path(key)
+        Path(str(record_path) + tmp_suffix).write_text(json.dumps(record), encoding="utf-8")
+        os.replace(str(record_path) + tmp_suffix, record_path)
+        with self._lock:
+            self.stats["stores"] += 1
+            entries = self._load_entries()
+            entries[key] = record["size"]
+            entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        entries = self._entries
+        total = sum(entries.values())
+        while total > self.max_bytes and len(entries) > 1:
+            key, size = entries.popitem(last=False)
+            total -= size
+            self.stats["evictions"] += 1
+            for path in self.cache_dir.glob(f"{key}.*"):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+
+    def hit_rate(self) -> float:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
@@ -0,0 +1,307 @@
+# Target of this module: one local HTTP server per process that serves every
+# chart folder being rendered, each under its own path prefix
+
+import os
+import html
+import hashlib
+import threading
+import http.server
+from typing import Dict, List
+from urllib.parse import parse_qs, quote, urlencode, urlsplit
+
+from assetCache import AssetCache, VENDOR_PREFIX, from_vendor_path, rewrite_cdn_urls
+
+# Content-addressed assets never change, chart pages are revalidated with ETags
+VENDOR_CACHE_CONTROL = "public, max-age=31536000, immutable"
+PAGE_CACHE_CONTROL = "no-cache"
+
+# Hosts several chart pages as iframes of one document. The frames are stacked
+# at the origin so all of them are inside the viewport, where Chrome does not
+# throttle their animation frames; the one being captured is raised on top.
+HARNESS_PATH = "/__harness__"
+HARNESS_FRAME = (
+    '<iframe scrolling="no" src="{src}" onload="this.dataset.loaded = 1"></iframe>'
+)
+HARNESS_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><style>
+html, body {{ margin: 0; background: white; }}
+iframe {{ position: absolute; left: 0; top: 0; width: {width}px; height: {height}px;
+  border: 0; background: white; }}
+</style></head><body>
+{frames}
+</body></html>
+"""
+
+
+def file_etag(file_path: str) -> str:
+    stat = os.stat(file_path)
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+class ChartRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves /<prefix>/<file> from the folder mounted under <prefix>.
+
+    Connections are kept alive (HTTP/1.1) and files carry an ETag so the
+    browser can revalidate them with a 304. When the server has an asset
+    cache, known CDN URLs in served pages are rewritten to /__vendor__/ paths
+    which are answered from the cache.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, *args, **kwargs):
+        self._extra_headers = {}
+        super().__init__(*args, **kwargs)
+
+    @property
+    def asset_cache(self) -> AssetCache | None:
+        return self.server.asset_cache
+
+    def translate_path(self, path: str) -> str:
+        prefix, _, rest = urlsplit(path).path.lstrip("/").partition("/")
+        root = self.server.mounts.get(prefix)
+        if root is None:
+            # Not a mounted folder, let the caller answer 404
+            return os.path.join(os.devnull, "missing")
+        self.directory = root
+        return super().translate_path("/" + rest)
+
+    def end_headers(self):
+        for key, value in self._extra_headers.items():
+            self.send_header(key, value)
+        self._extra_headers = {}
+        super().end_headers()
+
+    def not_modified(self, etag: str) -> bool:
+        self._extra_headers = {"ETag": etag, "Cache-Control": PAGE_CACHE_CONTROL}
+        if etag not in self.headers.get("If-None-Match", ""):
+            return False
+        self.send_response(304)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return True
+
+    def send_head(self):
+        file_path = self.translate_path(self.path)
+        if os.path.isfile(file_path) and self.not_modified(file_etag(file_path)):
+            return None
+        return super().send_head()
+
+    def send_generated(self) -> bool:
+        """Answer requests whose body is built here rather than read from a
+        file as is. Returns False for plain files."""
+        if self.path == "/favicon.ico":
+            # Return 204 No Content for favicon.ico requests
+            self.send_response(204)
+            self.end_headers()
+            return True
+        if urlsplit(self.path).path == HARNESS_PATH:
+            self.send_harness()
+            return True
+        if self.asset_cache is not None:
+            if self.path.startswith(VENDOR_PREFIX):
+                self.send_vendor_asset()
+                return True
+            file_path = self.translate_path(self.path)
+            if file_path.endswith(".html") and os.path.isfile(file_path):
+                self.send_rewritten_page(file_path)
+                return True
+        return False
+
+    def do_GET(self):
+        if not self.send_generated():
+            super().do_GET()
+
+    def do_HEAD(self):
+        # Same headers as GET, Content-Length included; send_body skips the body
+        if not self.send_generated():
+            super().do_HEAD()
+
+    def send_body(self, body: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def send_vendor_asset(self):
+        url = from_vendor_path(self.path)
+        try:
+            body, content_type = self.asset_cache.fetch(url)
+        except LookupError:
+            self.send_error(404, f"{url} is not cached")
+            return
+        except Exception as e:
+            self.send_error(502, f"Failed to fetch {url}: {str(e)}")
+            return
+        if "css" in content_type:
+            # Stylesheets may pull fonts from other CDN hosts
+            body = rewrite_cdn_urls(body.decode("utf-8")).encode("utf-8")
+        self._extra_headers = {"Cache-Control": VENDOR_CACHE_CONTROL}
+        self.send_body(body, content_type)
+
+    def send_rewritten_page(self, file_path: str):
+        if self.not_modified(file_etag(file_path)):
+            return
+        with open(file_path, "r", encoding="utf-8", errors="surrogateescape") as f:
+            html_str = f.read()
+        body = rewrite_cdn_urls(html_str).encode("utf-8", errors="surrogateescape")
+        self.send_body(body, "text/html; charset=utf-8")
+
+    def send_harness(self):
+        query = parse_qs(urlsplit(self.path).query)
+        frames = "\n".join(
+            HARNESS_FRAME.format(src=html.escape(src))
+            for src in query.get("frame", [])
+            # Only pages of this server
+            if src.startswith("/") and not src.startswith("//")
+        )
+        page = HARNESS_PAGE.format(
+            width=int(query.get("width", ["2000"])[0]),
+            height=int(query.get("height", ["2000"])[0]),
+            frames=frames,
+        )
+        self.send_body(page.encode("utf-8"), "text/html; charset=utf-8")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ChartServer:
+    """A ThreadingHTTPServer serving many chart folders under path prefixes.
+
+    Binding to port 0 lets the OS pick a free port atomically. Pages must
+    reference their own files with relative URLs, since each folder is served
+    below its prefix rather than at the root.
+
+    Usage:
+        with ChartServer() as server:
+            url = server.url_for(folder_path, "html_0.html")
+    """
+
+    def __init__(
+        self, host: str = "127.0.0.1", port: int = 0, asset_cache: AssetCache | None = None
+    ):
+        self.host = host
+        self.requested_port = port
+        self.asset_cache = asset_cache
+        self.httpd = None
+        self.pid = None
+        self._lock = threading.Lock()
+        self._mount_refs: Dict[str, int] = {}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def start(self) -> "ChartServer":
+        if self.httpd is not None:
+            return self
+        self.httpd = http.server.ThreadingHTTPServer(
+            (self.host, self.requested_port), ChartRequestHandler
+        )
+        self.httpd.daemon_threads = True
+        self.httpd.mounts = {}
+        self.httpd.asset_cache = self.asset_cache
+        self.pid = os.getpid()
+        server_thread = threading.Thread(target=self.httpd.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        return self
+
+    def close(self):
+        if self.httpd is None:
+            return
+        try:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+        except Exception as server_error:
+            print(f"Warning: Error while closing server: {str(server_error)}")
+        self.httpd = None
+
+    def mount(self, folder_path: str) -> str:
+        """Serve `folder_path` and return its path prefix. Idempotent."""
+        folder_path = os.path.abspath(folder_path)
+        prefix = hashlib.sha1(folder_path.encode("utf-8")).hexdigest()[:12]
+        with self._lock:
+            self.start().httpd.mounts[prefix] = folder_path
+        return prefix
+
+    def unmount(self, folder_path: str):
+        prefix = hashlib.sha1(os.path.abspath(folder_path).encode("utf-8")).hexdigest()[:12]
+        with self._lock:
+            self._mount_refs.pop(prefix, None)
+            if self.httpd is not None:
+                self.httpd.mounts.pop(prefix, None)
+
+    def acquire(self, folder_path: str) -> str:
+        """`mount` for a user of a shared server; the folder stays mounted
+        until every user that acquired it has called `release`."""
+        prefix = self.mount(folder_path)
+        with self._lock:
+            self._mount_refs[prefix] = self._mount_refs.get(prefix, 0) + 1
+        return prefix
+
+    def release(self, folder_path: str):
+        prefix = hashlib.sha1(os.path.abspath(folder_path).encode("utf-8")).hexdigest()[:12]
+        with self._lock:
+            refs = self._mount_refs.get(prefix, 0) - 1
+            if refs > 0:
+                self._mount_refs[prefix] = refs
+                return
+            self._mount_refs.pop(prefix, None)
+            if self.httpd is not None:
+                self.httpd.mounts.pop(prefix, None)
+
+    def url_for(self, folder_path: str, page_file_name: str) -> str:
+        prefix = self.mount(folder_path)
+        return f"{self.base_url}/{prefix}/{quote(page_file_name)}"
+
+    def harness_url_for(self, page_urls: List[str], width: int, height: int) -> str:
+        """URL of a page showing `page_urls` (from `url_for`) as iframes of
+        `width` x `height`, in this order."""
+        query = urlencode(
+            {
+                "width": width,
+                "height": height,
+                "frame": [urlsplit(url).path for url in page_urls],
+            },
+            doseq=True,
+        )
+        return f"{self.start().base_url}{HARNESS_PATH}?{query}"
+
+
+_shared_servers: Dict = {}
+_shared_servers_lock = threading.Lock()
+
+
+def get_shared_server(asset_cache: AssetCache | None = None) -> ChartServer:
+    """Return this process's server for the asset cache's folder and mode,
+    starting it on first use. Asset caches on the same folder share one
+    server, the one of the first cache asked for.
+
+    A server inherited through fork has no serving thread in the child, so
+    it is replaced.
+    """
+    key = (
+        (os.path.abspath(asset_cache.cache_dir), asset_cache.offline)
+        if asset_cache is not None
+        else None
+    )
+    with _shared_servers_lock:
+        server = _shared_servers.get(key)
+        if server is None or server.pid != os.getpid() or server.httpd is None:
+            server = ChartServer(asset_cache=asset_cache).start()
+            _shared_servers[key] = server
+        return server
@@ -0,0 +1,419 @@
+# Target of this module: turning each topic's MDX report and chart folder into
+# a self-contained Markdown/MDX report with sized chart images, and a PDF.
+# The PDF step converts Markdown with the `markdown` package (pip install
+# markdown) and prints it with Chrome; --no_pdf does not need the package.
+
+import os
+import re
+import csv
+import json
+import time
+import base64
+import hashlib
+import importlib.util
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from chartManifest import file_hash
+from config import load_config
+from utils import get_saved_topic
+
+# Bump whenever a change to this module changes the assembled output, so that
+# every topic is assembled again
+ASSEMBLY_VERSION = "1"
+ASSEMBLY_RECORD = "assembly.json"
+REPO_ROOT = Path(__file__).resolve().parents[2]
+TOPICS_CSV = REPO_ROOT / "src" / "topics.csv"
+REPORT_FOLDER = REPO_ROOT / "data" / "report"
+HTML_CHARTS_FOLDER = REPO_ROOT / "public" / "html_charts"
+OUTPUT_FOLDER = REPO_ROOT / "build" / "reports"
+CHARTS_SUBFOLDER = "charts"
+
+CHART_TAG_PATTERN = re.compile(
+    r"""<HTMLRenderer\b[^>]*?\bhtmlFile\s*=\s*["']([^"']+)["'][^>]*/>"""
+)
+FRONTMATTER_PATTERN = re.compile(r"\A---\s*\n(.*?)\n---\s*\n", re.DOTALL)
+TITLE_PATTERN = re.compile(r"""^title:\s*(?:'((?:[^']|'')*)'|"([^"]*)"|(.*?))\s*$""", re.MULTILINE)
+
+PDF_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title}</title><style>
+body {{ font-family: Georgia, serif; font-size: 11pt; line-height: 1.5; margin: 0 auto; }}
+h1, h2, h3 {{ font-family: Helvetica, Arial, sans-serif; }}
+img {{ display: block; max-width: 100%; height: auto; margin: 1em auto; }}
+table {{ border-collapse: collapse; }}
+th, td {{ border: 1px solid #ccc; padding: 4px 8px; }}
+</style></head><body>
+{body}
+</body></html>
+"""
+# A4 with 15 mm margins, in inches
+PDF_OPTIONS = {
+    "printBackground": True,
+    "paperWidth": 8.27,
+    "paperHeight": 11.69,
+    "marginTop": 0.59,
+    "marginBottom": 0.59,
+    "marginLeft": 0.59,
+    "marginRight": 0.59,
+}
+
+
+def load_topic_slugs(topics_csv: str | Path = TOPICS_CSV) -> List[str]:
+    """Report and chart folder names of the topics in `topics_csv`, in order."""
+    with open(topics_csv, "r", encoding="utf-8", newline="") as f:
+        slugs = [get_saved_topic(row["topic"]) for row in csv.DictReader(f)]
+    return list(dict.fromkeys(slugs))
+
+
+def split_frontmatter(mdx: str) -> Tuple[str, str]:
+    """(title, body) of an MDX report; the title is empty without frontmatter."""
+    match = FRONTMATTER_PATTERN.match(mdx)
+    if match is None:
+        return "", mdx
+    title_match = TITLE_PATTERN.search(match.group(1))
+    title = ""
+    if title_match:
+        single, double, bare = title_match.groups()
+        title = single.replace("''", "'") if single is not None else double or bare or ""
+    return title, mdx[match.end() :]
+
+
+def read_record(record_path: Path) -> Dict:
+    try:
+        with open(record_path, "r", encoding="utf-8") as f:
+            record = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return record if record.get("version") == ASSEMBLY_VERSION else {}
+
+
+def write_text_atomic(path: Path, text: str):
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(text, encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+def topic_hash(mdx_bytes: bytes, chart_hashes: Dict[str, str], settings: Dict) -> str:
+    payload = json.dumps(
+        {"version": ASSEMBLY_VERSION, "settings": settings, "charts": chart_hashes},
+        sort_keys=True,
+    )
+    digest = hashlib.sha256(payload.encode("utf-8"))
+    digest.update(mdx_bytes)
+    return digest.hexdigest()[:32]
+
+
+def image_tag(src: str, width: float, height: float, alt: str) -> str:
+    return f'<img src="{src}" width="{round(width)}" height="{round(height)}" alt="{alt}" />'
+
+
+def substitute_charts(body: str, charts: Dict[str, Dict], image_format: str) -> str:
+    """Replace every <HTMLRenderer htmlFile="..." /> with a sized <img> of its
+    screenshot. Charts without a screenshot become an HTML comment."""
+    from pageRender import get_screenshot_name
+
+    def replace(match: re.Match) -> str:
+        page = match.group(1)
+        chart = charts.get(page)
+        if chart is None or chart.get("w") is None:
+            return f"<!-- chart {page} could not be rendered -->"
+        src = f"{CHARTS_SUBFOLDER}/{get_screenshot_name(page, image_format)}"
+        return image_tag(src, chart["w"], chart["h"], Path(page).stem)
+
+    return CHART_TAG_PATTERN.sub(replace, body)
+
+
+def print_pdf(driver, html_path: Path, pdf_path: Path):
+    """Print a page of the topic's output folder through the shared server,
+    so its relative chart images resolve."""
+    from renderServer import get_shared_server
+
+    server = get_shared_server()
+    server.acquire(str(html_path.parent))
+    try:
+        driver.get(server.url_for(str(html_path.parent), html_path.name))
+        pdf = driver.execute_cdp_cmd("Page.printToPDF", PDF_OPTIONS)
+    finally:
+        server.release(str(html_path.parent))
+    tmp_path = pdf_path.with_name(f"{pdf_path.name}.{os.getpid()}.tmp")
+    tmp_path.write_bytes(base64.b64decode(pdf["data"]))
+    os.replace(tmp_path, pdf_path)
+
+
+def assemble_topic(
+    slug: str,
+    pool,
+    get_driver,
+    options: Dict,
+) -> Dict:
+    """
+    Assemble one topic into `<output_folder>/<slug>/`: `<slug>.mdx` (the
+    report with sized chart images), `<slug>.md` (the same without
+    frontmatter, titled), `<slug>.pdf` and the chart screenshots.
+
+    The topic is skipped when the hash of its report, its charts' HTML and
+    the settings matches the last complete assembly. Otherwise only charts
+    whose HTML changed or whose screenshot is missing are rendered on `pool`.
+    `get_driver` returns the Chrome driver that prints PDFs.
+    """
+    from pageRender import get_screenshot_name, write_html_size
+
+    report_path = Path(options["report_folder"]) / f"{slug}.mdx"
+    chart_folder = Path(options["charts_folder"]) / slug
+    if not report_path.is_file():
+        return {"topic": slug, "status": "missing", "error": f"No report at {report_path}"}
+    mdx_bytes = report_path.read_bytes()
+    mdx = mdx_bytes.decode("utf-8")
+    pages = list(dict.fromkeys(CHART_TAG_PATTERN.findall(mdx)))
+    chart_hashes = {
+        page: file_hash(chart_folder / page) if (chart_folder / page).is_file() else None
+        for page in pages
+    }
+    settings = {"image_format": options["image_format"], "pdf": options["pdf"]}
+    current_hash = topic_hash(mdx_bytes, chart_hashes, settings)
+
+    output_folder = Path(options["output_folder"]) / slug
+    screenshot_folder = output_folder / CHARTS_SUBFOLDER
+    record_path = output_folder / ASSEMBLY_RECORD
+    record = read_record(record_path)
+    outputs = [output_folder / f"{slug}.mdx", output_folder / f"{slug}.md"]
+    if options["pdf"]:
+        outputs.append(output_folder / f"{slug}.pdf")
+    if (
+        not options["force"]
+        and record.get("topic_hash") == current_hash
+        and record.get("complete")
+        and all(path.is_file() for path in outputs)
+    ):
+        return {"topic": slug, "status": "unchanged", "rendered": 0, "failures": []}
+
+    image_format = options["image_format"]
+    old_charts = record.get("charts", {})
+    charts, jobs = {}, []
+    for page, html_hash in chart_hashes.items():
+        old_chart = old_charts.get(page)
+        screenshot_path = screenshot_folder / get_screenshot_name(page, image_format)
+        if (
+            html_hash is not None
+            and old_chart is not None
+            and old_chart["html_hash"] == html_hash
+            and screenshot_path.is_file()
+        ):
+            charts[page] = old_chart
+        else:
+            charts[page] = {"html_hash": html_hash, "w": None, "h": None, "error": None}
+            jobs.append((str(chart_folder), page, str(screenshot_folder)))
+
+    failures = []
+    if jobs:
+        results = pool.render_many(jobs, options["group_size"])
+        sizes = {}
+        for (_, page, _), result in zip(jobs, results):
+            screenshot_path, error_message, width, height = result
+            if screenshot_path is None:
+                charts[page]["error"] = error_message
+                failures.append({"page": page, "error": error_message})
+                continue
+            charts[page].update(w=round(float(width), 2), h=round(float(height), 2))
+            sizes[page] = f"{width}+{height}"
+        if sizes:
+            write_html_size(str(chart_folder), sizes)
+
+    title, body = split_frontmatter(mdx)
+    assembled = substitute_charts(mdx, charts, image_format)
+    assembled_body = substitute_charts(body, charts, image_format)
+    markdown_text = f"# {title}\n\n{assembled_body}" if title else assembled_body
+    output_folder.mkdir(parents=True, exist_ok=True)
+    write_text_atomic(output_folder / f"{slug}.mdx", assembled)
+    write_text_atomic(output_folder / f"{slug}.md", markdown_text)
+    if options["pdf"]:
+        import markdown
+
+        html_path = output_folder / f"{slug}.html"
+        write_text_atomic(
+            html_path,
+            PDF_PAGE.format(
+                title=title or slug,
+                body=markdown.markdown(markdown_text, extensions=["tables", "fenced_code"]),
+            ),
+        )
+        print_pdf(get_driver(), html_path, output_folder / f"{slug}.pdf")
+
+    write_text_atomic(
+        record_path,
+        json.dumps(
+            {
+                "version": ASSEMBLY_VERSION,
+                # Failed charts leave the topic incomplete, so they are retried
+                "topic_hash": current_hash,
+                "complete": not failures,
+                "charts": charts,
+            },
+            indent=2,
+            ensure_ascii=False,
+        ),
+    )
+    return {
+        "topic": slug,
+        "status": "assembled",
+        "rendered": len(jobs) - len(failures),
+        "failures": failures,
+    }
+
+
+def _assemble_chunk(slugs: List[str], options: Dict) -> List[Dict]:
+    # Runs in a worker process: one warm render pool and one PDF driver serve
+    # every topic of the chunk, Chrome is only started when a topic needs it
+    from pageRender import RenderPool, create_driver, quit_driver
+
+    drivers = []
+
+    def get_driver():
+        if not drivers:
+            drivers.append(create_driver())
+        return drivers[0]
+
+    results = []
+    try:
+        with RenderPool(
+            size=options["pool_size"],
+            ready_kwargs=options["ready_kwargs"],
+            image_format=options["image_format"],
+        ) as pool:
+            for slug in slugs:
+                start_time = time.perf_counter()
+                try:
+                    result = assemble_topic(slug, pool, get_driver, options)
+                except Exception as e:
+                    result = {"topic": slug, "status": "error", "error": f"{type(e).__name__}: {e}"}
+                result["seconds"] = time.perf_counter() - start_time
+                results.append(result)
+    finally:
+        for driver in drivers:
+            quit_driver(driver)
+    return results
+
+
+def assemble_reports(
+    slugs: List[str],
+    workers: int | None = None,
+    output_folder: str | Path = OUTPUT_FOLDER,
+    report_folder: str | Path = REPORT_FOLDER,
+    charts_folder: str | Path = HTML_CHARTS_FOLDER,
+    image_format: str = "PNG",
+    pdf: bool = True,
+    force: bool = False,
+    pool_size: int = 1,
+    group_size: int | None = None,
+    ready_kwargs: Dict | None = None,
+) -> Dict:
+    """Assemble every topic in `slugs` across `workers` processes.
+
+    Returns a summary with the topics per status (assembled, unchanged,
+    missing report, error), the charts rendered and every topic's result.
+    """
+    if not slugs:
+        raise ValueError("No topics to assemble")
+    if pdf and importlib.util.find_spec("markdown") is None:
+        # Fail before the workers start rather than once per topic
+        raise ImportError(
+            "PDF output needs the markdown package: pip install markdown, or pass pdf=False"
+        )
+    options = {
+        "output_folder": str(output_folder),
+        "report_folder": str(report_folder),
+        "charts_folder": str(charts_folder),
+        "image_format": image_format,
+        "pdf": pdf,
+        "force": force,
+        "pool_size": pool_size,
+        "group_size": group_size,
+        "ready_kwargs": ready_kwargs or {},
+    }
+    workers = max(1, min(workers or os.cpu_count() or 1, len(slugs)))
+    # Interleave topics so that every process gets a similar share of the work
+    chunks = [slugs[i::workers] for i in range(workers)]
+
+    start_time = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk_results in executor.map(_assemble_chunk, chunks, [options] * len(chunks)):
+            results.extend(chunk_results)
+    order = {slug: index for index, slug in enumerate(slugs)}
+    results.sort(key=lambda result: order[result["topic"]])
+
+    statuses = {}
+    for result in results:
+        statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+    return {
+        "topics": len(slugs),
+        "workers": workers,
+        "seconds": time.perf_counter() - start_time,
+        "statuses": statuses,
+        "rendered": sum(result.get("rendered", 0) for result in results),
+        "chart_failures": sum(len(result.get("failures", [])) for result in results),
+        "results": results,
+    }
+
+
+def print_assembly_summary(summary: Dict):
+    statuses = ", ".join(f"{count} {status}" for status, count in sorted(summary["statuses"].items()))
+    print(
+        f"{summary['topics']} topics with {summary['workers']} workers in "
+        f"{summary['seconds']:.2f}s: {statuses}"
+    )
+    print(f"Charts rendered: {summary['rendered']}, failed: {summary['chart_failures']}")
+    for result in summary["results"]:
+        if result["status"] == "error":
+            print(f"  {result['topic']}: {result['error']}")
+        for failure in result.get("failures", []):
+            print(f"  {result['topic']}/{failure['page']}: {failure['error']}")
+
+
+if __name__ == "__main__":
+    load_config()
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--topics", type=str, nargs="+", default=None, help="Topic slugs, defaults to topics.csv"
+    )
+    parser.add_argument("--topics_csv", type=str, default=str(TOPICS_CSV))
+    parser.add_argument(
+        "--all_reports",
+        action="store_true",
+        help="Assemble every report in the report folder instead of the topics.csv topics",
+    )
+    parser.add_argument("--report_folder", type=str, default=str(REPORT_FOLDER))
+    parser.add_argument("--charts_folder", type=str, default=str(HTML_CHARTS_FOLDER))
+    parser.add_argument("--output_folder", type=str, default=str(OUTPUT_FOLDER))
+    parser.add_argument("--workers", type=int, default=None, help="Defaults to the CPU count")
+    parser.add_argument("--pool_size", type=int, default=1, help="Chrome drivers per worker")
+    parser.add_argument(
+        "--group_size", type=int, default=None, help="Render this many charts per browser page"
+    )
+    parser.add_argument("--image_format", type=str, default="PNG")
+    parser.add_argument("--no_pdf", action="store_true", help="Only emit MDX and Markdown")
+    parser.add_argument("--force", action="store_true", help="Assemble unchanged topics too")
+    args = parser.parse_args()
+
+    if args.topics:
+        slugs = args.topics
+    elif args.all_reports:
+        slugs = sorted(path.stem for path in Path(args.report_folder).glob("*.mdx"))
+    else:
+        slugs = load_topic_slugs(args.topics_csv)
+    summary = assemble_reports(
+        slugs,
+        args.workers,
+        args.output_folder,
+        args.report_folder,
+        args.charts_folder,
+        image_format=args.image_format.upper(),
+        pdf=not args.no_pdf,
+        force=args.force,
+        pool_size=args.pool_size,
+        group_size=args.group_size,
+    )
+    print_assembly_summary(summary)
+    raise SystemExit(1 if summary["statuses"].get("error") or summary["chart_failures"] else 0)
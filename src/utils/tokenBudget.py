@@ -0,0 +1,172 @@
+# Target of this module: counting prompt tokens cheaply and filling prompt
+# templates so that they fit the model's context
+
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
+from typing import List
+
+import tiktoken
+
+from utils import default_context_size, format_prompt, get_encoder, trim
+
+
+@functools.lru_cache(maxsize=None)
+def get_model_encoder(model: str) -> tiktoken.Encoding:
+    """Encoder of `model`, falling back to cl100k_base for unknown models."""
+    try:
+        encoding_name = tiktoken.encoding_for_model(model).name
+    except KeyError:
+        encoding_name = "cl100k_base"
+    return get_encoder(encoding_name)
+
+
+class TokenBudget:
+    """
+    Token counting and prompt fitting for one model.
+
+    Counts are memoized by content hash (least recently used entries beyond
+    `memo_size` are dropped), and `count_many` encodes all uncached texts in
+    one threaded `encode_batch` call.
+
+    Usage:
+        budget = TokenBudget("gpt-4o", context_size=128000)
+        prompt = budget.fit_prompt(
+            template, shrink_order=["search_results", "report"], reserve=4096,
+            topic=topic, report=report, search_results=search_results,
+        )
+    """
+
+    def __init__(
+        self,
+        model: str = "gpt-4o",
+        context_size: int | None = None,
+        num_threads: int = 8,
+        memo_size: int = 4096,
+    ):
+        self.model = model
+        self.encoder = get_model_encoder(model)
+        self.context_size = context_size if context_size is not None else default_context_size()
+        self.num_threads = num_threads
+        self.memo_size = memo_size
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            "counted": 0,
+            "memo_hits": 0,
+            "prompts": 0,
+            "slots_trimmed": 0,
+            "tokens_saved": 0,
+        }
+
+    @staticmethod
+    def _key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def _remember(self, key: bytes, count: int):
+        self._memo[key] = count
+        self._memo.move_to_end(key)
+        while len(self._memo) > self.memo_size:
+            self._memo.popitem(last=False)
+
+    def count(self, text: str) -> int:
+        return self.count_many([text])[0]
+
+    def count_many(self, texts: List[str]) -> List[int]:
+        keys = [self._key(text) for text in texts]
+        counts = [None] * len(texts)
+        missing = {}
+        with self._lock:
+            for index, key in enumerate(keys):
+                if key in self._memo:
+                    self._memo.move_to_end(key)
+                    counts[index] = self._memo[key]
+                    self.stats["memo_hits"] += 1
+                else:
+                    missing.setdefault(key, []).append(index)
+        if missing:
+            unique_texts = [texts[indexes[0]] for indexes in missing.values()]
+            token_lists = self.encoder.encode_batch(
+                unique_texts, num_threads=self.num_threads, disallowed_special=()
+            )
+            with self._lock:
+                for (key, indexes), tokens in zip(missing.items(), token_lists):
+                    self._remember(key, len(tokens))
+                    for index in indexes:
+                        counts[index] = len(tokens)
+                self.stats["counted"] += len(unique_texts)
+        return counts
+
+    def fit_prompt(
+        self,
+        template: str,
+        shrink_order: List[str] | None = None,
+        reserve: int = 0,
+        snap: str | None = "paragraph",
+        **kwargs,
+    ) -> str:
+        """
+        Fill `template` like `format_prompt`, trimming variable slots until the
+        prompt leaves `reserve` tokens of the context free.
+
+        Slots are sized from their own token counts first. Tokens can merge
+        across the joins with the template, so the formatted prompt is counted
+        again and the largest shrinkable slot trimmed until it fits.
+
+        Args:
+            template (str): The prompt template.
+            shrink_order (List[str] | None): Slots that may be trimmed, the first
+                one is shrunk first. Slots not listed are never trimmed.
+            reserve (int): Tokens kept free, e.g. for the completion.
+            snap (str | None): Passed to `trim`.
+
+        Returns:
+            str: The formatted prompt.
+        """
+        values = {key: str(value) for key, value in kwargs.items()}
+        fixed_tokens = self.count(format_prompt(template, **{key: "" for key in values}))
+        available = self.context_size - reserve - fixed_tokens
+        slot_names = list(values)
+        slot_tokens = dict(zip(slot_names, self.count_many([values[k] for k in slot_names])))
+
+        shrink_order = shrink_order or []
+        for name in shrink_order:
+            if name not in values:
+                raise ValueError(f"Unknown prompt slot: {name}")
+
+        def shrink(name: str, overflow: int) -> int:
+            target = max(0, slot_tokens[name] - overflow)
+            values[name] = trim(values[name], target, snap=snap, encoding_name=self.encoder.name)
+            new_tokens = self.count(values[name]) if values[name] else 0
+            saved = slot_tokens[name] - new_tokens
+            slot_tokens[name] = new_tokens
+            with self._lock:
+                self.stats["slots_trimmed"] += 1
+                self.stats["tokens_saved"] += saved
+            return saved
+
+        overflow = sum(slot_tokens.values()) - available
+        for name in shrink_order:
+            if overflow <= 0:
+                break
+            overflow -= shrink(name, overflow)
+
+        prompt = format_prompt(template, **values)
+        if overflow <= 0:
+            overflow = self.count(prompt) - (self.context_size - reserve)
+            while overflow > 0:
+                shrinkable = [name for name in shrink_order if slot_tokens[name] > 0]
+                if not shrinkable:
+                    break
+                shrink(max(shrinkable, key=slot_tokens.get), overflow)
+                prompt = format_prompt(template, **values)
+                overflow = self.count(prompt) - (self.context_size - reserve)
+
+        if overflow > 0:
+            raise ValueError(
+                f"Prompt exceeds the context by {overflow} tokens after shrinking {shrink_order}"
+            )
+        with self._lock:
+            self.stats["prompts"] += 1
+        return prompt
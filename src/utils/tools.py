@@ -1,42 +1,220 @@
 import random
-import requests
 import os
-from dotenv import load_dotenv
-
-load_dotenv(override=True)
-from typing import Dict
-import re
-import aiohttp
-
-from tenacity import retry, stop_after_attempt, wait_exponential
-
-
-@retry(wait=wait_exponential(multiplier=1, min=4, max=60), stop=stop_after_attempt(6))
-async def firecrawl_search(query: str, params: Dict = {}):
-    FIRECRAWL_KEY = os.environ.get("FIRECRAWL_KEY")
-    if not FIRECRAWL_KEY:
-        raise ValueError("Firecrawl API key not configured.")
-    url = "https://api.firecrawl.dev/v1/search"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {FIRECRAWL_KEY}",
-    }
-    data = {"query": query}
-    for key, value in params.items():
-        data[key] = value
-
-    proxy = os.environ.get("PROXY_ADDR")
-
-    async with aiohttp.ClientSession() as session:
-        if proxy:
-            async with session.post(
-                url=url,
-                headers=headers,
-                json=data,
-                proxy=proxy,
-            ) as response:
-                res = await response.json()
-        else:
-            async with session.post(url=url, headers=headers, json=data) as response:
-                res = await response.json()
-        return res
\ No newline at end of file
+from typing import Dict, List, Tuple
+import json
+import time
+import asyncio
+import hashlib
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+
+from config import get_env
+
+FIRECRAWL_SEARCH_URL = "https://api.firecrawl.dev/v1/search"
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+class TokenBucket:
+    """Async token bucket: `rate` requests per second with bursts of up to
+    `capacity`. `pause` blocks every caller, e.g. for a Retry-After."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def parse_retry_after(value: str | None, default: float) -> float:
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class SearchClient:
+    """
+    Firecrawl search client shared by a whole research run.
+
+    - one pooled aiohttp session,
+    - a token bucket limiting requests to `requests_per_minute`; a 429/503
+      pauses the bucket for the server's Retry-After (or an exponential
+      backoff) instead of stalling each query separately,
+    - identical in-flight queries (same query and params) share one request,
+    - successful results are cached on disk under `cache_dir` for `cache_ttl`.
+
+    `base_url` can point at a local mock server for testing.
+
+    Usage:
+        async with SearchClient() as client:
+            results = await client.search_many(["query 1", "query 2"])
+    """
+
+    def __init__(
+        self,
+        api_key: str | None = None,
+        base_url: str = FIRECRAWL_SEARCH_URL,
+        requests_per_minute: float = 100,
+        burst: int = 10,
+        max_concurrency: int = 16,
+        max_retries: int = 6,
+        cache_dir: str | Path | None = None,
+        cache_ttl: float = 24 * 3600,
+        proxy: str | None = None,
+    ):
+        self.api_key = api_key or get_env("FIRECRAWL_KEY")
+        if not self.api_key:
+            raise ValueError("Firecrawl API key not configured.")
+        self.base_url = base_url
+        self.bucket = TokenBucket(requests_per_minute / 60.0, burst)
+        self.max_retries = max_retries
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.cache_ttl = cache_ttl
+        self.proxy = proxy if proxy is not None else get_env("PROXY_ADDR")
+        self.session = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.stats = {
+            "queries": 0,
+            "cache_hits": 0,
+            "coalesced": 0,
+            "requests": 0,
+            "throttled": 0,
+        }
+
+    async def __aenter__(self):
+        import aiohttp
+
+        self.session = aiohttp.ClientSession(
+            headers={
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {self.api_key}",
+            }
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.session.close()
+        self.session = None
+
+    @staticmethod
+    def _cache_key(data: Dict) -> str:
+        payload = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _read_cache(self, key: str) -> Dict | None:
+        if self.cache_dir is None:
+            return None
+        cache_file = self.cache_dir / f"{key}.json"
+        try:
+            if time.time() - cache_file.stat().st_mtime > self.cache_ttl:
+                return None
+            return json.loads(cache_file.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self, key: str, res: Dict):
+        if self.cache_dir is None or not res.get("success", True):
+            return
+        cache_file = self.cache_dir / f"{key}.json"
+        tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+        tmp_file.write_text(json.dumps(res, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_file, cache_file)
+
+    async def _post(self, data: Dict) -> Dict:
+        import aiohttp
+
+        for attempt in range(self.max_retries):
+            await self.bucket.acquire()
+            backoff = min(60, 2**attempt) * (1 + random.random() / 4)
+            last_attempt = attempt == self.max_retries - 1
+            async with self._semaphore:
+                self.stats["requests"] += 1
+                try:
+                    async with self.session.post(
+                        self.base_url, json=data, proxy=self.proxy
+                    ) as response:
+                        if response.status in RETRY_STATUSES and not last_attempt:
+                            self.stats["throttled"] += 1
+                            self.bucket.pause(
+                                parse_retry_after(response.headers.get("Retry-After"), backoff)
+                            )
+                            continue
+                        # Firecrawl reports errors as {"success": false, "error": ...}
+                        return await response.json(content_type=None)
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    if last_attempt:
+                        raise
+            await asyncio.sleep(backoff)
+
+    async def search(self, query: str, params: Dict | None = None) -> Dict:
+        data = {"query": query, **(params or {})}
+        key = self._cache_key(data)
+        self.stats["queries"] += 1
+
+        cached = self._read_cache(key)
+        if cached is not None:
+            self.stats["cache_hits"] += 1
+            return cached
+
+        future = self._inflight.get(key)
+        if future is not None:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.ensure_future(self._post(data))
+        self._inflight[key] = future
+        try:
+            res = await asyncio.shield(future)
+        finally:
+            self._inflight.pop(key, None)
+        self._write_cache(key, res)
+        return res
+
+    async def search_many(
+        self, queries: List[str | Tuple[str, Dict]], params: Dict | None = None
+    ) -> List[Dict]:
+        """Search all queries concurrently within the rate limit. A query is
+        either a string using `params` or a (query, params) pair. Results keep
+        the order of `queries`."""
+        tasks = []
+        for query in queries:
+            if isinstance(query, tuple):
+                query, query_params = query
+            else:
+                query_params = params
+            tasks.append(self.search(query, query_params))
+        return await asyncio.gather(*tasks)
+
+
+async def firecrawl_search(query: str, params: Dict | None = None):
+    """Single query. Use one SearchClient for a batch of queries."""
+    async with SearchClient() as client:
+        return await client.search(query, dict(params or {}))
@@ -0,0 +1,259 @@
+# Target of this module: cheap structured timing of research and rendering
+# stages, kept in memory or written as JSONL and summarized per stage
+
+import os
+import json
+import math
+import time
+import atexit
+import random
+import itertools
+import threading
+import contextvars
+from argparse import ArgumentParser
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+from config import load_config
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_span_ids = itertools.count(1)
+
+
+class Span:
+    """One timed stage. Attributes added with `set` (sizes, counts, ...) end up
+    in the span's record next to its name, duration and parent."""
+
+    __slots__ = ("name", "span_id", "parent_id", "trace_id", "start", "attrs")
+    sampled = True
+
+    def __init__(self, name: str, parent: "Span | None", attrs: Dict):
+        self.name = name
+        self.span_id = next(_span_ids)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.trace_id = parent.trace_id if parent is not None else self.span_id
+        self.start = time.time()
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+class _UnsampledSpan:
+    """Stands in for spans of traces that were not sampled, and their children."""
+
+    sampled = False
+
+    def set(self, **attrs):
+        pass
+
+
+UNSAMPLED_SPAN = _UnsampledSpan()
+
+
+class Tracer:
+    """
+    Records spans into a ring buffer of the last `ring_size` spans and, with a
+    `path`, appends them to a JSONL file. Attributes are kept under "attrs"
+    so they cannot shadow the span's own fields.
+
+    The file is line buffered: every record is written when its span ends, so
+    forked worker processes, which exit without running `atexit`, lose no
+    spans, and their records interleave whole lines with the parent's.
+
+    Sampling is decided once per trace (a span without a parent): with
+    `sample_rate` 0.1 about one root call in ten is recorded, together with
+    all spans below it. Unsampled spans cost one random draw and a context
+    variable update.
+
+    Usage:
+        tracer = Tracer("trace.jsonl")
+        with tracer.span("render", page=page_file_name) as span:
+            ...
+            span.set(png_bytes=len(png_bytes))
+    """
+
+    def __init__(
+        self,
+        path: str | Path | None = None,
+        sample_rate: float = 1.0,
+        ring_size: int = 10000,
+    ):
+        self.path = Path(path) if path else None
+        self.sample_rate = sample_rate
+        self.ring = deque(maxlen=ring_size)
+        self._lock = threading.Lock()
+        self._file = None
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8", buffering=1)
+            atexit.register(self.close)
+
+    @contextmanager
+    def span(self, name: str, **attrs) -> Iterator[Span]:
+        parent = _current_span.get()
+        if parent is None:
+            sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+        else:
+            sampled = parent.sampled
+        if not sampled:
+            token = _current_span.set(UNSAMPLED_SPAN)
+            try:
+                yield UNSAMPLED_SPAN
+            finally:
+                _current_span.reset(token)
+            return
+
+        span = Span(name, parent, attrs)
+        token = _current_span.set(span)
+        start_time = time.perf_counter()
+        status, error = "ok", None
+        try:
+            yield span
+        except BaseException as e:
+            status, error = "error", f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            duration = time.perf_counter() - start_time
+            _current_span.reset(token)
+            self._emit(span, duration, status, error)
+
+    def _emit(self, span: Span, duration: float, status: str, error: str | None):
+        record = {
+            "name": span.name,
+            "id": span.span_id,
+            "parent": span.parent_id,
+            "trace": span.trace_id,
+            "pid": os.getpid(),
+            "start": span.start,
+            "duration": duration,
+            "status": status,
+        }
+        if error is not None:
+            record["error"] = error
+        if span.attrs:
+            record["attrs"] = span.attrs
+        with self._lock:
+            self.ring.append(record)
+            if self._file is not None:
+                self._file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+    def spans(self) -> List[Dict]:
+        with self._lock:
+            return list(self.ring)
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    return _tracer
+
+
+def configure_tracing(
+    path: str | Path | None = None, sample_rate: float = 1.0, ring_size: int = 10000
+) -> Tracer:
+    """Replace the process-wide tracer used by `trace` and the `log` decorator."""
+    global _tracer
+    _tracer.close()
+    _tracer = Tracer(path, sample_rate, ring_size)
+    return _tracer
+
+
+def trace(name: str, **attrs):
+    """`with trace("stage"):` records a span on the process-wide tracer."""
+    return _tracer.span(name, **attrs)
+
+
+def load_spans(paths: List[str | Path]) -> List[Dict]:
+    spans = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            spans.extend(json.loads(line) for line in f if line.strip())
+    return spans
+
+
+def percentile(values: List[float], q: float) -> float | None:
+    """Nearest-rank percentile, q in [0, 100]."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, math.ceil(q / 100.0 * len(ordered)) - 1)
+    return ordered[rank]
+
+
+def summarize_spans(spans: List[Dict]) -> List[Dict]:
+    """
+    Time per stage (span name), slowest total first. `self` is the time not
+    covered by child spans, so the `self` column adds up to the run's time
+    without double counting nested stages.
+    """
+    child_time = {}
+    for span in spans:
+        if span["parent"] is not None:
+            key = (span["pid"], span["parent"])
+            child_time[key] = child_time.get(key, 0.0) + span["duration"]
+
+    stages = {}
+    for span in spans:
+        stage = stages.setdefault(span["name"], {"durations": [], "self": 0.0, "errors": 0})
+        stage["durations"].append(span["duration"])
+        stage["self"] += max(
+            0.0, span["duration"] - child_time.get((span["pid"], span["id"]), 0.0)
+        )
+        stage["errors"] += span["status"] != "ok"
+
+    summary = []
+    for name, stage in stages.items():
+        durations = sorted(stage["durations"])
+        summary.append(
+            {
+                "name": name,
+                "count": len(durations),
+                "errors": stage["errors"],
+                "total": sum(durations),
+                "self": stage["self"],
+                "mean": sum(durations) / len(durations),
+                "p50": percentile(durations, 50),
+                "p95": percentile(durations, 95),
+                "max": durations[-1],
+            }
+        )
+    return sorted(summary, key=lambda stage: stage["total"], reverse=True)
+
+
+def print_report(summary: List[Dict]):
+    print(
+        f"{'stage':<48} {'count':>7} {'errors':>6} {'total s':>9} {'self s':>9} "
+        f"{'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}"
+    )
+    for stage in summary:
+        print(
+            f"{stage['name'][:48]:<48} {stage['count']:>7} {stage['errors']:>6} "
+            f"{stage['total']:>9.2f} {stage['self']:>9.2f} {stage['mean'] * 1000:>9.1f} "
+            f"{stage['p50'] * 1000:>9.1f} {stage['p95'] * 1000:>9.1f} {stage['max'] * 1000:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    load_config()
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    report_parser = subparsers.add_parser("report", help="Time per stage across a run")
+    report_parser.add_argument("traces", type=str, nargs="+", help="JSONL trace files")
+    args = parser.parse_args()
+
+    print_report(summarize_spans(load_spans(args.traces)))
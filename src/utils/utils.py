@@ -1,22 +1,36 @@
-import os
-from dotenv import load_dotenv
+from __future__ import annotations
 
-load_dotenv(override=True)
+import os
 from pathlib import Path
 import re
 import asyncio
 
 import logging
+import logging.handlers
+import queue
+import atexit
+import gzip
+import shutil
 import time
 import json
-import requests
-import tiktoken
-from typing import List, Union, Dict
-from bs4 import BeautifulSoup
-import aiohttp
+import itertools
+import hashlib
+from typing import TYPE_CHECKING, AsyncIterator, List, Tuple, Union, Dict
+import functools
 from functools import wraps
-import schema
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from html.parser import HTMLParser
+from config import get_env
+from referenceCache import FRESH, STALE, ReferenceCache
+from htmlSanitizer import sanitize_html
+from tracing import trace
+
+# Heavy dependencies (tiktoken, bs4, requests, aiohttp, schema) are imported
+# where they are used, so that processes needing only the light helpers start
+# fast. .env is loaded by config.load_config, not at import.
+if TYPE_CHECKING:
+    import schema
+    import tiktoken
 
 
 def format_prompt(template: str, **kwargs) -> str:
@@ -30,6 +44,12 @@ def format_prompt(template: str, **kwargs) -> str:
         raise ValueError(f"Missing required prompt variable: {e}")
 
 
+@functools.lru_cache(maxsize=256)
+def get_tag_pattern(tag: str) -> re.Pattern:
+    """Compiled pattern matching `<tag>...</tag>`, cached per tag."""
+    return re.compile(f"<{re.escape(tag)}>(.*?)</{re.escape(tag)}>", re.DOTALL)
+
+
 def extract_xml(text: str, tag: str) -> str:
     """
     Implementation of Anthropic from `https://github.com/anthropics/anthropic-cookbook/blob/main/patterns/agents/util.py`.
@@ -42,7 +62,7 @@ def extract_xml(text: str, tag: str) -> str:
     Returns:
         str: The content of the specified XML tag, or an empty string if the tag is not found.
     """
-    match = re.search(f"<{tag}>(.*?)</{tag}>", text, re.DOTALL)
+    match = get_tag_pattern(tag).search(text)
     return match.group(1) if match else ""
 
 
@@ -56,27 +76,207 @@ def extract_xml_num(text: str, tag: str, num: int) -> str:
     Returns:
         str: The content of the specified XML tag, or an empty string if the tag is not found.
     """
-    result = ""
-    match = re.findall(f"<{tag}>(.*?)</{tag}>", text, re.DOTALL)
-    if num >= len(match):
-        return result
-    try:
-        result = match[num].strip()
-    except Exception as e:
-        raise ValueError(f"Error: {e} Incorrect tag index in xml")
-    return result
+    pattern = get_tag_pattern(tag)
+    if num < 0:
+        # Counting from the end needs every match
+        match = pattern.findall(text)
+        try:
+            return match[num].strip()
+        except IndexError as e:
+            raise ValueError(f"Error: {e} Incorrect tag index in xml")
+    # Stop scanning as soon as the num-th match is found
+    match = next(itertools.islice(pattern.finditer(text), num, None), None)
+    return match.group(1).strip() if match else ""
 
 
 def extract_code(resp: str, language: str = "python") -> str:
     """Extract Python code snippet from the response."""
-    try:
-        code = resp.split(f"```{language}")[1].split("```")[0].strip()
-    except Exception as e:
-        raise ValueError(f"Error while extracting {language} code: {e}")
-    return code
+    fence = f"```{language}"
+    start = resp.find(fence)
+    if start == -1:
+        raise ValueError(f"Error while extracting {language} code: no {fence} block")
+    start += len(fence)
+    end = resp.find("```", start)
+    return (resp[start:end] if end != -1 else resp[start:]).strip()
+
+
+# An opening tag such as <answer> or <chart_1>, and what may still become one
+OPEN_TAG_PATTERN = re.compile(r"<([A-Za-z_][\w.-]*)>")
+PARTIAL_OPEN_TAG_PATTERN = re.compile(r"(?:[A-Za-z_][\w.-]*)?")
+ANY_TAG_PATTERN = re.compile(r"<([A-Za-z_][\w.-]*)>(.*?)</\1>", re.DOTALL)
+
+
+@functools.lru_cache(maxsize=256)
+def get_tags_pattern(tags: Tuple[str, ...]) -> re.Pattern:
+    alternatives = "|".join(map(re.escape, tags))
+    return re.compile(f"<({alternatives})>(.*?)</\\1>", re.DOTALL)
+
+
+@functools.lru_cache(maxsize=256)
+def get_open_tags_pattern(tags: Tuple[str, ...]) -> re.Pattern:
+    return re.compile(f"<({'|'.join(map(re.escape, tags))})>")
+
+
+def parse_tags(text: str, tags: List[str] | None = None) -> Dict[str, List[str]]:
+    """
+    Extract every top-level `<tag>...</tag>` of a response in one scan.
+    Tags nested inside a matched tag stay part of its content.
 
+    Args:
+        text (str): The response text.
+        tags (List[str] | None): Only collect these tags, all tags if None.
+
+    Returns:
+        Dict[str, List[str]]: Tag name to its contents, in order of appearance.
+    """
+    pattern = get_tags_pattern(tuple(tags)) if tags else ANY_TAG_PATTERN
+    result: Dict[str, List[str]] = {}
+    for match in pattern.finditer(text):
+        result.setdefault(match.group(1), []).append(match.group(2))
+    return result
+
+
+class TagStreamParser:
+    """
+    Incremental `parse_tags` for streamed completions: `feed` returns the
+    (tag, content) pairs that became final with the chunk, `close` the rest
+    once the stream has ended. Together they return exactly what
+    `parse_tags` returns for the whole text, in the same order.
+
+    A closed tag is final once no earlier opening tag can still close, since
+    such a tag would contain it. An opener that never closes (e.g. the <T> of
+    "List<T>") therefore holds back the tags after it until `close`, as the
+    regex only skips it once the text has ended. Each opener's closing tag
+    is searched for once over the text after it.
+    """
 
-def configure_logger(log_file: str | Path) -> logging.Logger:
+    def __init__(self, tags: List[str] | None = None):
+        self.tags = tuple(tags) if tags else None
+        self._open_pattern = get_open_tags_pattern(self.tags) if self.tags else OPEN_TAG_PATTERN
+        self._buffer = ""
+        self._scanned = 0  # where to look for the next opening tag
+        # [tag, opener start, content start, search closing tag from], in order
+        self._openers = []
+
+    def _may_open(self, tail: str) -> bool:
+        # Whether the text after a trailing "<" can still become an opener
+        if self.tags is None:
+            return PARTIAL_OPEN_TAG_PATTERN.fullmatch(tail) is not None
+        return any(tag.startswith(tail) for tag in self.tags)
+
+    def feed(self, chunk: str) -> List[Tuple[str, str]]:
+        self._buffer += chunk
+        return self._drain(final=False)
+
+    def close(self) -> List[Tuple[str, str]]:
+        """End of the stream: openers still waiting will never close."""
+        return self._drain(final=True)
+
+    def _drain(self, final: bool) -> List[Tuple[str, str]]:
+        buffer = self._buffer
+        for match in self._open_pattern.finditer(buffer, self._scanned):
+            self._openers.append([match.group(1), match.start(), match.end(), match.end()])
+            self._scanned = match.end()
+        partial = buffer.rfind("<", self._scanned)
+        if partial != -1 and self._may_open(buffer[partial + 1 :]):
+            self._scanned = partial
+        else:
+            self._scanned = len(buffer)
+
+        closed = []
+        while self._openers:
+            tag, _, content_start, search_from = self._openers[0]
+            closing = f"</{tag}>"
+            end = buffer.find(closing, search_from)
+            if end == -1:
+                if not final:
+                    self._openers[0][3] = max(content_start, len(buffer) - len(closing) + 1)
+                    break
+                # Never closed, the regex moves on to the next opener
+                self._openers.pop(0)
+                continue
+            closed.append((tag, buffer[content_start:end]))
+            match_end = end + len(closing)
+            # Openers inside the match are part of its content
+            self._openers = [opener for opener in self._openers if opener[1] >= match_end]
+            self._scanned = max(self._scanned, match_end)
+
+        # Drop the consumed prefix of the buffer
+        cut = self._openers[0][1] if self._openers else self._scanned
+        if cut:
+            self._buffer = buffer[cut:]
+            self._scanned -= cut
+            for opener in self._openers:
+                opener[1] -= cut
+                opener[2] -= cut
+                opener[3] -= cut
+        return closed
+
+
+async def stream_tags(
+    chunks: AsyncIterator[str], tags: List[str] | None = None
+) -> AsyncIterator[Tuple[str, str]]:
+    """Yield (tag, content) from a streamed completion as soon as each tag is final."""
+    parser = TagStreamParser(tags)
+    async for chunk in chunks:
+        for item in parser.feed(chunk):
+            yield item
+    for item in parser.close():
+        yield item
+
+
+def gzip_rotator(source: str, dest: str):
+    """Rotate a log file into a gzip archive (used with `gzip_namer`)."""
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def gzip_namer(name: str) -> str:
+    return name + ".gz"
+
+
+_log_listener = None
+
+
+def stop_log_listener():
+    """Write out every queued record and close the background log writer.
+    Runs at interpreter exit."""
+    global _log_listener
+    if _log_listener is None:
+        return
+    _log_listener.stop()
+    for handler in _log_listener.handlers:
+        handler.close()
+    _log_listener = None
+
+
+def configure_logger(
+    log_file: str | Path,
+    use_queue: bool = False,
+    max_bytes: int = 0,
+    when: str | None = None,
+    backup_count: int = 5,
+    compress: bool = False,
+) -> logging.Logger:
+    """
+    Send all DEBUG and higher records to `log_file`.
+
+    Args:
+        log_file (str | Path): The log file, truncated unless it rotates.
+        use_queue (bool): Only enqueue records on the calling thread and write
+            them from a background thread (QueueHandler/QueueListener), so that
+            logging never blocks the event loop on disk I/O. Queued records are
+            written out at exit.
+        max_bytes (int): Rotate once the file reaches this size.
+        when (str | None): Rotate on time instead, e.g. "midnight" or "H"
+            (see TimedRotatingFileHandler).
+        backup_count (int): Rotated files kept.
+        compress (bool): Gzip rotated files.
+
+    Returns:
+        logging.Logger: The root logger.
+    """
     no_propagate_libs = [
         "openai",
         "httpx",
@@ -95,90 +295,139 @@ def configure_logger(log_file: str | Path) -> logging.Logger:
     for lib in no_propagate_libs:
         logging.getLogger(lib).propagate = False
     formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-    file_handler = logging.FileHandler(log_file, mode="w", encoding="utf-8")
+    if when:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            log_file, when=when, backupCount=backup_count, encoding="utf-8"
+        )
+    elif max_bytes:
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+        )
+    else:
+        file_handler = logging.FileHandler(log_file, mode="w", encoding="utf-8")
+    if compress:
+        file_handler.namer = gzip_namer
+        file_handler.rotator = gzip_rotator
     file_handler.setFormatter(formatter)
     root_logger = logging.getLogger()
     root_logger.setLevel(logging.DEBUG)
-    root_logger.addHandler(file_handler)
+    if not use_queue:
+        root_logger.addHandler(file_handler)
+        return root_logger
+
+    global _log_listener
+    stop_log_listener()
+    for handler in root_logger.handlers[:]:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            root_logger.removeHandler(handler)
+    log_queue = queue.SimpleQueue()
+    # The message is still formatted on the calling thread (QueueHandler.prepare),
+    # so records never show objects changed after the call; only I/O moves off
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    _log_listener = logging.handlers.QueueListener(
+        log_queue, file_handler, respect_handler_level=True
+    )
+    _log_listener.start()
     return root_logger
 
 
+atexit.register(stop_log_listener)
+
+
+class LazyMessage:
+    """Log message argument built only if a handler actually emits the record."""
+
+    __slots__ = ("build", "args")
+
+    def __init__(self, build, *args):
+        self.build = build
+        self.args = args
+
+    def __str__(self):
+        return self.build(*self.args)
+
+
+def result_size(result) -> int | None:
+    try:
+        return len(result)
+    except TypeError:
+        return None
+
+
 def log(class_variables: List[str] | None = None):
+    """
+    Log each call of the decorated method and record it as a `Class.method`
+    span (see tracing.py). The debug message, with the full return value and
+    the JSON of `class_variables`, is only built when DEBUG records are
+    actually emitted.
+    """
+
     def decorator(func):
         # 检查函数是否是异步函数
         is_async = asyncio.iscoroutinefunction(func)
 
+        # 获取需要记录的变量
+        def get_class_vars(self):
+            if not class_variables:
+                return None
+            vars = {var: getattr(self, var, "<未找到>") for var in class_variables}
+            json_str = json.dumps(vars, indent=4, ensure_ascii=False)
+            return json_str
+
+        def success_message(self, duration, result):
+            return (
+                f"✅ 方法 {self.__class__.__name__}.{func.__name__} 成功 | "
+                f"耗时: {duration:.2f}s | "
+                f"return: {result} | "
+                f"类变量: {get_class_vars(self)}"
+            )
+
+        def failure_message(self, duration, error):
+            return (
+                f"❌ 方法 {self.__class__.__name__}.{func.__name__} 失败 | "
+                f"耗时: {duration:.2f}s | "
+                f"错误: {str(error)}"
+            )
+
         @wraps(func)
         async def async_wrapper(self, *args, **kwargs):
             logger = logging.getLogger(__name__)
-            start_time = time.perf_counter()
-
-            # 获取需要记录的变量
-            def get_class_vars():
-                if not class_variables:
-                    return None
-                vars = {var: getattr(self, var, "<未找到>") for var in class_variables}
-                json_str = json.dumps(vars, indent=4, ensure_ascii=False)
-                return json_str
-
-            try:
-                # 对于异步函数，需要 await 执行结果
-                result = await func(self, *args, **kwargs)
+            with trace(f"{self.__class__.__name__}.{func.__name__}") as span:
+                start_time = time.perf_counter()
+                try:
+                    # 对于异步函数，需要 await 执行结果
+                    result = await func(self, *args, **kwargs)
+                except Exception as e:
+                    duration = time.perf_counter() - start_time
+                    logger.error("%s", LazyMessage(failure_message, self, duration, e))
+                    raise
                 duration = time.perf_counter() - start_time
+                span.set(result_size=result_size(result))
 
                 # 记录成功信息
-                logger.debug(
-                    f"✅ 方法 {self.__class__.__name__}.{func.__name__} 成功 | "
-                    f"耗时: {duration:.2f}s | "
-                    f"return: {result} | "
-                    f"类变量: {get_class_vars()}"
-                )
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("%s", LazyMessage(success_message, self, duration, result))
                 return result
 
-            except Exception as e:
-                duration = time.perf_counter() - start_time
-                logger.error(
-                    f"❌ 方法 {self.__class__.__name__}.{func.__name__} 失败 | "
-                    f"耗时: {duration:.2f}s | "
-                    f"错误: {str(e)}"
-                )
-                raise
-
         @wraps(func)
         def sync_wrapper(self, *args, **kwargs):
             logger = logging.getLogger(__name__)
-            start_time = time.perf_counter()
-
-            # 获取需要记录的变量
-            def get_class_vars():
-                if not class_variables:
-                    return None
-                vars = {var: getattr(self, var, "<未找到>") for var in class_variables}
-                json_str = json.dumps(vars, indent=4, ensure_ascii=False)
-                return json_str
-
-            try:
-                result = func(self, *args, **kwargs)
+            with trace(f"{self.__class__.__name__}.{func.__name__}") as span:
+                start_time = time.perf_counter()
+                try:
+                    result = func(self, *args, **kwargs)
+                except Exception as e:
+                    duration = time.perf_counter() - start_time
+                    logger.error("%s", LazyMessage(failure_message, self, duration, e))
+                    raise
                 duration = time.perf_counter() - start_time
+                span.set(result_size=result_size(result))
 
                 # 记录成功信息
-                logger.debug(
-                    f"✅ 方法 {self.__class__.__name__}.{func.__name__} 成功 | "
-                    f"耗时: {duration:.2f}s | "
-                    f"return: {result} | "
-                    f"类变量: {get_class_vars()}"
-                )
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("%s", LazyMessage(success_message, self, duration, result))
                 return result
 
-            except Exception as e:
-                duration = time.perf_counter() - start_time
-                logger.error(
-                    f"❌ 方法 {self.__class__.__name__}.{func.__name__} 失败 | "
-                    f"耗时: {duration:.2f}s | "
-                    f"错误: {str(e)}"
-                )
-                raise
-
         # 根据函数类型返回相应的包装器
         return async_wrapper if is_async else sync_wrapper
 
@@ -200,7 +449,9 @@ def get_elapsed_time(start_time) -> str:
 
 
 def is_url_accessible(url: str):
-    proxy_addr = os.environ.get("PROXY_ADDR")
+    import requests
+
+    proxy_addr = get_env("PROXY_ADDR")
     if proxy_addr:
         proxies = {"http": proxy_addr, "https": proxy_addr}
     else:
@@ -217,62 +468,307 @@ def is_url_accessible(url: str):
 
 
 def process_html_str(html_str):
-    font_awesome_pattern = r'<script\s+src="https://kit\.fontawesome\.com/a076d05399\.js"(?:\s+crossorigin(?:=["\'](.*?)["\'])?)?(?:\s+[^>]*)?></script>'
-    replacement = '<link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css">'
-    html_str = re.sub(font_awesome_pattern, replacement, html_str)
-    return html_str
+    """Replace the Font Awesome kit script with the cdnjs stylesheet."""
+    return sanitize_html(html_str, body_styles=False)
 
 
 def remove_anchor_links(narrative: str) -> str:
     return re.sub(r"\[(.*?)\]\(#\)", r"\1", narrative)
 
 
+@functools.lru_cache(maxsize=None)
+def get_encoder(encoding_name: str = "cl100k_base") -> tiktoken.Encoding:
+    import tiktoken
+
+    return tiktoken.get_encoding(encoding_name)
+
+
+def default_context_size() -> int:
+    return int(get_env("CONTEXT_SIZE", "128000"))
+
+
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+SENTENCE_BREAK = re.compile(r"(?<=[.!?。！？])\s")
+HEAD_TAIL_SEPARATOR = "\n...\n"
+
+
+def _snap_end(text: str, snap: str | None, window: float = 0.2) -> str:
+    """Shorten `text` to the last paragraph or sentence break within its final
+    `window` share, if there is one."""
+    if snap is None:
+        return text
+    pattern = {"paragraph": PARAGRAPH_BREAK, "sentence": SENTENCE_BREAK}[snap]
+    floor = int(len(text) * (1 - window))
+    last = None
+    for last in pattern.finditer(text, floor):
+        pass
+    return text[: last.start()] if last else text
+
+
+def _snap_start(text: str, snap: str | None, window: float = 0.2) -> str:
+    if snap is None:
+        return text
+    pattern = {"paragraph": PARAGRAPH_BREAK, "sentence": SENTENCE_BREAK}[snap]
+    match = pattern.search(text, 0, int(len(text) * window))
+    return text[match.end() :] if match else text
+
+
+def _head_chars(encoder, tokens: List[int], count: int) -> int:
+    # Token bytes concatenate to the content's UTF-8 bytes, so decoding the
+    # first `count` tokens and dropping a split trailing character gives the
+    # exact character length of the prefix they cover
+    return len(encoder.decode_bytes(tokens[:count]).decode("utf-8", errors="ignore"))
+
+
+def _tail_chars(encoder, tokens: List[int], count: int) -> int:
+    if count <= 0:
+        return 0
+    return len(encoder.decode_bytes(tokens[-count:]).decode("utf-8", errors="ignore"))
+
+
 def trim(
-    content: str, context_size: int = int(os.environ.get("CONTEXT_SIZE", "128000"))
+    content: str,
+    context_size: int | None = None,
+    snap: str | None = None,
+    mode: str = "head",
+    head_ratio: float = 0.5,
+    encoding_name: str = "cl100k_base",
 ) -> str:
+    """
+    Trim `content` to at most `context_size` tokens, encoding it only once.
+
+    Args:
+        content (str): The text to trim.
+        context_size (int | None): Token budget, CONTEXT_SIZE from the config if None.
+        snap (str | None): "paragraph" or "sentence" to move the cut back to the
+            nearest such break near the boundary, None to cut at the exact token.
+        mode (str): "head" keeps the beginning, "head_tail" keeps `head_ratio`
+            of the budget from the beginning and the rest from the end.
+        encoding_name (str): tiktoken encoding.
+
+    Returns:
+        str: The trimmed content, a prefix of `content` in "head" mode.
+    """
     if not content:
         return ""
+    if mode not in ("head", "head_tail"):
+        raise ValueError(f"Unknown trim mode: {mode}")
+    if context_size is None:
+        context_size = default_context_size()
+
+    encoder = get_encoder(encoding_name)
+    tokens = encoder.encode(content, disallowed_special=())
+    if len(tokens) <= context_size:
+        return content
 
-    MIN_CHUNK_SIZE = 140  # 设置最小块大小
-
-    # 使用tiktoken计算tokens数量
-    encoder = tiktoken.get_encoding("cl100k_base")  # 或选择其他编码器
-    tokens = encoder.encode(content)
-    length = len(tokens)
+    budget = context_size
+    if mode == "head_tail":
+        budget -= len(encoder.encode(HEAD_TAIL_SEPARATOR))
+        if budget <= 0:
+            # The separator alone fills the budget, keep the beginning instead
+            mode, budget = "head", context_size
+
+    # A cut text may encode to a few more tokens than the tokens it was cut
+    # from (a split word, tokens merging at the separator), so the result is
+    # re-encoded, which is cheap at its size, and cut shorter until it fits
+    while budget > 0:
+        if mode == "head":
+            trimmed = _snap_end(content[: _head_chars(encoder, tokens, budget)], snap)
+        else:
+            head_budget = int(budget * head_ratio)
+            head = content[: _head_chars(encoder, tokens, head_budget)]
+            tail_length = _tail_chars(encoder, tokens, budget - head_budget)
+            tail = content[len(content) - tail_length :] if tail_length else ""
+            trimmed = _snap_end(head, snap) + HEAD_TAIL_SEPARATOR + _snap_start(tail, snap)
+        excess = len(encoder.encode(trimmed, disallowed_special=())) - context_size
+        if excess <= 0:
+            return trimmed
+        budget -= excess
+    return ""
+
+
+def trim_sources(
+    sources: List[str],
+    context_size: int | None = None,
+    snap: str | None = None,
+    encoding_name: str = "cl100k_base",
+) -> List[str]:
+    """
+    Trim several sources to share one token budget fairly: sources below an
+    equal share are kept whole and their unused share is split among the rest.
+    Each source is encoded once.
+    """
+    if context_size is None:
+        context_size = default_context_size()
+    encoder = get_encoder(encoding_name)
+    token_lists = encoder.encode_batch(sources, disallowed_special=())
+    budgets = [0] * len(sources)
+    remaining = context_size
+    pending = sorted(range(len(sources)), key=lambda i: len(token_lists[i]))
+    while pending:
+        share = remaining // len(pending)
+        index = pending.pop(0)
+        budgets[index] = min(len(token_lists[index]), share)
+        remaining -= budgets[index]
+
+    trimmed = []
+    for source, tokens, budget in zip(sources, token_lists, budgets):
+        if len(tokens) <= budget:
+            trimmed.append(source)
+        else:
+            trimmed.append(_snap_end(source[: _head_chars(encoder, tokens, budget)], snap))
+    return trimmed
 
-    if length <= context_size:
-        return content
 
-    overflow_tokens = length - context_size
-    # 大约每个token对应3个字符，用这个比例估算需要裁剪的字符数
-    chunk_size = len(content) - overflow_tokens * 3
+# Query parameters that only track where a click came from
+TRACKING_PARAM_PATTERN = re.compile(
+    r"^(?:utm_\w+|gclid|dclid|fbclid|msclkid|yclid|mc_cid|mc_eid|_ga|_gl|igshid|spm|ref_src)$",
+    re.IGNORECASE,
+)
+DEFAULT_PORTS = {"http": "80", "https": "443"}
 
-    if chunk_size < MIN_CHUNK_SIZE:
-        return content[:MIN_CHUNK_SIZE]
 
-    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=0)
+@functools.lru_cache(maxsize=65536)
+def canonicalize_url(url: str) -> str:
+    """
+    Key under which URLs of the same page compare equal.
 
-    chunks = splitter.split_text(content)
-    trimmed_prompt = chunks[0] if chunks else ""
+    http and https are treated alike, the host is lowercased without `www.`
+    or a default port, the fragment and tracking parameters (utm_*, gclid,
+    fbclid, ...) are dropped, the remaining query parameters are sorted and
+    a trailing slash is removed. The key is for comparison only, fetch the
+    original URL.
+    """
+    parts = urlsplit(url.strip() if "://" in url else "https://" + url.strip())
+    host = (parts.hostname or "").rstrip(".")
+    if host.startswith("www."):
+        host = host[4:]
+    scheme = parts.scheme.lower()
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port is not None and str(port) != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{port}"
+    path = parts.path.rstrip("/")
+    query = ""
+    if parts.query:
+        params = [
+            (key, value)
+            for key, value in parse_qsl(parts.query, keep_blank_values=True)
+            if not TRACKING_PARAM_PATTERN.match(key)
+        ]
+        query = urlencode(sorted(params))
+    if scheme in DEFAULT_PORTS:
+        scheme = "https"
+    return urlunsplit((scheme, host, path, query, ""))
+
+
+def unique_urls(url_list: List[str]) -> List[str]:
+    """First URL of every canonical URL in `url_list`, in order."""
+    seen = set()
+    unique = []
+    for url in url_list:
+        key = canonicalize_url(url)
+        if key not in seen:
+            seen.add(key)
+            unique.append(url)
+    return unique
+
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+# Maps the ASCII digits of a 64-bit binary string to byte values 0 and 1
+_BIT_DIGITS = bytes.maketrans(b"01", b"\x00\x01")
+MAX_SIMHASH_FEATURES = 255
+
+
+@functools.lru_cache(maxsize=65536)
+def _feature_lanes(feature: str) -> int:
+    """The 64 bits of the feature's hash, one per byte of a 512-bit integer."""
+    digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+    bits = format(int.from_bytes(digest, "big"), "064b").encode("ascii")
+    return int.from_bytes(bits.translate(_BIT_DIGITS), "big")
+
+
+@functools.lru_cache(maxsize=None)
+def _majority_table(num_features: int) -> bytes:
+    return bytes(ord("1") if 2 * count > num_features else ord("0") for count in range(256))
+
+
+def simhash(text: str) -> int:
+    """
+    64-bit SimHash of the distinct words of `text` (the first 255 of them).
 
-    # 最后检查，有可能裁剪后的prompt长度与原始prompt相同
-    # 这是由于tokens的分割方式和splitter的内部工作原理导致的
-    # 处理这种情况，直接进行硬切割
-    if len(trimmed_prompt) == len(content):
-        return trim(content[:chunk_size], context_size)
+    Each word's hash is spread over 64 byte-wide lanes of one big integer, so
+    summing the words counts the votes for all 64 bits at once.
+    """
+    words = list(dict.fromkeys(WORD_PATTERN.findall(text.lower())))[:MAX_SIMHASH_FEATURES]
+    votes = sum(map(_feature_lanes, words)).to_bytes(64, "big")
+    return int(votes.translate(_majority_table(len(words))), 2)
 
-    # 递归裁剪直到prompt在上下文大小范围内
-    return trim(trimmed_prompt, context_size)
 
+def deduplicate_near_duplicates(
+    references: List[schema.Reference], max_distance: int = 4
+) -> List[schema.Reference]:
+    """
+    Drop references whose title and description are near-duplicates of an
+    earlier one: their SimHashes differ in at most `max_distance` bits. On a
+    title plus description, one changed word typically moves about 3 bits.
 
-def deduplicate_by_url(references: List[schema.Reference]) -> List[schema.Reference]:
+    The fingerprints are split into `max_distance + 1` bands. Two fingerprints
+    within the distance agree on at least one band, so only references sharing
+    a band are compared, which keeps the whole pass close to linear.
+    """
+    bands = max_distance + 1
+    band_bits = 64 // bands
+    band_mask = (1 << band_bits) - 1
+    buckets = {}
+    kept = []
+    for reference in references:
+        text = f"{reference.title or ''} {reference.description or ''}"
+        if not WORD_PATTERN.search(text):
+            kept.append(reference)
+            continue
+        fingerprint = simhash(text)
+        band_keys = [
+            (band, (fingerprint >> (band * band_bits)) & band_mask) for band in range(bands)
+        ]
+        if any(
+            (fingerprint ^ other).bit_count() <= max_distance
+            for band_key in band_keys
+            for other in buckets.get(band_key, ())
+        ):
+            continue
+        for band_key in band_keys:
+            buckets.setdefault(band_key, []).append(fingerprint)
+        kept.append(reference)
+    return kept
+
+
+def deduplicate_by_url(
+    references: List[schema.Reference],
+    near_duplicates: bool = False,
+    max_distance: int = 4,
+) -> List[schema.Reference]:
+    """
+    Keep one reference per canonical URL (see `canonicalize_url`), the last
+    one seen, at the position of the first. With `near_duplicates`, also drop
+    references whose title and description nearly repeat an earlier one.
+    """
     unique_dict = {}
     for reference in references:
-        unique_dict[reference.url] = reference
-    return list(unique_dict.values())
+        unique_dict[canonicalize_url(reference.url)] = reference
+    unique = list(unique_dict.values())
+    if near_duplicates:
+        unique = deduplicate_near_duplicates(unique, max_distance)
+    return unique
 
 
 def process_response_text(response_text):
+    from bs4 import BeautifulSoup
+
     # Parse HTML using BeautifulSoup
     soup = BeautifulSoup(response_text, "html.parser")
 
@@ -301,7 +797,242 @@ def process_response_text(response_text):
     return res
 
 
-async def get_url_info(url) -> Dict:
+class HeadMetadataParser(HTMLParser):
+    """Incrementally collects the <title> and meta description of a page,
+    ignoring everything from <body> on."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = None
+        self.description = None
+        self.in_body = False
+        self._title_parts = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.in_body:
+            return
+        if tag == "body":
+            self.in_body = True
+        elif tag == "title" and self.title is None:
+            self._title_parts = []
+        elif tag == "meta" and self.description is None:
+            attrs = dict(attrs)
+            if (attrs.get("name") or "").lower() == "description" and attrs.get("content"):
+                self.description = attrs["content"].strip()
+
+    def handle_endtag(self, tag):
+        if tag == "title" and self._title_parts is not None:
+            self.title = "".join(self._title_parts).strip()
+            self._title_parts = None
+
+    def handle_data(self, data):
+        if self._title_parts is not None:
+            self._title_parts.append(data)
+
+
+HTML_CONTENT_TYPES = ("text/html", "application/xhtml+xml")
+HEAD_END_PATTERN = re.compile(rb"</head\s*>", re.IGNORECASE)
+
+
+class NonHtmlContentError(Exception):
+    pass
+
+
+class ReferenceFetchError(Exception):
+    pass
+
+
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+}
+
+
+class UrlFetcher:
+    """
+    A shared aiohttp session for fetching many reference URLs.
+
+    Connections are pooled and DNS lookups cached across requests. At most
+    `max_concurrency` requests are in flight overall and `per_host_limit` per
+    target host; the per-host bound is enforced with our own semaphores,
+    because with a proxy every connection goes to the proxy host and the
+    connector's own per-host limit no longer applies to the real target.
+
+    Bodies are streamed: reading stops at </head> when the head already has
+    a meta description, and never goes past `max_bytes`. Responses that are
+    not HTML (PDFs, images, ...) are skipped without reading their body.
+
+    With a `reference_cache`, results and failures are looked up by
+    normalized URL first, and stale results are revalidated with their
+    ETag / Last-Modified before anything is downloaded. When revalidation
+    fails, the stale result is returned and kept; failures are only cached
+    for URLs with no good result.
+
+    Usage:
+        async with UrlFetcher(max_concurrency=64) as fetcher:
+            info = await fetcher.get_url_info(url)
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 64,
+        per_host_limit: int = 8,
+        timeout: float = 10,
+        connect_timeout: float = 5,
+        dns_cache_ttl: int = 300,
+        proxy: str | None = None,
+        max_bytes: int = 1024 * 1024,
+        reference_cache: ReferenceCache | None = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.per_host_limit = per_host_limit
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.proxy = proxy if proxy is not None else get_env("PROXY_ADDR")
+        self.max_bytes = max_bytes
+        self.reference_cache = reference_cache
+        self.session = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._host_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    async def __aenter__(self):
+        import aiohttp
+
+        connector = aiohttp.TCPConnector(
+            limit=self.max_concurrency,
+            ttl_dns_cache=self.dns_cache_ttl,
+            use_dns_cache=True,
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers=DEFAULT_HEADERS,
+            timeout=aiohttp.ClientTimeout(total=self.timeout, connect=self.connect_timeout),
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.session.close()
+        self.session = None
+        if self.reference_cache is not None:
+            self.reference_cache.flush()
+
+    def _host_semaphore(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).hostname or ""
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(self.per_host_limit)
+        return self._host_semaphores[host]
+
+    async def fetch_info(
+        self, url: str, proxy: str | None = None, validators: Dict | None = None
+    ) -> tuple:
+        """Stream the page and extract its title and description.
+
+        Returns (info, etag, last_modified); info is None when `validators`
+        (etag, last_modified) were sent and the server answered 304.
+        """
+        headers = {}
+        if validators:
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+        async with self._semaphore, self._host_semaphore(url):
+            async with self.session.get(url, proxy=proxy, headers=headers) as response:
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+                if response.status == 304:
+                    return None, etag, last_modified
+                response.raise_for_status()
+                content_type = response.headers.get("Content-Type", "").lower()
+                if content_type and not content_type.startswith(HTML_CONTENT_TYPES):
+                    raise NonHtmlContentError(f"Skipped non-HTML content: {content_type}")
+                encoding = response.charset or "utf-8"
+
+                chunks = []
+                size = 0
+                head_parser = HeadMetadataParser()
+                head_done = False
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    if not head_done:
+                        # Search the seam with the previous chunk too
+                        window = chunks[-2][-16:] + chunk if len(chunks) > 1 else chunk
+                        head_done = HEAD_END_PATTERN.search(window) is not None
+                        if head_done:
+                            head = b"".join(chunks).decode(encoding, errors="replace")
+                            head_parser.feed(head[: head.lower().find("</head") + 7])
+                            if head_parser.description:
+                                break
+                    if size >= self.max_bytes:
+                        break
+
+        if head_parser.description:
+            info = {"title": head_parser.title or "", "description": head_parser.description}
+            return info, etag, last_modified
+        # No meta description, fall back to parsing the body for a snippet
+        body = b"".join(chunks)[: self.max_bytes].decode(encoding, errors="replace")
+        return process_response_text(body), etag, last_modified
+
+    async def get_url_info(self, url: str) -> Dict:
+        """See `get_url_info`."""
+        import aiohttp
+
+        # Ensure URL format is correct
+        if not url.startswith(("http://", "https://")):
+            url = "https://" + url
+
+        cache = self.reference_cache
+        cache_key = canonicalize_url(url)
+        validators = None
+        if cache is not None:
+            state, entry = cache.lookup(cache_key)
+            if state == FRESH:
+                if entry["error"] is not None:
+                    return {"error": entry["error"], "url": url}
+                return {**entry["info"], "url": url}
+            if state == STALE:
+                validators = entry
+
+        etag, last_modified = None, None
+        try:
+            try:
+                # First attempt: Send request without proxy
+                res, etag, last_modified = await self.fetch_info(url, validators=validators)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not self.proxy:
+                    raise ReferenceFetchError(f"Request error: {str(e)}")
+                try:
+                    # Retry with proxy
+                    res, etag, last_modified = await self.fetch_info(
+                        url, proxy=self.proxy, validators=validators
+                    )
+                except (aiohttp.ClientError, asyncio.TimeoutError) as proxy_error:
+                    raise ReferenceFetchError(f"Proxy request error: {str(proxy_error)}")
+        except ReferenceFetchError as e:
+            res = {"error": str(e)}
+        except Exception as e:
+            res = {"error": f"Error occurred: {str(e)}"}
+
+        if res is None:
+            # 304 Not Modified
+            cache.touch(cache_key)
+            return {**validators["info"], "url": url}
+        if "error" in res:
+            if validators is not None:
+                # Revalidation failed, keep serving the stale entry and retry later
+                return {**validators["info"], "url": url}
+            if cache is not None:
+                cache.store(cache_key, error=res["error"])
+            return {**res, "url": url}
+        if not res["title"]:
+            res["title"] = url
+        if cache is not None:
+            cache.store(cache_key, info=res, etag=etag, last_modified=last_modified)
+        return {**res, "url": url}
+
+
+async def get_url_info(url, fetcher: UrlFetcher | None = None) -> Dict:
     """
     Asynchronously access the URL and extract the webpage title and content snippet.
     If the direct request fails and PROXY_ADDR environment variable is set,
@@ -309,64 +1040,32 @@ async def get_url_info(url) -> Dict:
 
     Parameters:
     url (str): The URL to access
+    fetcher (UrlFetcher | None): Shared session to use, a private one is opened if None
 
     Returns:
     dict: A dictionary containing title and snippet
     """
-    # Ensure URL format is correct
-    if not url.startswith(("http://", "https://")):
-        url = "https://" + url
+    if fetcher is not None:
+        return await fetcher.get_url_info(url)
+    async with UrlFetcher() as fetcher:
+        return await fetcher.get_url_info(url)
 
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-    }
-    try:
-        # First attempt: Send request without proxy
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                url, headers=headers, timeout=aiohttp.ClientTimeout(total=10)
-            ) as response:
-                response.raise_for_status()
-                response_text = await response.text()
-                res = process_response_text(response_text)
-                res["url"] = url
-                if not res["title"]:
-                    res["title"] = url
-
-    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-        # Check if PROXY_ADDR environment variable is set
-        proxy_addr = os.environ.get("PROXY_ADDR")
-        if proxy_addr:
-            try:
-                # Retry with proxy
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(
-                        url,
-                        headers=headers,
-                        proxy=proxy_addr,
-                        timeout=aiohttp.ClientTimeout(total=10),
-                    ) as response:
-                        response.raise_for_status()
-                        response_text = await response.text()
-                        res = process_response_text(response_text)
-                        res["url"] = url
-                        if not res["title"]:
-                            res["title"] = url
-
-            except (aiohttp.ClientError, asyncio.TimeoutError) as proxy_error:
-                res = {"error": f"Proxy request error: {str(proxy_error)}", "url": url}
-        else:
-            res = {"error": f"Request error: {str(e)}", "url": url}
-    except Exception as e:
-        res = {"error": f"Error occurred: {str(e)}", "url": url}
-    finally:
-        return res
 
+async def supplement_references(
+    url_list: List[str],
+    fetcher: UrlFetcher | None = None,
+    reference_cache: ReferenceCache | None = None,
+) -> List[schema.Reference]:
+    import schema
 
-async def supplement_references(url_list: List[str]) -> List[schema.Reference]:
+    if fetcher is not None and reference_cache not in (None, fetcher.reference_cache):
+        raise ValueError("Pass reference_cache to the UrlFetcher instead of alongside it")
     if not url_list:
         return []
-    tasks = [get_url_info(url) for url in url_list]
+    if fetcher is None:
+        async with UrlFetcher(reference_cache=reference_cache) as fetcher:
+            return await supplement_references(url_list, fetcher)
+    tasks = [fetcher.get_url_info(url) for url in unique_urls(url_list)]
     url_res_list = await asyncio.gather(*tasks)
 
     # Filter out any None results or errors
@@ -378,42 +1077,10 @@ async def supplement_references(url_list: List[str]) -> List[schema.Reference]:
     return references
 
 
-def replace_styles(match):
-    style_block = match.group(1)
-
-    # 替换padding值为0
-    style_block = re.sub(r"padding\s*:\s*[^;]+;", "padding: 0;", style_block)
-
-    # 替换background-color为white
-    style_block = re.sub(
-        r"background-color\s*:\s*[^;]+;", "background-color: white;", style_block
-    )
-
-    return style_block
-
-
 def clean_body_styles(html_content):
-    # 清除 body 标签上的 class 属性
-    cleaned_html = re.sub(r'<body\s+class=["\'][^"\']*["\']', "<body", html_content)
-
-    # 清除 body 标签上的 style 属性
-    cleaned_html = re.sub(r'<body\s+style=["\'][^"\']*["\']', "<body", cleaned_html)
-
-    # 处理同时有多个属性的情况
-    cleaned_html = re.sub(
-        r'<body([^>]*)\s+class=["\'][^"\']*["\']', r"<body\1", cleaned_html
-    )
-    cleaned_html = re.sub(
-        r'<body([^>]*)\s+style=["\'][^"\']*["\']', r"<body\1", cleaned_html
-    )
-    selectors = [
-        r"(body\s*\{[^}]*\})",
-        r"(\.container\s*\{[^}]*\})",
-        r"(\.visualization-container\s*\{[^}]*\})",
-    ]
-    for pattern in selectors:
-        cleaned_html = re.sub(pattern, replace_styles, cleaned_html, flags=re.DOTALL)
-    return cleaned_html
+    """Drop body class/style attributes and reset container padding and
+    background. Use `sanitize_html` to also fix Font Awesome in the same pass."""
+    return sanitize_html(html_content, font_awesome=False)
 
 
 def get_saved_topic(topic: str) -> str: